@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Tuple
+
+
+# 预先算好的运算结果，导入时生成一次，执行指令时只需一次下标访问
+# 表项是元组，相同的元组共用一个对象，查表时不会创建新的对象
+def _shared(entries: List[Tuple]):
+    cache: Dict[Tuple, Tuple] = {}
+    return [cache.setdefault(e, e) for e in entries]
+
+
+def _adc_entry(a: int, m: int, c: int):
+    t = a + m + c
+    # 两个操作数符号相同而结果的符号不同时溢出
+    v = (~(a ^ m) & (a ^ t) & 0x80) >> 1
+    return t & 0xff, v, t >> 8
+
+
+def _compare_entry(r: int, m: int):
+    t = r - m
+    return t & 0xff, 1 if t >= 0 else 0
+
+
+# (C << 16 | A << 8 | M) => (结果, V, C)，V 为 0 或 0x40
+# SBC 等于 ADC 操作数取反，查表时用 M ^ 0xFF
+adc_table = _shared([
+    _adc_entry((i >> 8) & 0xff, i & 0xff, i >> 16) for i in range(0x20000)
+])
+
+# (寄存器 << 8 | M) => (用于 N/Z 的差, C)
+compare_table = _shared([
+    _compare_entry(i >> 8, i & 0xff) for i in range(0x10000)
+])
+
+# M => (结果, C)
+asl_table = [((m << 1) & 0xff, m >> 7) for m in range(0x100)]
+lsr_table = [(m >> 1, m & 0x01) for m in range(0x100)]
+
+# (C << 8 | M) => (结果, C)
+rol_table = [(((i << 1) | (i >> 8)) & 0xff, (i >> 7) & 0x01) for i in range(0x200)]
+ror_table = [(i >> 1, i & 0x01) for i in range(0x200)]
+
+# M => M + 1、M - 1
+inc_table = [(m + 1) & 0xff for m in range(0x100)]
+dec_table = [(m - 1) & 0xff for m in range(0x100)]
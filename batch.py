@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Optional, Tuple
+
+import config
+import nes_cpu as nc
+import nes_file as nf
+import nes_scheduler as ns
+
+
+def run_rom(job: Tuple[str, int, Optional[int]]):
+    """
+    在一个独立的 NesCPU 上运行 ROM，直到用完帧数或者指令数的预算
+    没有指定指令数时按 PPU 的时序运行 frames 帧
+    返回可以直接转成 JSON 的运行摘要
+    """
+    path, frames, instructions = job
+    cpu = nc.NesCPU()
+    executed = 0
+    error = None
+    begin = time.perf_counter()
+    try:
+        nes = nf.NesFile.load(path)
+        cpu.load_nes(nes)
+        cpu.interrupt('reset')
+
+        scheduler = ns.NesScheduler(cpu)
+        if instructions is None:
+            while cpu.ppu.frame_count < frames:
+                scheduler.step()
+                executed += 1
+        else:
+            while executed < instructions:
+                scheduler.step()
+                executed += 1
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    used = time.perf_counter() - begin
+
+    frame = cpu.ppu.screen
+    summary = dict(
+        rom=path,
+        instructions=executed,
+        cycles=cpu.cycles,
+        frames=cpu.ppu.frame_count,
+        wall_time=used,
+        registers=cpu.registers,
+        framebuffer_sha1=hashlib.sha1(frame.tobytes()).hexdigest(),
+        error=error,
+    )
+    return summary
+
+
+def _init_worker():
+    # 批量运行时不需要逐条指令的日志
+    config.DEBUG = False
+
+
+def run_roms(paths, frames: int, instructions: Optional[int], processes: Optional[int] = None):
+    jobs = [(path, frames, instructions) for path in paths]
+    with multiprocessing.Pool(processes or os.cpu_count(), initializer=_init_worker) as pool:
+        for summary in pool.imap(run_rom, jobs):
+            yield summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='无界面批量运行 ROM，每个 ROM 输出一行 JSON 摘要')
+    parser.add_argument('roms', nargs='+', help='ROM 文件路径')
+    parser.add_argument('--frames', type=int, default=60, help='每个 ROM 运行的帧数')
+    parser.add_argument('--instructions', type=int, default=None, help='每个 ROM 运行的指令数，设置后忽略 --frames')
+    parser.add_argument('--processes', type=int, default=None, help='进程数，默认为 CPU 核数')
+    parser.add_argument('--output', default=None, help='输出文件，默认输出到标准输出')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for summary in run_roms(args.roms, args.frames, args.instructions, args.processes):
+            print(json.dumps(summary), file=out, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+import pygame
+
+import config
+import log_differ as ld
+import nes_cpu as nc
+import nes_file as nf
+import nes_rewind as nr
+import nes_scheduler as ns
+
+
+# nestest_log.json 覆盖的指令条数
+nestest_instructions = 8991
+
+
+def nestest_cpu(nes: nf.NesFile):
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    # nestest.nes 所需的特殊初始化
+    cpu.set_reg_value('pc', 0xc000)
+    cpu.set_reg_value('p', 0x24)
+    return cpu
+
+
+def run_by_table(cpu: nc.NesCPU):
+    # 按 opcode 字节查表分发
+    for _ in range(nestest_instructions):
+        cpu.execute()
+
+
+def run_by_scheduler(cpu: nc.NesCPU):
+    # 查表分发，并且按周期同步 PPU
+    scheduler = ns.NesScheduler(cpu)
+    for _ in range(nestest_instructions):
+        scheduler.step()
+
+
+def best_run(nes: nf.NesFile, runner, rounds: int):
+    # 返回 (最短用时, 这次运行用掉的 CPU 周期数)
+    best = None
+    for _ in range(rounds):
+        cpu = nestest_cpu(nes)
+        begin = time.perf_counter()
+        runner(cpu)
+        used = time.perf_counter() - begin
+        if best is None or used < best[0]:
+            best = (used, cpu.cycles)
+    return best
+
+
+def instructions_per_second(nes: nf.NesFile, runner, rounds: int):
+    used, _ = best_run(nes, runner, rounds)
+    return nestest_instructions / used
+
+
+def emulated_mhz(nes: nf.NesFile, runner, rounds: int):
+    used, cycles = best_run(nes, runner, rounds)
+    return cycles / used / 1e6
+
+
+def state_round_trip_seconds(nes: nf.NesFile, rounds: int):
+    # 存档再读档一次的最短用时
+    cpu = nestest_cpu(nes)
+    run_by_scheduler(cpu)
+    best = None
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        cpu.load_state(cpu.save_state())
+        used = time.perf_counter() - begin
+        if best is None or used < best:
+            best = used
+    return best
+
+
+def frames_per_second(nes: nf.NesFile, jit: bool, frames: int, rounds: int):
+    # 从 reset 开始按 PPU 时序运行 frames 帧的最高帧率
+    best = None
+    for _ in range(rounds):
+        cpu = nestest_cpu(nes)
+        cpu.interrupt('reset')
+        scheduler = ns.NesScheduler(cpu, jit=jit)
+        begin = time.perf_counter()
+        for _ in range(frames):
+            scheduler.run_frame()
+        used = time.perf_counter() - begin
+        if best is None or used < best:
+            best = used
+    return frames / best
+
+
+# 寻址模式 => 放在 $0200 的操作数字节，地址和间接寻址的指针都落在 RAM 里
+address_mode_operands = {
+    'IMM': [0x12],
+    'ZPG': [0x12],
+    'ZPX': [0x12],
+    'ABS': [0x34, 0x12],
+    'ABX': [0xf0, 0x12],
+    'ABY': [0xf0, 0x12],
+    'IND': [0x34, 0x12],
+    'INX': [0x12],
+    'INY': [0x12],
+    'REL': [0xf0],
+}
+
+
+def address_mode_costs(calls: int):
+    """
+    每种寻址模式解码一次操作数的用时（秒）和临时对象占用的峰值内存（字节，由 tracemalloc 测量）
+    大于 256 的整数都是新对象，每个 32 字节，IMM 的 64 字节就是 PC 前进时新建的整数
+    """
+    cpu = nc.NesCPU()
+    cpu.x = cpu.y = 0x20
+    # 间接寻址的指针指向 $1234
+    cpu.ram[0x12:0x14] = cpu.ram[0x32:0x34] = bytes([0x34, 0x12])
+    costs = {}
+    for mode, operand in address_mode_operands.items():
+        cpu.ram[0x200:0x200 + len(operand)] = bytes(operand)
+        decode = cpu.address_modes[mode]
+        begin = time.perf_counter()
+        for _ in range(calls):
+            cpu.pc = 0x200
+            decode()
+        used = (time.perf_counter() - begin) / calls
+
+        tracemalloc.start()
+        peak = 0
+        for _ in range(100):
+            cpu.pc = 0x200
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            decode()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+        costs[mode] = (used, peak)
+    return costs
+
+
+def rewind_overhead(nes: nf.NesFile, frames: int):
+    # 倒带每帧保存快照的用时占运行一帧用时的比例
+    cpu = nestest_cpu(nes)
+    cpu.interrupt('reset')
+    scheduler = ns.NesScheduler(cpu)
+    rewind = nr.RewindBuffer(scheduler)
+    running = 0
+    capturing = 0
+    for _ in range(frames):
+        begin = time.perf_counter()
+        scheduler.run_frame()
+        middle = time.perf_counter()
+        rewind.capture()
+        end = time.perf_counter()
+        running += middle - begin
+        capturing += end - middle
+    return capturing / running
+
+
+def opcode_costs(nes: nf.NesFile, calls: int, rounds: int):
+    """
+    每个操作码在 $0200 重复执行一次的最短平均用时（秒），包括已解码指令的查找和循环本身的开销
+    没有实现的操作码（执行时抛出 ValueError）不测
+    """
+    cpu = nestest_cpu(nes)
+    costs = {}
+    for c in range(0x100):
+        # 前面的操作码可能改写了指针和寄存器，每个操作码都从同样的状态开始，避免写到 $0200 的代码上
+        cpu.a, cpu.x, cpu.y, cpu.s = 0, 0x20, 0x20, 0xfd
+        cpu.set_reg_value('p', 0x24)
+        cpu.ram[0x12:0x14] = cpu.ram[0x32:0x34] = bytes([0x34, 0x12])
+        _, mode = cpu.dispatch[c][:2]
+        cpu.ram[0x200] = c
+        operand = address_mode_operands.get(mode, [])
+        cpu.ram[0x201:0x201 + len(operand)] = bytes(operand)
+        cpu.invalidate_pages(2)
+        try:
+            cpu.pc = 0x200
+            cpu.execute()
+        except ValueError:
+            continue
+        best = None
+        for _ in range(rounds):
+            begin = time.perf_counter()
+            for _ in range(calls):
+                cpu.pc = 0x200
+                cpu.execute()
+            used = (time.perf_counter() - begin) / calls
+            if best is None or used < best:
+                best = used
+        costs[c] = best
+    return costs
+
+
+def ppu_frames_per_second(nes: nf.NesFile, frames: int):
+    """
+    只让 PPU 前进一帧的点数并把画面画到和窗口一样大的 Surface 上，测量逐行渲染背景和精灵加上 draw 的帧率
+    先运行几帧让 nestest 打开渲染，计时的时候 CPU 不执行指令
+    """
+    cpu = nestest_cpu(nes)
+    cpu.interrupt('reset')
+    scheduler = ns.NesScheduler(cpu)
+    for _ in range(4):
+        scheduler.run_frame()
+    ppu = cpu.ppu
+    canvas = pygame.Surface((256, 240))
+    begin = time.perf_counter()
+    for _ in range(frames):
+        ppu.step(341 * 262)
+        ppu.draw(canvas)
+    return frames / (time.perf_counter() - begin)
+
+
+def rom_load_seconds(path: str, rounds: int):
+    best = None
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        nf.NesFile.load(path)
+        used = time.perf_counter() - begin
+        if best is None or used < best:
+            best = used
+    return best
+
+
+def trace_diff_per_second(golden_path: str, rounds: int):
+    # 用标准日志本身作为执行结果，测量逐条比较的速度
+    infos = [ld.info_from_golden_record(r) for r in ld.GoldenLogDiffer.from_golden(golden_path).records()]
+    best = None
+    for _ in range(rounds):
+        differ = ld.GoldenLogDiffer.from_golden(golden_path)
+        begin = time.perf_counter()
+        for info in infos:
+            differ.diff(info)
+        used = time.perf_counter() - begin
+        if best is None or used < best:
+            best = used
+    return len(infos) / best
+
+
+# 这些单位的指标越小越好，其他的越大越好
+lower_is_better = ('ns', 'us')
+
+
+def suite(nes: nf.NesFile, rounds: int):
+    """
+    运行整套基准测试，返回 (名字 => (值, 单位), 操作码 => 用时 ns)
+    单个操作码的用时抖动太大，只记录在历史里，和基线比较的是所有操作码用时的几何平均
+    """
+    results = {}
+    results['nestest by table'] = (instructions_per_second(nes, run_by_table, rounds), 'instructions/s')
+    results['nestest scheduler'] = (instructions_per_second(nes, run_by_scheduler, rounds), 'instructions/s')
+    results['ppu frame'] = (ppu_frames_per_second(nes, 20 * rounds), 'frames/s')
+    results['rom load'] = (rom_load_seconds('misc/nestest.nes', rounds) * 1e6, 'us')
+    results['trace diff'] = (trace_diff_per_second('misc/nestest_log.bin', max(rounds // 5, 1)), 'records/s')
+
+    cpu = nc.NesCPU()
+    opcodes = {}
+    for c, used in opcode_costs(nes, 1000, rounds).items():
+        op, mode = cpu.dispatch[c][:2]
+        opcodes['{:02X} {} {}'.format(c, op, mode)] = used * 1e9
+    mean = math.exp(sum(math.log(used) for used in opcodes.values()) / len(opcodes))
+    results['opcode geomean'] = (mean, 'ns')
+    return results, opcodes
+
+
+def regressions(baseline: Dict, results: Dict, threshold: float) -> List[Tuple[str, float, float, float]]:
+    """
+    返回比基线差了超过 threshold（比例）的指标：(名字, 基线, 结果, 变差的比例)
+    基线里没有的指标不比较
+    """
+    found = []
+    for name, (value, unit) in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name][0]
+        if unit in lower_is_better:
+            change = value / base - 1
+        else:
+            change = base / value - 1
+        if change > threshold:
+            found.append((name, base, value, change))
+    return found
+
+
+def append_history(path: str, results: Dict, opcodes: Dict):
+    # 历史文件是一个 JSON 数组，每次运行追加一项
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    history.append(dict(
+        time=datetime.datetime.now().isoformat(timespec='seconds'),
+        results=results,
+        opcodes=opcodes,
+    ))
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1)
+
+
+def run_suite(args):
+    """
+    返回退出码：0 没有退化，1 有指标退化，2 没有基线
+    基线和机器有关，不随代码提交，第一次运行时用 --save-baseline 保存
+    """
+    nes = nf.NesFile.load('misc/nestest.nes')
+    results, opcodes = suite(nes, args.rounds)
+    for name, (value, unit) in results.items():
+        print('{:<24} {:>14,.1f} {}'.format(name, value, unit))
+    append_history(args.history, results, opcodes)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('没有基线 <{}>，用 --save-baseline 保存'.format(args.baseline))
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(baseline, results, args.threshold)
+    for name, base, value, change in found:
+        print('regression {:<24} {:>14,.1f} => {:>14,.1f} ({:+.1%})'.format(name, base, value, change))
+    return 1 if found else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='性能测试，--suite 时和基线比较，变差超过阈值时返回 1，没有基线时返回 2')
+    parser.add_argument('--suite', action='store_true', help='运行整套基准测试，结果追加到历史文件')
+    parser.add_argument('--rounds', type=int, default=5, help='每项测试运行几轮，取最好的一轮')
+    parser.add_argument('--history', default='benchmark_history.json', help='历史文件路径')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='基线文件路径')
+    parser.add_argument('--save-baseline', action='store_true', help='把这次的结果保存为基线')
+    parser.add_argument('--threshold', type=float, default=0.25, help='比基线变差多少（比例）算退化')
+    args = parser.parse_args(argv)
+
+    config.DEBUG = False
+    if args.suite:
+        return run_suite(args)
+
+    nes = nf.NesFile.load('misc/nestest.nes')
+    rounds = 10
+
+    benchmarks = [
+        ('by table', run_by_table),
+        ('scheduler', run_by_scheduler),
+    ]
+    for name, runner in benchmarks:
+        ips = instructions_per_second(nes, runner, rounds)
+        print('nestest {:<10} {:>12,.0f} instructions/s'.format(name, ips))
+
+    # 和真机的 CPU 频率比较
+    mhz = emulated_mhz(nes, run_by_scheduler, rounds)
+    ratio = mhz * 1e6 / ns.cpu_frequency
+    print('nestest {:<10} {:>12.3f} MHz ({:.1%} of NTSC)'.format('scheduler', mhz, ratio))
+
+    for name, jit in [('frames', False), ('frames jit', True)]:
+        fps = frames_per_second(nes, jit, 60, 3)
+        print('nestest {:<10} {:>12.1f} frames/s'.format(name, fps))
+
+    used = state_round_trip_seconds(nes, rounds * 10)
+    print('nestest {:<10} {:>12.1f} us per save/load'.format('state', used * 1e6))
+
+    overhead = rewind_overhead(nes, 60)
+    print('nestest {:<10} {:>12.1%} per frame'.format('rewind', overhead))
+
+    for mode, (used, peak) in address_mode_costs(100000).items():
+        print('address {:<10} {:>12.0f} ns {:>6} bytes'.format(mode, used * 1e9, peak))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
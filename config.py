@@ -1 +1,3 @@
 DEBUG = True
+# DEBUG 时指令跟踪记录写入的文件，用 python nes_trace.py 转成文本
+TRACE_PATH = 'nes.trace'
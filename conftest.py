@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import config
+
+
+@pytest.fixture(autouse=True, scope='session')
+def trace_path(tmp_path_factory):
+    # 测试时 DEBUG 打开，指令跟踪写到临时目录，不在仓库里留下 nes.trace
+    old_path = config.TRACE_PATH
+    config.TRACE_PATH = os.path.join(str(tmp_path_factory.mktemp('trace')), 'nes.trace')
+    yield config.TRACE_PATH
+    config.TRACE_PATH = old_path
+
+
+@pytest.fixture(params=[True, False], ids=['log', 'decoded'])
+def debug(request):
+    # 两条路径都从已解码指令的缓存执行：DEBUG 时走 _execute_with_log，另外记录跟踪；否则走不记录跟踪的 execute
+    old = config.DEBUG
+    config.DEBUG = request.param
+    yield request.param
+    config.DEBUG = old
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import json
+import mmap
+import struct
+import sys
 
 
 class AllTestsPassed(Exception):
@@ -14,6 +17,37 @@ def logs_from_json(json_path):
     return logs
 
 
+# 二进制的标准日志：文件头之后是定长的记录，字段顺序和 JSON 日志相同
+# PC, op, address, A, X, Y, P, S，op 为 3 个 ASCII 字符，没有地址时 address 为 -1
+golden_magic = b'NESGOLD1'
+golden_struct = struct.Struct('<H3siBBBBB')
+golden_keys = ('PC', 'op', 'address', 'A', 'X', 'Y', 'P', 'S')
+
+
+def golden_record_from_info(info):
+    return golden_struct.pack(
+        info['PC'], info['op'].encode('ascii'), info['address'],
+        info['A'], info['X'], info['Y'], info['P'], info['S'],
+    )
+
+
+def info_from_golden_record(record: bytes):
+    values = list(golden_struct.unpack(record))
+    values[1] = values[1].decode('ascii')
+    return dict(zip(golden_keys, values))
+
+
+def golden_from_json(json_path, golden_path):
+    """
+    把 JSON 格式的标准日志转换成二进制格式，只需要转换一次
+    """
+    logs = logs_from_json(json_path)
+    with open(golden_path, 'wb') as f:
+        f.write(golden_magic)
+        for log in logs:
+            f.write(golden_record_from_info(log))
+
+
 def bytes_from_x8(x8_num: int):
     low = x8_num & 0x0F
     high = (x8_num & 0xF0) >> 4
@@ -92,3 +126,61 @@ class LogDiffer(object):
         logs = logs_from_json(json_path)
         ld = LogDiffer(logs)
         return ld
+
+
+class GoldenLogDiffer(LogDiffer):
+    """
+    逐条读取二进制标准日志的 LogDiffer
+    文件通过 mmap 映射，不需要预先解析，比较时直接比较打包后的字节
+    只有出现不一致的时候才解码记录、生成可读的差异
+    """
+
+    def __init__(self, golden_path):
+        super().__init__(None)
+        with open(golden_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(golden_magic)] != golden_magic:
+            raise ValueError('不是二进制的标准日志：<{}>'.format(golden_path))
+        self.count = (len(self.data) - len(golden_magic)) // golden_struct.size
+
+    def records(self):
+        # 按顺序逐条返回记录的字节
+        size = golden_struct.size
+        begin = len(golden_magic)
+        for i in range(self.count):
+            offset = begin + i * size
+            yield self.data[offset:offset + size]
+
+    def pop_record(self):
+        if self.cursor >= self.count:
+            raise AllTestsPassed
+        size = golden_struct.size
+        offset = len(golden_magic) + self.cursor * size
+        self.cursor += 1
+        return self.data[offset:offset + size]
+
+    def pop_log(self):
+        return info_from_golden_record(self.pop_record())
+
+    def diff(self, info):
+        self.correct_op_name(info)
+        expected = self.pop_record()
+        result = golden_record_from_info(info)
+        if expected != result:
+            log = info_from_golden_record(expected)
+            assert False, self.message_of_diff(log, info)
+
+    @staticmethod
+    def from_golden(golden_path):
+        return GoldenLogDiffer(golden_path)
+
+
+def main(argv=None):
+    # 用法：python log_differ.py misc/nestest_log.json misc/nestest_log.bin
+    args = sys.argv[1:] if argv is None else argv
+    json_path, golden_path = args
+    golden_from_json(json_path, golden_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# 按键 => 位，也是移位寄存器读出的顺序：A、B、Select、Start、上、下、左、右
+buttons = {
+    'A': 0b00000001,
+    'B': 0b00000010,
+    'SELECT': 0b00000100,
+    'START': 0b00001000,
+    'UP': 0b00010000,
+    'DOWN': 0b00100000,
+    'LEFT': 0b01000000,
+    'RIGHT': 0b10000000,
+}
+
+
+class NesController(object):
+    """
+    标准手柄，$4016 写入第 0 位作为 strobe，$4016/$4017 每次读出一个按键
+    strobe 为 1 时一直重新装载按键状态，读到的总是 A；变为 0 后每读一次移出一位
+    """
+
+    def __init__(self):
+        # 当前按下的按键，由前端或录像在每帧开始前设置
+        self.buttons = 0
+        self.strobe = 0
+        self.shift = 0
+
+    def set_buttons(self, value: int):
+        self.buttons = value
+        if self.strobe:
+            self.shift = value
+
+    def write(self, value: int):
+        self.strobe = value & 1
+        if self.strobe:
+            self.shift = self.buttons
+
+    def read(self):
+        if self.strobe:
+            return 0x40 | (self.buttons & 1)
+        bit = self.shift & 1
+        # 8 个按键读完之后一直读到 1
+        self.shift = (self.shift >> 1) | 0x80
+        # 高位是数据总线上残留的值，一般是地址的高字节 $40
+        return 0x40 | bit
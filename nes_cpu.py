@@ -1,39 +1,116 @@
 # -*- coding: utf-8 -*-
+import struct
 from typing import (
-    Dict, List, Tuple, Optional
+    Dict, List, Tuple, Optional, Callable
 )
 
 import pygame
 import config
 import opcodes_table
-from utils import log, number_from_bytes
+from alu_table import (
+    adc_table, compare_table, asl_table, lsr_table, rol_table, ror_table, inc_table, dec_table
+)
 import nes_file as nf
-from log_differ import LogDiffer
+import nes_trace
 from nes_ppu import NesPPU
+from nes_controller import NesController
+from nes_mapper import NesMapper, mapper_from_nes
+
+
+# 寄存器名 => NesCPU 上的属性名
+register_attrs = {
+    'PC': 'pc',
+    'P': 'p',
+    'A': 'a',
+    'X': 'x',
+    'Y': 'y',
+    'S': 's',
+}
+
+
+# 存档的开头：魔数、版本、mapper 编号（没有卡带时为 $FFFF）、PC、P、A、X、Y、S、周期数
+# 之后依次是 CPU 的 RAM、两个手柄、PPU 的存档、mapper 的存档，格式改变时增加版本号
+state_magic = b'NESSTATE'
+state_version = 2
+state_struct = struct.Struct('<8sHHHBBBBBQ')
 
 
 class NesCPU(object):
+    # 寄存器直接作为整数属性保存，热路径上不再经过名字规范化和字典查找
+    __slots__ = (
+        'pc', 'status', 'n', 'z', 'c', 'v', 'a', 'x', 'y', 's', 'cycles',
+        'ram', 'prg_rom', 'opcodes', 'p_masks',
+        'read_pages', 'write_pages', 'read_handlers', 'write_handlers',
+        'address_modes', 'handlers', 'dispatch', 'ppu', 'mapper', 'controllers',
+        'operand_modes', 'decode_table', 'decoded', 'blocks', 'code_pages', 'protected_pages',
+    )
+
     def __init__(self):
-        self.registers: Dict[str, int] = None
-        self.ram: List[int] = None
-        self.prg_rom: List[int] = None
+        self.pc: int = 0
+        # P 里的 N/Z/C/V 分开保存，执行指令时只记下结果，读写 p 时才和其余的位合并、拆开
+        # n 的第 7 位是 N，z 为 0 表示 Z（通常 n 和 z 都是上一次的运算结果），c 是 0 或 1，v 是 0 或 0x40
+        # status 是 P 里其余的位
+        self.status: int = 0
+        self.n: int = 0
+        self.z: int = 1
+        self.c: int = 0
+        self.v: int = 0
+        self.a: int = 0
+        self.x: int = 0
+        self.y: int = 0
+        self.s: int = 0
+        # 上电以来经过的 CPU 周期数
+        self.cycles: int = 0
+        self.ram: bytearray = None
+        self.prg_rom: memoryview = None
+        # 每 256 字节一页，共 256 页
+        # 普通的 RAM/ROM 页直接对应一段 memoryview，其余的页为 None，交给对应的 handler 处理
+        self.read_pages: List[Optional[memoryview]] = None
+        self.write_pages: List[Optional[memoryview]] = None
+        self.read_handlers: List[Callable[[int], int]] = None
+        self.write_handlers: List[Callable[[int, int], None]] = None
         self.opcodes: Dict[int, Tuple[str, str]] = None
         self.p_masks: Dict[str, int] = None
+        # 寻址模式 => 解码函数
+        self.address_modes: Dict[str, Callable[[], Optional[int]]] = None
+        # 指令名 => 处理函数
+        self.handlers: Dict[str, Callable[[Optional[int], str], None]] = None
+        # opcode => (指令名, 寻址模式, 处理函数, 解码函数, 基本周期数)
+        self.dispatch: List[Tuple[str, str, Callable, Callable, int]] = None
+        # opcode => 用预先取出的操作数计算地址的函数，地址和寄存器无关的寻址模式为 None
+        self.operand_modes: List[Optional[Callable[[int], int]]] = None
+        # opcode => (处理函数, 寻址模式, 地址函数, 基本周期数, 操作数字节数, 是否为分支, 是否结束基本块)，解码时使用
+        self.decode_table: List[Tuple] = None
+        # 按 PC 缓存的已解码指令：(opcode, 处理函数, 寻址模式, 地址函数, 操作数, 下一条指令的 PC, 基本周期数)
+        # 操作数在地址函数为 None 时就是地址本身
+        # 没有执行过的 PC 为 None，只执行过一次的为 False，第二次执行时才解码，只执行一次的代码不必付出解码的开销
+        self.decoded: List[Optional[Tuple]] = None
+        # 基本块的起始 PC => 块里所有指令的 PC
+        self.blocks: Dict[int, List[int]] = None
+        # 页 => 覆盖这一页的基本块的起始 PC
+        self.code_pages: Dict[int, List[int]] = None
+        # 有已解码代码的 RAM 页，写入时需要先丢弃缓存，页 => 原来的写入页
+        self.protected_pages: Dict[int, memoryview] = None
         self.ppu = NesPPU()
+        self.ppu.nmi_callback = self._nmi
+        # 加载 ROM 后由 mapper 接管 $6000-$FFFF
+        self.mapper: NesMapper = None
+        # $4016、$4017 上的两个手柄
+        self.controllers: List[NesController] = None
 
         self.setup()
 
     def setup(self):
         # at power-up
-        self.registers = {
-            'PC': 0,
-            'P': 0x34,
-            'A': 0,
-            'X': 0,
-            'Y': 0,
-            'S': 0xfd,
-        }
-        self.ram = [0] * 0x2000
+        self.pc = 0
+        self.p = 0x34
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.s = 0xfd
+        self.cycles = 0
+        self.ram = bytearray(0x800)
+        self.controllers = [NesController(), NesController()]
         self.opcodes = opcodes_table.opcodes
         self.p_masks = {
             'N': 0b10000000,
@@ -44,19 +121,191 @@ class NesCPU(object):
             'Z': 0b00000010,
             'C': 0b00000001,
         }
+        self.address_modes = {
+            'IMP': self._address_imp,
+            'IMM': self._address_imm,
+            'ABS': self._address_abs,
+            'ZPG': self._address_zpg,
+            'ABX': self._address_abx,
+            'ABY': self._address_aby,
+            'ZPX': self._address_zpx,
+            'ZPY': self._address_zpy,
+            'IND': self._address_ind,
+            'INX': self._address_inx,
+            'INY': self._address_iny,
+            'REL': self._address_rel,
+        }
+        self.handlers = self._handlers_from_methods()
+        self.dispatch = self._dispatch_from_opcodes()
+        self.operand_modes = self._operand_modes_from_opcodes()
+        self.decode_table = [
+            (handler, mode, self.operand_modes[c], cycles, opcodes_table.operand_sizes[mode], mode == 'REL',
+             op in opcodes_table.block_end_ops)
+            for c, (op, mode, handler, _, cycles) in enumerate(self.dispatch)
+        ]
+        self.decoded = [None] * 0x10000
+        self.blocks = {}
+        self.code_pages = {}
+        self.protected_pages = {}
+        self._setup_pages()
+
+    def _setup_pages(self):
+        self.read_pages = [None] * 0x100
+        self.write_pages = [None] * 0x100
+        self.read_handlers = [self._read_unmapped] * 0x100
+        self.write_handlers = [self._write_unmapped] * 0x100
+
+        # $0000-$1FFF: 2KB 的 RAM，每 $800 镜像一次
+        ram = memoryview(self.ram)
+        for page in range(0x00, 0x20):
+            begin = (page & 0x07) << 8
+            view = ram[begin:begin + 0x100]
+            self.read_pages[page] = view
+            self.write_pages[page] = view
+        # $2000-$3FFF: PPU 寄存器，每 8 字节镜像一次
+        for page in range(0x20, 0x40):
+            self.read_handlers[page] = self._read_ppu_register
+            self.write_handlers[page] = self._write_ppu_register
+        # $4000-$5FFF: APU/IO 寄存器和扩展 ROM
+        for page in range(0x40, 0x60):
+            self.read_handlers[page] = self._read_io_register
+            self.write_handlers[page] = self._write_io_register
+
+    def _handlers_from_methods(self):
+        prefix = '_op_'
+        handlers = {}
+        for attr in dir(type(self)):
+            if attr.startswith(prefix):
+                op = attr[len(prefix):].upper()
+                handlers[op] = getattr(self, attr)
+        return handlers
+
+    def _dispatch_from_opcodes(self):
+        # 按 opcode 字节预先绑定好处理函数和解码函数，执行时只需一次下标访问
+        # 跨页时需要多算 1 个周期的指令使用单独的解码函数，其余指令不必检查跨页
+        page_cross_address_modes = {
+            'ABX': self._address_abx_page_cross,
+            'ABY': self._address_aby_page_cross,
+            'INY': self._address_iny_page_cross,
+        }
+        dispatch = []
+        for c in range(0x100):
+            op, mode = self.opcodes[c]
+            handler = self.handlers.get(op)
+            if handler is None:
+                handler = self._unknown_handler(op)
+            if op in opcodes_table.page_cross_ops and mode in opcodes_table.page_cross_modes:
+                address = page_cross_address_modes[mode]
+            else:
+                address = self.address_modes[mode]
+            dispatch.append((op, mode, handler, address, opcodes_table.cycles[c]))
+        return dispatch
+
+    def _operand_modes_from_opcodes(self):
+        operand_modes = {
+            'ABX': self._operand_abx,
+            'ABY': self._operand_aby,
+            'ZPX': self._operand_zpx,
+            'ZPY': self._operand_zpy,
+            'IND': self._operand_ind,
+            'INX': self._operand_inx,
+            'INY': self._operand_iny,
+        }
+        page_cross_operand_modes = {
+            'ABX': self._operand_abx_page_cross,
+            'ABY': self._operand_aby_page_cross,
+            'INY': self._operand_iny_page_cross,
+        }
+        modes = []
+        for c in range(0x100):
+            op, mode = self.opcodes[c]
+            if op in opcodes_table.page_cross_ops and mode in opcodes_table.page_cross_modes:
+                modes.append(page_cross_operand_modes[mode])
+            else:
+                modes.append(operand_modes.get(mode))
+        return modes
+
+    @staticmethod
+    def _unknown_handler(op: str):
+        def handler(addr: Optional[int], mode: str):
+            raise ValueError('错误的 op： <{}>'.format(op))
+        return handler
 
     def load_nes(self, nes: nf.NesFile):
         self.prg_rom = nes.prg_rom
+        self.invalidate_pages(0, 0x100)
         self.ppu.load_nes(nes)
+        self.mapper = mapper_from_nes(nes)
+        self.mapper.attach(self)
+
+    def save_state(self):
+        """
+        把 CPU、PPU 和 mapper 的状态保存成一个字节串
+        """
+        mapper = 0xffff if self.mapper is None else self.mapper.number
+        head = state_struct.pack(state_magic, state_version, mapper,
+                                 self.pc, self.p, self.a, self.x, self.y, self.s, self.cycles)
+        controllers = bytes(v for c in self.controllers for v in (c.buttons, c.strobe, c.shift))
+        parts = [head, self.ram, controllers, self.ppu.save_state()]
+        if self.mapper is not None:
+            parts.append(self.mapper.save_state())
+        return b''.join(parts)
+
+    def load_state(self, data: bytes):
+        """
+        从 save_state 的结果恢复，需要先加载同一个 ROM
+        """
+        data = memoryview(data)
+        magic, version, mapper, *registers, cycles = state_struct.unpack_from(data)
+        if magic != state_magic:
+            raise ValueError('错误的存档')
+        if version != state_version:
+            raise ValueError('不支持的存档版本：<{}>'.format(version))
+        current = 0xffff if self.mapper is None else self.mapper.number
+        if mapper != current:
+            raise ValueError('存档的 mapper <{}> 和当前的 mapper <{}> 不一致'.format(mapper, current))
+
+        self.pc, self.p, self.a, self.x, self.y, self.s = registers
+        self.cycles = cycles
+        # RAM 和 bank 都可能变了，已解码的指令全部作废
+        self.invalidate_pages(0, 0x100)
+        size = state_struct.size
+        self.ram[:] = data[size:size + len(self.ram)]
+        size += len(self.ram)
+        for c in self.controllers:
+            c.buttons, c.strobe, c.shift = data[size:size + 3]
+            size += 3
+        size += self.ppu.load_state(data[size:])
+        if self.mapper is not None:
+            size += self.mapper.load_state(data[size:])
+        if size != len(data):
+            raise ValueError('存档的长度 <{}> 和当前的卡带不一致'.format(len(data)))
+
+    @property
+    def registers(self):
+        # 兼容旧的字典形式，只用于调试输出
+        return {n: getattr(self, attr) for n, attr in register_attrs.items()}
+
+    @property
+    def p(self):
+        return self.status | (self.n & 0b10000000) | (0 if self.z else 0b00000010) | self.c | self.v
+
+    @p.setter
+    def p(self, value: int):
+        self.status = value & 0b00111100
+        self.n = value & 0b10000000
+        self.z = 0 if value & 0b00000010 else 1
+        self.c = value & 0b00000001
+        self.v = value & 0b01000000
 
     def reg_value(self, name: str):
         n = name.upper()
-        return self.registers[n]
+        return getattr(self, register_attrs[n])
 
     def set_reg_value(self, name: str, value: int):
         n = name.upper()
 
-        if n not in self.registers:
+        if n not in register_attrs:
             raise ValueError('未知的寄存器：<{}>'.format(n))
         if n == 'PC':
             if value < 0 or value > 2 ** 16 - 1:
@@ -65,190 +314,381 @@ class NesCPU(object):
             if value < 0 or value > 2 ** 8 - 1:
                 raise ValueError('<{}>超过了<{}>寄存器的取值范围'.format(value, n))
 
-        self.registers[n] = value
+        setattr(self, register_attrs[n], value)
 
     def mem_value(self, addr: int):
-        if 0 <= addr <= 0x1fff:
-            return self.ram[addr]
-        elif 0x2000 <= addr <= 0x2007:
-            return self.ppu.reg_value_for_cpu(addr)
-        elif 0x2008 <= addr <= 0x3fff:
-            # 主动忽略
-            return 0
-        elif 0x4000 <= addr <= 0x4013:
-            # 主动忽略
-            return 0
-        elif addr == 0x4014:
+        page = self.read_pages[addr >> 8]
+        if page is None:
+            return self.read_handlers[addr >> 8](addr)
+        return page[addr & 0xff]
+
+    def set_mem_value(self, addr: int, value: int):
+        # 超出字节范围的值由 memoryview 抛出 ValueError
+        page = self.write_pages[addr >> 8]
+        if page is None:
+            self.write_handlers[addr >> 8](addr, value)
+        else:
+            page[addr & 0xff] = value
+
+    def _read_ppu_register(self, addr: int):
+        return self.ppu.reg_value_for_cpu(0x2000 | (addr & 0x0007))
+
+    def _write_ppu_register(self, addr: int, value: int):
+        self.ppu.set_reg_value_for_cpu(0x2000 | (addr & 0x0007), value)
+
+    def _read_io_register(self, addr: int):
+        if addr == 0x4014:
             return self.ppu.reg_value_for_cpu(addr)
-        elif 0x4015 <= addr <= 0x5fff:
+        elif addr == 0x4016 or addr == 0x4017:
+            return self.controllers[addr - 0x4016].read()
+        else:
             # 主动忽略
             return 0
-        elif 0x8000 <= addr <= 0xbfff:
-            addr -= 0x8000
-            return self.prg_rom[addr]
-        elif 0xc000 <= addr <= 0xffff:
-            addr -= 0xc000
-            return self.prg_rom[addr]
-        else:
-            raise ValueError('错误的读地址：<{}>'.format(addr))
 
-    def set_mem_value(self, addr: int, value: int):
-        # log('set_mem_value: ', hex(addr), hex(value))
+    def _write_io_register(self, addr: int, value: int):
         if value < 0 or value > 2 ** 8 - 1:
             raise ValueError('<{}>超过了字节的取值范围'.format(value))
 
-        if 0 <= addr <= 0x1fff:
-            self.ram[addr] = value
-        elif 0x2000 <= addr <= 0x2007:
-            self.ppu.set_reg_value_for_cpu(addr, value)
-        elif 0x2008 <= addr <= 0x3fff:
-            # 主动忽略
-            pass
-        elif 0x4000 <= addr <= 0x4013:
-            # 主动忽略
-            pass
-        elif addr == 0x4014:
+        if addr == 0x4014:
             self.ppu.set_reg_value_for_cpu(addr, value)
-        elif 0x4015 <= addr <= 0x5fff:
+            self._oam_dma(value)
+        elif addr == 0x4016:
+            # 两个手柄共用 strobe
+            for c in self.controllers:
+                c.write(value)
+        else:
             # 主动忽略
             pass
-        else:
-            raise ValueError('错误的写地址：<{}>'.format(addr))
+
+    def _oam_dma(self, page: int):
+        # 直接复制整页，普通的 RAM/ROM 页只需要一次切片
+        view = self.read_pages[page]
+        if view is None:
+            begin = page << 8
+            view = bytes(self.mem_value(addr) for addr in range(begin, begin + 0x100))
+        self.ppu.write_oam_dma(view)
+        # DMA 期间 CPU 暂停 513 个周期，从奇数周期开始时再多等 1 个周期
+        self.cycles += 513 + (self.cycles & 1)
+
+    def _read_unmapped(self, addr: int):
+        raise ValueError('错误的读地址：<{}>'.format(addr))
+
+    def _write_unmapped(self, addr: int, value: int):
+        raise ValueError('错误的写地址：<{}>'.format(addr))
+
+    @staticmethod
+    def _page_aliases(page: int):
+        # $0000-$1FFF 的 RAM 每 $800 镜像一次，写任何一个镜像都会改到同一段代码
+        if page < 0x20:
+            return range(page & 0x07, 0x20, 0x08)
+        return page,
+
+    def _decode_block(self, pc: int):
+        """
+        从 pc 开始解码一个基本块，直到改变执行流程的指令或者已经解码过的指令为止
+        返回第一条指令，pc 所在的页不是 RAM/ROM 时返回 None
+        """
+        decoded = self.decoded
+        read_pages = self.read_pages
+        decode_table = self.decode_table
+        start = pc
+        pcs = []
+        page = pc >> 8
+        view = read_pages[page]
+        pages = [page]
+        while view is not None and not decoded[pc]:
+            offset = pc & 0xff
+            c = view[offset]
+            handler, mode, operand_mode, cycles, size, relative, block_end = decode_table[c]
+            next_pc = pc + 1 + size
+            if size == 0:
+                operand = None
+            elif offset + size < 0x100:
+                operand = view[offset + 1]
+                if size == 2:
+                    operand |= view[offset + 2] << 8
+            else:
+                # 操作数跨页，下一页也必须是 RAM/ROM
+                if next_pc > 0x10000 or read_pages[page + 1] is None:
+                    break
+                pages.append(page + 1)
+                operand = 0
+                for i, a in enumerate(range(pc + 1, next_pc)):
+                    operand |= read_pages[a >> 8][a & 0xff] << (8 * i)
+            if relative:
+                # 分支的目标地址和寄存器无关，直接算好
+                operand = (next_pc + (operand ^ 0x80) - 0x80) & 0xffff
+            decoded[pc] = (c, handler, mode, operand_mode, operand, next_pc, cycles)
+            pcs.append(pc)
+            if block_end or next_pc > 0xffff or len(pcs) == 0x100:
+                break
+            pc = next_pc
+            if pc >> 8 != page:
+                page = pc >> 8
+                view = read_pages[page]
+                pages.append(page)
+
+        if not pcs:
+            return None
+        self.blocks[start] = pcs
+        for page in set(pages):
+            view = read_pages[page]
+            if view is None:
+                continue
+            if view.readonly:
+                self.code_pages.setdefault(page, []).append(start)
+                continue
+            # RAM 里的代码：写入这一页（包括镜像）时丢弃缓存
+            for alias in self._page_aliases(page):
+                self.code_pages.setdefault(alias, []).append(start)
+                view = self.write_pages[alias]
+                if view is not None:
+                    self.protected_pages[alias] = view
+                    self.write_pages[alias] = None
+                    self.write_handlers[alias] = self._write_code_page
+        return decoded[start]
+
+    def invalidate_pages(self, first: int, count=1):
+        """
+        丢弃覆盖 first 开始 count 页的已解码指令，改写了代码或者切换了 bank 之后调用
+        """
+        decoded = self.decoded
+        for page in range(first, first + count):
+            starts = self.code_pages.pop(page, None)
+            if starts is not None:
+                for start in starts:
+                    for pc in self.blocks.pop(start, ()):
+                        decoded[pc] = None
+            view = self.protected_pages.pop(page, None)
+            if view is not None:
+                self.write_pages[page] = view
+
+    def _write_code_page(self, addr: int, value: int):
+        page = addr >> 8
+        for alias in self._page_aliases(page):
+            self.invalidate_pages(alias)
+        self.write_pages[page][addr & 0xff] = value
 
     def next_mem_value(self):
-        pc = self.reg_value('pc')
-        v = self.mem_value(pc)
-        self.set_reg_value('pc', pc + 1)
+        pc = self.pc
+        page = self.read_pages[pc >> 8]
+        if page is None:
+            v = self.read_handlers[pc >> 8](pc)
+        else:
+            v = page[pc & 0xff]
+        self.pc = (pc + 1) & 0xffff
         return v
 
     def address(self, mode: str):
-        if mode == 'IMP':
-            return None
-        elif mode == 'IMM':
-            a = self.next_mem_value()
-            return a
-        elif mode == 'ABS':
-            al = self.next_mem_value()
-            ah = self.next_mem_value()
-            a = number_from_bytes([al, ah])
-            return a
-        elif mode == 'ZPG':
-            a = self.next_mem_value()
-            return a
-        elif mode == 'ABX':
-            al = self.next_mem_value()
-            ah = self.next_mem_value()
-            a = number_from_bytes([al, ah])
-            i = self.reg_value('x')
-            return (a + i) % 0x10000
-        elif mode == 'ABY':
-            al = self.next_mem_value()
-            ah = self.next_mem_value()
-            a = number_from_bytes([al, ah])
-            i = self.reg_value('y')
-            return (a + i) % 0x10000
-        elif mode == 'ZPX':
-            a = self.next_mem_value()
-            i = self.reg_value('x')
-            return (a + i) % 0x100
-        elif mode == 'ZPY':
-            a = self.next_mem_value()
-            i = self.reg_value('y')
-            return (a + i) % 0x100
-        elif mode == 'IND':
-            tal = self.next_mem_value()
-            tah = self.next_mem_value()
-            ta = number_from_bytes([tal, tah])
-            # 模拟 6502 的 BUG
-            ta2 = (ta & 0xFF00) | ((ta + 1) & 0x00FF)
-
-            al = self.mem_value(ta)
-            ah = self.mem_value(ta2)
-            a = number_from_bytes([al, ah])
-
-            return a
-        elif mode == 'INX':
-            t = self.next_mem_value()
-            i = self.reg_value('x')
-            ta = (t + i) % 0x100
-            ta2 = (ta + 1) % 0x100
-
-            al = self.mem_value(ta)
-            ah = self.mem_value(ta2)
-            a = number_from_bytes([al, ah])
-
-            return a
-        elif mode == 'INY':
-            ta = self.next_mem_value()
-            ta2 = (ta + 1) % 0x100
-
-            al = self.mem_value(ta)
-            ah = self.mem_value(ta2)
-            a = number_from_bytes([al, ah])
-
-            i = self.reg_value('y')
-            return (a + i) % 0x10000
-        elif mode == 'REL':
-            diff = self.next_mem_value()
-            diff = number_from_bytes([diff], signed=True)
-            pc = self.reg_value('pc')
-            return (pc + diff) % 0x10000
-        else:
+        if mode not in self.address_modes:
             raise ValueError('错误的寻址模式：<{}>'.format(mode))
+        return self.address_modes[mode]()
+
+    def _address_imp(self):
+        return None
+
+    def _address_imm(self):
+        a = self.next_mem_value()
+        return a
+
+    def _address_abs(self):
+        # 两个字节在同一页时直接从页里读出，不必逐字节经过 next_mem_value
+        pc = self.pc
+        offset = pc & 0xff
+        page = self.read_pages[pc >> 8]
+        if page is None or offset == 0xff:
+            al = self.next_mem_value()
+            return al | (self.next_mem_value() << 8)
+        self.pc = (pc + 2) & 0xffff
+        return page[offset] | (page[offset + 1] << 8)
+
+    def _address_zpg(self):
+        a = self.next_mem_value()
+        return a
+
+    def _address_abx(self):
+        return (self._address_abs() + self.x) & 0xffff
+
+    def _address_aby(self):
+        return (self._address_abs() + self.y) & 0xffff
+
+    def _address_abx_page_cross(self):
+        a = self._address_abx()
+        # 加上 X 之后高字节改变了，说明跨页
+        if (a - self.x) & 0xff00 != a & 0xff00:
+            self.cycles += 1
+        return a
+
+    def _address_aby_page_cross(self):
+        a = self._address_aby()
+        if (a - self.y) & 0xff00 != a & 0xff00:
+            self.cycles += 1
+        return a
+
+    def _address_iny_page_cross(self):
+        a = self._address_iny()
+        if (a - self.y) & 0xff00 != a & 0xff00:
+            self.cycles += 1
+        return a
+
+    def _address_zpx(self):
+        a = self.next_mem_value()
+        return (a + self.x) & 0xff
+
+    def _address_zpy(self):
+        a = self.next_mem_value()
+        return (a + self.y) & 0xff
+
+    def _address_ind(self):
+        return self._operand_ind(self._address_abs())
+
+    def _address_inx(self):
+        return self._operand_inx(self.next_mem_value())
+
+    def _address_iny(self):
+        return self._operand_iny(self.next_mem_value())
+
+    def _address_rel(self):
+        # 操作数是有符号的偏移
+        diff = self.next_mem_value()
+        return (self.pc + (diff ^ 0x80) - 0x80) & 0xffff
+
+    # 以下的函数用预先取出的操作数计算地址，供已解码的指令使用
+    def _operand_abx(self, a: int):
+        return (a + self.x) & 0xffff
+
+    def _operand_aby(self, a: int):
+        return (a + self.y) & 0xffff
+
+    def _operand_abx_page_cross(self, a: int):
+        r = (a + self.x) & 0xffff
+        if (a ^ r) & 0xff00:
+            self.cycles += 1
+        return r
+
+    def _operand_aby_page_cross(self, a: int):
+        r = (a + self.y) & 0xffff
+        if (a ^ r) & 0xff00:
+            self.cycles += 1
+        return r
+
+    def _operand_zpx(self, a: int):
+        return (a + self.x) & 0xff
+
+    def _operand_zpy(self, a: int):
+        return (a + self.y) & 0xff
+
+    def _operand_ind(self, ta: int):
+        # 模拟 6502 的 BUG
+        ta2 = (ta & 0xFF00) | ((ta + 1) & 0x00FF)
+        return self.mem_value(ta) | (self.mem_value(ta2) << 8)
+
+    def _operand_inx(self, ta: int):
+        # 指针总是在零页，也就是 RAM 里
+        ram = self.ram
+        ta = (ta + self.x) & 0xff
+        return ram[ta] | (ram[(ta + 1) & 0xff] << 8)
+
+    def _operand_iny(self, ta: int):
+        ram = self.ram
+        a = ram[ta] | (ram[(ta + 1) & 0xff] << 8)
+        return (a + self.y) & 0xffff
+
+    def _operand_iny_page_cross(self, ta: int):
+        ram = self.ram
+        a = ram[ta] | (ram[(ta + 1) & 0xff] << 8)
+        r = (a + self.y) & 0xffff
+        if (a ^ r) & 0xff00:
+            self.cycles += 1
+        return r
 
     def flag(self, bit: str):
         b = bit.upper()
         m = self.p_masks[b]
-        p = self.reg_value('p')
-        f = p & m
-        return f != 0
+        return (self.p & m) != 0
 
     def set_flag(self, bit: str, switch_on: bool):
         b = bit.upper()
-        p = self.reg_value('p')
         m = self.p_masks[b]
         if switch_on:
-            p |= m
+            self.p |= m
         else:
-            p &= ~m
-        self.set_reg_value('p', p)
+            self.p &= ~m
+
+    def _set_p_from_stack(self, v: int):
+        # 从栈里弹出的值，外面不会作用到 P 的 B flag 上
+        self.p = (self.status & 0b00110000) | (v & 0b11001111)
 
     def push(self, value: int):
-        s = self.reg_value('s')
-        addr = s + 0x0100
-        self.set_mem_value(addr, value)
-        self.set_reg_value('s', s - 1)
+        # 栈固定在 RAM 的 $0100-$01FF
+        s = self.s
+        self.ram[s + 0x0100] = value
+        self.s = (s - 1) & 0xff
 
     def pop(self):
-        s = self.reg_value('s')
-        s += 1
-        addr = s + 0x0100
-        self.set_reg_value('s', s)
-        v = self.mem_value(addr)
-        return v
+        s = (self.s + 1) & 0xff
+        self.s = s
+        return self.ram[s + 0x0100]
 
     def draw(self, canvas: pygame.Surface):
         self.ppu.draw(canvas)
 
     def execute(self):
-        # for debug
-        info = {}
         if config.DEBUG:
-            info.update(self.registers)
+            self._execute_with_log()
+            return
 
-        op, addr, mode = self._prepare()
+        # 已经解码过的指令直接取出操作数，不再逐字节读取和查表
+        pc = self.pc
+        entry = self.decoded[pc]
+        if not entry:
+            if entry is None:
+                self.decoded[pc] = False
+            else:
+                entry = self._decode_block(pc)
+        if not entry:
+            c = self.next_mem_value()
+            _, mode, handler, address, cycles = self.dispatch[c]
+            self.cycles += cycles
+            handler(address(), mode)
+            return
 
-        if config.DEBUG:
-            info['op'] = op
-            info['address'] = addr if addr is not None else -1
-            log(LogDiffer.log_line_from_info(info))
+        _, handler, mode, operand_mode, operand, self.pc, cycles = entry
+        self.cycles += cycles
+        if operand_mode is None:
+            handler(operand, mode)
+        else:
+            handler(operand_mode(operand), mode)
 
-        self._execute(op, addr, mode)
+    def _execute_with_log(self):
+        # 只记录二进制的跟踪数据，由后台线程写入文件，需要文本时再用 nes_trace 转换
+        pc = self.pc
+        a, x, y, s, p = self.a, self.x, self.y, self.s, self.p
+        entry = self.decoded[pc]
+        if not entry:
+            if entry is None:
+                self.decoded[pc] = False
+            else:
+                entry = self._decode_block(pc)
+        if not entry:
+            c = self.next_mem_value()
+            _, mode, handler, address, cycles = self.dispatch[c]
+            self.cycles += cycles
+            addr = address()
+        else:
+            c, handler, mode, operand_mode, addr, self.pc, cycles = entry
+            self.cycles += cycles
+            if operand_mode is not None:
+                addr = operand_mode(addr)
+        nes_trace.tracer().record(pc, c, addr if addr is not None else -1, a, x, y, s, p)
+
+        handler(addr, mode)
 
     def _prepare(self):
         c = self.next_mem_value()
-        op, mode = self.opcodes[c]
-        addr = self.address(mode)
+        op, mode, _, address, cycles = self.dispatch[c]
+        self.cycles += cycles
+        addr = address()
         return op, addr, mode
 
     def _value_from_address(self, addr: Optional[int], mode: str):
@@ -259,406 +699,340 @@ class NesCPU(object):
             return self.mem_value(addr)
 
     def _execute(self, op: str, addr: Optional[int], mode: str):
-        if op == 'JMP':
-            self.set_reg_value('pc', addr)
-        elif op == 'LDX':
-            v = self._value_from_address(addr, mode)
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'STX':
-            v = self.reg_value('x')
-            self.set_mem_value(addr, v)
-        elif op == 'JSR':
-            pc = self.reg_value('pc')
-            v = pc - 1
-            self.push((v & 0xff00) >> 8)
-            self.push(v & 0x00ff)
-            self.set_reg_value('pc', addr)
-        elif op == 'NOP':
-            # do nothing
-            pass
-        elif op == 'SEC':
-            self.set_flag('c', True)
-        elif op == 'BCS':
-            f = self.flag('c')
-            if f:
-                self.set_reg_value('pc', addr)
-        elif op == 'CLC':
-            self.set_flag('c', False)
-        elif op == 'BCC':
-            f = self.flag('c')
-            if not f:
-                self.set_reg_value('pc', addr)
-        elif op == 'LDA':
-            v = self._value_from_address(addr, mode)
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'BEQ':
-            f = self.flag('z')
-            if f:
-                self.set_reg_value('pc', addr)
-        elif op == 'BNE':
-            f = self.flag('z')
-            if not f:
-                self.set_reg_value('pc', addr)
-        elif op == 'STA':
-            v = self.reg_value('a')
-            self.set_mem_value(addr, v)
-        elif op == 'BIT':
-            v = self._value_from_address(addr, mode)
-            a = self.reg_value('a')
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('v', v & 0b01000000 != 0)
-            self.set_flag('z', v & a == 0)
-        elif op == 'BVS':
-            f = self.flag('v')
-            if f:
-                self.set_reg_value('pc', addr)
-        elif op == 'BVC':
-            f = self.flag('v')
-            if not f:
-                self.set_reg_value('pc', addr)
-        elif op == 'BPL':
-            f = self.flag('n')
-            if not f:
-                self.set_reg_value('pc', addr)
-        elif op == 'RTS':
-            vl = self.pop()
-            vh = self.pop()
-            v = number_from_bytes([vl, vh])
-            pc = v + 1
-            self.set_reg_value('pc', pc)
-        elif op == 'SEI':
-            self.set_flag('i', True)
-        elif op == 'SED':
-            self.set_flag('d', True)
-        elif op == 'PHP':
-            # 在这条指令中，只有「被压入栈」的 P 的 B flag 被置为 True
-            bv = self.reg_value('p')
-
-            self.set_flag('b', True)
-            v = self.reg_value('p')
-            self.push(v)
-
-            self.set_reg_value('p', bv)
-        elif op == 'PLA':
-            v = self.pop()
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'AND':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('a')
-            v = r & v
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'CMP':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('a')
-            v = r - v
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', v >= 0)
-        elif op == 'CLD':
-            self.set_flag('d', False)
-        elif op == 'PHA':
-            v = self.reg_value('a')
-            self.push(v)
-        elif op == 'PLP':
-            v = self.pop()
-            # 从栈里弹出的值，外面不会作用到 P 的 B flag 上
-            for b in 'NVDIZC':
-                m = self.p_masks[b]
-                f = v & m != 0
-                self.set_flag(b, f)
-        elif op == 'BMI':
-            f = self.flag('n')
-            if f:
-                self.set_reg_value('pc', addr)
-        elif op == 'ORA':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('a')
-            v = r | v
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'CLV':
-            self.set_flag('v', False)
-        elif op == 'EOR':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('a')
-            v = r ^ v
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'ADC':
-            mvalue = self._value_from_address(addr, mode)
-            v = mvalue
-            r = self.reg_value('a')
-            c = int(self.flag('c'))
-            v = r + v + c
-            # C flag: set if overflow
-            if v > 255:
-                v -= 256
-                self.set_flag('c', True)
-            else:
-                self.set_flag('c', False)
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            # 处理 v flag
-            v = number_from_bytes([mvalue], signed=True)
-            r = number_from_bytes([r], signed=True)
-            v = r + v + c
-            self.set_flag('v', v > 128 or v < -127)
-        elif op == 'LDY':
-            v = self._value_from_address(addr, mode)
-            self.set_reg_value('y', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'CPY':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('y')
-            v = r - v
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', v >= 0)
-        elif op == 'CPX':
-            v = self._value_from_address(addr, mode)
-            r = self.reg_value('x')
-            v = r - v
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', v >= 0)
-        elif op == 'SBC':
-            mvalue = self._value_from_address(addr, mode)
-            v = mvalue
-            r = self.reg_value('a')
-            c = int(self.flag('c'))
-            v = r - v - (1 - c)
-            # C flag: clear if overflow
-            if v < 0:
-                v += 256
-                self.set_flag('c', False)
-            else:
-                self.set_flag('c', True)
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            # 处理 v flag
-            v = number_from_bytes([mvalue], signed=True)
-            r = number_from_bytes([r], signed=True)
-            v = r - v - (1 - c)
-            self.set_flag('v', v > 128 or v < -127)
-        elif op == 'INY':
-            v = self.reg_value('y')
-            v += 1
-            v %= 256
-            self.set_reg_value('y', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'INX':
-            v = self.reg_value('x')
-            v += 1
-            v %= 256
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'DEY':
-            v = self.reg_value('y')
-            v -= 1
-            v %= 256
-            self.set_reg_value('y', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'DEX':
-            v = self.reg_value('x')
-            v -= 1
-            v %= 256
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TAY':
-            v = self.reg_value('a')
-            self.set_reg_value('y', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TAX':
-            v = self.reg_value('a')
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TYA':
-            v = self.reg_value('y')
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TXA':
-            v = self.reg_value('x')
-            self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TSX':
-            v = self.reg_value('s')
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'TXS':
-            v = self.reg_value('x')
-            self.set_reg_value('s', v)
-        elif op == 'RTI':
-            v = self.pop()
-            # 从栈里弹出的值，外面不会作用到 P 的 B flag 上
-            for b in 'NVDIZC':
-                m = self.p_masks[b]
-                f = v & m != 0
-                self.set_flag(b, f)
-            vl = self.pop()
-            vh = self.pop()
-            v = number_from_bytes([vl, vh])
-            # 这里不需要像 RTS 一样 +1
-            pc = v
-            self.set_reg_value('pc', pc)
-        elif op == 'LSR':
-            if addr is not None:
-                old_v = self._value_from_address(addr, mode)
-                v = old_v >> 1
-                self.set_mem_value(addr, v)
-            else:
-                old_v = self.reg_value('a')
-                v = old_v >> 1
-                self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', old_v & 0b00000001 != 0)
-        elif op == 'ASL':
-            if addr is not None:
-                old_v = self._value_from_address(addr, mode)
-                v = old_v << 1
-                v %= 256
-                self.set_mem_value(addr, v)
-            else:
-                old_v = self.reg_value('a')
-                v = old_v << 1
-                v %= 256
-                self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', old_v & 0b10000000 != 0)
-        elif op == 'ROR':
-            c = int(self.flag('c'))
-            if addr is not None:
-                old_v = self._value_from_address(addr, mode)
-                v = (old_v >> 1) + (c * 128)
-                self.set_mem_value(addr, v)
-            else:
-                old_v = self.reg_value('a')
-                v = (old_v >> 1) + (c * 128)
-                self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', old_v & 0b00000001 != 0)
-        elif op == 'ROL':
-            c = int(self.flag('c'))
-            if addr is not None:
-                old_v = self._value_from_address(addr, mode)
-                v = (old_v << 1) + c
-                v %= 256
-                self.set_mem_value(addr, v)
-            else:
-                old_v = self.reg_value('a')
-                v = (old_v << 1) + c
-                v %= 256
-                self.set_reg_value('a', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-            self.set_flag('c', old_v & 0b10000000 != 0)
-        elif op == 'STY':
-            v = self.reg_value('y')
+        if op not in self.handlers:
+            raise ValueError('错误的 op： <{}>'.format(op))
+        self.handlers[op](addr, mode)
+
+    def _branch(self, addr: int):
+        # 跳转成功多用 1 个周期，跳到另一页再多用 1 个周期
+        if (self.pc ^ addr) & 0xff00:
+            self.cycles += 2
+        else:
+            self.cycles += 1
+        self.pc = addr
+
+    def _op_jmp(self, addr: Optional[int], mode: str):
+        self.pc = addr
+
+    def _op_ldx(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self.x = v
+        self.n = self.z = v
+
+    def _op_stx(self, addr: Optional[int], mode: str):
+        self.set_mem_value(addr, self.x)
+
+    def _op_jsr(self, addr: Optional[int], mode: str):
+        v = self.pc - 1
+        self.push((v & 0xff00) >> 8)
+        self.push(v & 0x00ff)
+        self.pc = addr
+
+    def _op_nop(self, addr: Optional[int], mode: str):
+        # do nothing
+        pass
+
+    def _op_sec(self, addr: Optional[int], mode: str):
+        self.c = 1
+
+    def _op_bcs(self, addr: Optional[int], mode: str):
+        if self.c:
+            self._branch(addr)
+
+    def _op_clc(self, addr: Optional[int], mode: str):
+        self.c = 0
+
+    def _op_bcc(self, addr: Optional[int], mode: str):
+        if not self.c:
+            self._branch(addr)
+
+    def _op_lda(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self.a = v
+        self.n = self.z = v
+
+    def _op_beq(self, addr: Optional[int], mode: str):
+        if not self.z:
+            self._branch(addr)
+
+    def _op_bne(self, addr: Optional[int], mode: str):
+        if self.z:
+            self._branch(addr)
+
+    def _op_sta(self, addr: Optional[int], mode: str):
+        self.set_mem_value(addr, self.a)
+
+    def _op_bit(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        # N、V 直接取自操作数的第 7、6 位，Z 取自和 A 相与的结果
+        self.n = v
+        self.v = v & 0b01000000
+        self.z = v & self.a
+
+    def _op_bvs(self, addr: Optional[int], mode: str):
+        if self.v:
+            self._branch(addr)
+
+    def _op_bvc(self, addr: Optional[int], mode: str):
+        if not self.v:
+            self._branch(addr)
+
+    def _op_bpl(self, addr: Optional[int], mode: str):
+        if not self.n & 0b10000000:
+            self._branch(addr)
+
+    def _op_rts(self, addr: Optional[int], mode: str):
+        vl = self.pop()
+        self.pc = ((vl | (self.pop() << 8)) + 1) & 0xffff
+
+    def _op_sei(self, addr: Optional[int], mode: str):
+        self.status |= 0b00000100
+
+    def _op_sed(self, addr: Optional[int], mode: str):
+        self.status |= 0b00001000
+
+    def _op_php(self, addr: Optional[int], mode: str):
+        # 在这条指令中，只有「被压入栈」的 P 的 B flag 被置为 True
+        self.push(self.p | 0b00010000)
+
+    def _op_pla(self, addr: Optional[int], mode: str):
+        v = self.pop()
+        self.a = v
+        self.n = self.z = v
+
+    def _op_and(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        v = self.a & v
+        self.a = v
+        self.n = self.z = v
+
+    def _op_cmp(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self._compare(self.a, v)
+
+    def _compare(self, r: int, v: int):
+        v, self.c = compare_table[r << 8 | v]
+        self.n = self.z = v
+
+    def _op_cld(self, addr: Optional[int], mode: str):
+        self.status &= 0b11110111
+
+    def _op_pha(self, addr: Optional[int], mode: str):
+        self.push(self.a)
+
+    def _op_plp(self, addr: Optional[int], mode: str):
+        v = self.pop()
+        self._set_p_from_stack(v)
+
+    def _op_bmi(self, addr: Optional[int], mode: str):
+        if self.n & 0b10000000:
+            self._branch(addr)
+
+    def _op_ora(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        v = self.a | v
+        self.a = v
+        self.n = self.z = v
+
+    def _op_clv(self, addr: Optional[int], mode: str):
+        self.v = 0
+
+    def _op_eor(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        v = self.a ^ v
+        self.a = v
+        self.n = self.z = v
+
+    def _op_adc(self, addr: Optional[int], mode: str):
+        mvalue = self._value_from_address(addr, mode)
+        v, self.v, self.c = adc_table[self.c << 16 | self.a << 8 | mvalue]
+        self.a = self.n = self.z = v
+
+    def _op_ldy(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self.y = v
+        self.n = self.z = v
+
+    def _op_cpy(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self._compare(self.y, v)
+
+    def _op_cpx(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self._compare(self.x, v)
+
+    def _op_sbc(self, addr: Optional[int], mode: str):
+        mvalue = self._value_from_address(addr, mode)
+        # A - M - (1 - C) 等于 A + ~M + C，借位时 C 为 0
+        v, self.v, self.c = adc_table[self.c << 16 | self.a << 8 | (mvalue ^ 0xff)]
+        self.a = self.n = self.z = v
+
+    def _op_iny(self, addr: Optional[int], mode: str):
+        v = inc_table[self.y]
+        self.y = v
+        self.n = self.z = v
+
+    def _op_inx(self, addr: Optional[int], mode: str):
+        v = inc_table[self.x]
+        self.x = v
+        self.n = self.z = v
+
+    def _op_dey(self, addr: Optional[int], mode: str):
+        v = dec_table[self.y]
+        self.y = v
+        self.n = self.z = v
+
+    def _op_dex(self, addr: Optional[int], mode: str):
+        v = dec_table[self.x]
+        self.x = v
+        self.n = self.z = v
+
+    def _op_tay(self, addr: Optional[int], mode: str):
+        v = self.a
+        self.y = v
+        self.n = self.z = v
+
+    def _op_tax(self, addr: Optional[int], mode: str):
+        v = self.a
+        self.x = v
+        self.n = self.z = v
+
+    def _op_tya(self, addr: Optional[int], mode: str):
+        v = self.y
+        self.a = v
+        self.n = self.z = v
+
+    def _op_txa(self, addr: Optional[int], mode: str):
+        v = self.x
+        self.a = v
+        self.n = self.z = v
+
+    def _op_tsx(self, addr: Optional[int], mode: str):
+        v = self.s
+        self.x = v
+        self.n = self.z = v
+
+    def _op_txs(self, addr: Optional[int], mode: str):
+        self.s = self.x
+
+    def _op_rti(self, addr: Optional[int], mode: str):
+        v = self.pop()
+        self._set_p_from_stack(v)
+        vl = self.pop()
+        # 这里不需要像 RTS 一样 +1
+        self.pc = vl | (self.pop() << 8)
+
+    def _op_lsr(self, addr: Optional[int], mode: str):
+        if addr is not None:
+            v, self.c = lsr_table[self._value_from_address(addr, mode)]
             self.set_mem_value(addr, v)
-        elif op == 'INC':
-            v = self._value_from_address(addr, mode)
-            v += 1
-            v %= 256
+        else:
+            v, self.c = lsr_table[self.a]
+            self.a = v
+        self.n = self.z = v
+
+    def _op_asl(self, addr: Optional[int], mode: str):
+        if addr is not None:
+            v, self.c = asl_table[self._value_from_address(addr, mode)]
             self.set_mem_value(addr, v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'DEC':
-            v = self._value_from_address(addr, mode)
-            v -= 1
-            v %= 256
+        else:
+            v, self.c = asl_table[self.a]
+            self.a = v
+        self.n = self.z = v
+
+    def _op_ror(self, addr: Optional[int], mode: str):
+        c = self.c << 8
+        if addr is not None:
+            v, self.c = ror_table[c | self._value_from_address(addr, mode)]
             self.set_mem_value(addr, v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'LAX':
-            v = self._value_from_address(addr, mode)
-            self.set_reg_value('a', v)
-            self.set_reg_value('x', v)
-            self.set_flag('n', v & 0b10000000 != 0)
-            self.set_flag('z', v == 0)
-        elif op == 'SAX':
-            v1 = self.reg_value('a')
-            v2 = self.reg_value('x')
-            v = v1 & v2
+        else:
+            v, self.c = ror_table[c | self.a]
+            self.a = v
+        self.n = self.z = v
+
+    def _op_rol(self, addr: Optional[int], mode: str):
+        c = self.c << 8
+        if addr is not None:
+            v, self.c = rol_table[c | self._value_from_address(addr, mode)]
             self.set_mem_value(addr, v)
-        elif op == 'DCP':
-            self._execute('DEC', addr, mode)
-            self._execute('CMP', addr, mode)
-        elif op == 'ISB':
-            self._execute('ISC', addr, mode)
-        elif op == 'ISC':
-            self._execute('INC', addr, mode)
-            self._execute('SBC', addr, mode)
-        elif op == 'SLO':
-            self._execute('ASL', addr, mode)
-            self._execute('ORA', addr, mode)
-        elif op == 'RLA':
-            self._execute('ROL', addr, mode)
-            self._execute('AND', addr, mode)
-        elif op == 'SRE':
-            self._execute('LSR', addr, mode)
-            self._execute('EOR', addr, mode)
-        elif op == 'RRA':
-            self._execute('ROR', addr, mode)
-            self._execute('ADC', addr, mode)
-        elif op == 'BRK':
-            # pc 压栈
-            # 这里不需要 pc - 1
-            pc = self.reg_value('pc')
-            v = pc
-            self.push((v & 0xff00) >> 8)
-            self.push(v & 0x00ff)
-
-            # p 压栈
-            # 在这条指令中，只有「被压入栈」的 P 的 B flag 被置为 True
-            bv = self.reg_value('p')
-            self.set_flag('b', True)
-            v = self.reg_value('p')
-            self.push(v)
-            self.set_reg_value('p', bv)
-
-            # 设置中断跳转
-            vl = self.mem_value(0xfffe)
-            vh = self.mem_value(0xffff)
-            v = number_from_bytes([vl, vh])
-            self.set_reg_value('pc', v)
-
-            self.set_flag('i', True)
-            self.set_flag('b', True)
         else:
-            raise ValueError('错误的 op： <{}>'.format(op))
+            v, self.c = rol_table[c | self.a]
+            self.a = v
+        self.n = self.z = v
+
+    def _op_sty(self, addr: Optional[int], mode: str):
+        self.set_mem_value(addr, self.y)
+
+    def _op_inc(self, addr: Optional[int], mode: str):
+        v = inc_table[self._value_from_address(addr, mode)]
+        self.set_mem_value(addr, v)
+        self.n = self.z = v
+
+    def _op_dec(self, addr: Optional[int], mode: str):
+        v = dec_table[self._value_from_address(addr, mode)]
+        self.set_mem_value(addr, v)
+        self.n = self.z = v
+
+    def _op_lax(self, addr: Optional[int], mode: str):
+        v = self._value_from_address(addr, mode)
+        self.a = v
+        self.x = v
+        self.n = self.z = v
+
+    def _op_sax(self, addr: Optional[int], mode: str):
+        self.set_mem_value(addr, self.a & self.x)
+
+    def _op_dcp(self, addr: Optional[int], mode: str):
+        self._op_dec(addr, mode)
+        self._op_cmp(addr, mode)
+
+    def _op_isb(self, addr: Optional[int], mode: str):
+        self._op_isc(addr, mode)
+
+    def _op_isc(self, addr: Optional[int], mode: str):
+        self._op_inc(addr, mode)
+        self._op_sbc(addr, mode)
+
+    def _op_slo(self, addr: Optional[int], mode: str):
+        self._op_asl(addr, mode)
+        self._op_ora(addr, mode)
+
+    def _op_rla(self, addr: Optional[int], mode: str):
+        self._op_rol(addr, mode)
+        self._op_and(addr, mode)
+
+    def _op_sre(self, addr: Optional[int], mode: str):
+        self._op_lsr(addr, mode)
+        self._op_eor(addr, mode)
+
+    def _op_rra(self, addr: Optional[int], mode: str):
+        self._op_ror(addr, mode)
+        self._op_adc(addr, mode)
+
+    def _op_brk(self, addr: Optional[int], mode: str):
+        # pc 压栈
+        # 这里不需要 pc - 1
+        v = self.pc
+        self.push((v & 0xff00) >> 8)
+        self.push(v & 0x00ff)
+
+        # p 压栈
+        # 在这条指令中，只有「被压入栈」的 P 的 B flag 被置为 True
+        self.push(self.p | 0b00010000)
+
+        # 设置中断跳转
+        self.pc = self.mem_value(0xfffe) | (self.mem_value(0xffff) << 8)
+
+        self.status |= 0b00010100
+
+    def _nmi(self):
+        self.interrupt('nmi')
 
     def interrupt(self, name: str):
         name = name.upper()
 
         if name == 'NMI':
-            if not self.ppu.can_nmi():
-                return
-            else:
-                self.ppu.set_can_nmi(False)
+            # 是否允许 NMI 由 PPU 在调用之前判断
             al_pos = 0xfffa
         elif name == 'RESET':
             al_pos = 0xfffc
@@ -667,18 +1041,14 @@ class NesCPU(object):
             raise ValueError('错误的 interrupt： <{}>'.format(name))
 
         # 将 pc 和 p 压栈
-        pc = self.reg_value('pc')
-        v = pc
+        v = self.pc
         self.push((v & 0xff00) >> 8)
         self.push(v & 0x00ff)
         # 只有「被压入栈」的 P 的 B flag 被置为 True
-        bv = self.reg_value('p')
-        self.set_flag('b', True)
-        v = self.reg_value('p')
-        self.push(v)
-        self.set_reg_value('p', bv)
-
-        al = self.mem_value(al_pos)
-        ah = self.mem_value(al_pos + 1)
-        addr = utils.number_from_bytes([al, ah])
-        self.set_reg_value('pc', addr)
+        self.push(self.p | 0b00010000)
+
+        # 进入中断处理时屏蔽 IRQ
+        self.status |= 0b00000100
+
+        self.pc = self.mem_value(al_pos) | (self.mem_value(al_pos + 1) << 8)
+        self.cycles += 7
@@ -1,27 +1,98 @@
 # -*- coding: utf-8 -*-
+import mmap
 
 
 class NesFile(object):
     def __init__(self, data: bytes):
         self.format = None
+        # 是否为 NES 2.0 格式的文件头
+        self.nes2 = False
         self.size_of_prg_rom_unit = None
-        self.size_of_prg_chr_unit = None
-        self.prg_rom = None
-        self.chr_rom = None
+        self.size_of_chr_rom_unit = None
+        self.mapper = None
+        self.submapper = None
+        # 'horizontal'、'vertical' 或者 'four_screen'
+        self.mirroring = None
+        self.battery = False
+        self.vs_unisystem = False
+        self.playchoice = False
+        self.prg_ram_size = None
+        self.chr_ram_size = None
+        # 都是只读的 memoryview，直接引用 data 里的字节，不做拷贝
+        self.trainer: memoryview = None
+        self.prg_rom: memoryview = None
+        self.chr_rom: memoryview = None
 
         self._setup(data)
 
     def _setup(self, data: bytes):
-        self.format: str = data[0: 3].decode('ascii')
-        self.size_of_prg_rom_unit: int = data[4]
-        self.size_of_chr_rom_unit: int = data[5]
+        view = memoryview(data).toreadonly()
+        self.format: str = bytes(view[0: 3]).decode('ascii')
+        flags6 = view[6]
+        flags7 = view[7]
+        self.nes2 = (flags7 & 0b00001100) == 0b00001000
+
+        # Flags 6: NNNN FTBM
+        if flags6 & 0b00001000:
+            self.mirroring = 'four_screen'
+        elif flags6 & 0b00000001:
+            self.mirroring = 'vertical'
+        else:
+            self.mirroring = 'horizontal'
+        self.battery = (flags6 & 0b00000010) != 0
+        has_trainer = (flags6 & 0b00000100) != 0
+
+        if self.nes2:
+            self._setup_nes2(view)
+        else:
+            self._setup_ines(view)
+
+        offset = 16
+        if has_trainer:
+            # Trainer 在文件头之后，加载到 $7000-$71FF
+            self.trainer = view[offset:offset + 512]
+            offset += 512
         prom_len = self.size_of_prg_rom_unit * 16384
-        self.prg_rom = list(data[16:16 + prom_len])
+        self.prg_rom = view[offset:offset + prom_len]
+        offset += prom_len
         crom_len = self.size_of_chr_rom_unit * 8192
-        self.chr_rom = list(data[16 + prom_len:16 + prom_len + crom_len])
+        self.chr_rom = view[offset:offset + crom_len]
+
+    def _setup_ines(self, view: memoryview):
+        flags6 = view[6]
+        flags7 = view[7]
+        self.size_of_prg_rom_unit: int = view[4]
+        self.size_of_chr_rom_unit: int = view[5]
+        if any(view[12:16]):
+            # 旧的工具会在 7-15 字节写入 "DiskDude!" 之类的垃圾数据，这时 Flags 7 不可信
+            flags7 = 0
+        self.mapper = (flags7 & 0xf0) | (flags6 >> 4)
+        self.submapper = 0
+        self.vs_unisystem = (flags7 & 0b00000001) != 0
+        self.playchoice = (flags7 & 0b00000010) != 0
+        # 以 8KB 为单位，0 表示 8KB
+        self.prg_ram_size = max(view[8], 1) * 0x2000
+        self.chr_ram_size = 0x2000 if self.size_of_chr_rom_unit == 0 else 0
+
+    def _setup_nes2(self, view: memoryview):
+        flags6 = view[6]
+        flags7 = view[7]
+        self.size_of_prg_rom_unit: int = view[4] | ((view[9] & 0x0f) << 8)
+        self.size_of_chr_rom_unit: int = view[5] | ((view[9] & 0xf0) << 4)
+        self.mapper = ((view[8] & 0x0f) << 8) | (flags7 & 0xf0) | (flags6 >> 4)
+        self.submapper = view[8] >> 4
+        self.vs_unisystem = (flags7 & 0b00000011) == 0b01
+        self.playchoice = (flags7 & 0b00000011) == 0b10
+        # 大小为 64 << shift，shift 为 0 表示没有
+        self.prg_ram_size = sum(64 << s for s in (view[10] & 0x0f, view[10] >> 4) if s)
+        self.chr_ram_size = sum(64 << s for s in (view[11] & 0x0f, view[11] >> 4) if s)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, *, use_mmap=True):
         with open(path, 'rb') as f:
-            data = f.read()
+            if use_mmap:
+                # 映射后即可关闭文件，映射本身由 memoryview 引用着
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
             return cls(data)
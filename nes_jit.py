@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+from typing import Callable, Dict, List, Optional, Tuple
+
+import nes_cpu as nc
+import opcodes_table
+
+
+# 只改 N/Z 的指令：指令名 => 结果写回的寄存器
+load_ops = {'LDA': 'a', 'LDX': 'x', 'LDY': 'y'}
+store_ops = {'STA': 'a', 'STX': 'x', 'STY': 'y', 'SAX': 'a & x'}
+transfer_ops = {
+    'TAX': ('x', 'a'), 'TAY': ('y', 'a'), 'TXA': ('a', 'x'),
+    'TYA': ('a', 'y'), 'TSX': ('x', 's'),
+}
+step_ops = {
+    'INX': ('x', 1), 'INY': ('y', 1), 'DEX': ('x', -1), 'DEY': ('y', -1),
+}
+logic_ops = {'AND': '&', 'ORA': '|', 'EOR': '^'}
+compare_ops = {'CMP': 'a', 'CPX': 'x', 'CPY': 'y'}
+# 分支指令 => (flag, 跳转的条件是 flag 被设置)
+branch_ops = {
+    'BCS': ('C', True), 'BCC': ('C', False), 'BEQ': ('Z', True), 'BNE': ('Z', False),
+    'BMI': ('N', True), 'BPL': ('N', False), 'BVS': ('V', True), 'BVC': ('V', False),
+}
+# 直接修改 P 里其余位的指令 => 对 cpu.status 的运算
+status_ops = {'SEI': '|= 0x04', 'SED': '|= 0x08', 'CLD': '&= 0xf7'}
+shift_ops = {'ASL', 'LSR', 'ROL', 'ROR'}
+# 非官方的读-改-写指令 => (先执行的读-改-写, 再用结果执行的运算)
+combined_ops = {
+    'DCP': ('DEC', 'CMP'), 'ISB': ('INC', 'SBC'), 'ISC': ('INC', 'SBC'), 'SLO': ('ASL', 'ORA'),
+    'RLA': ('ROL', 'AND'), 'SRE': ('LSR', 'EOR'), 'RRA': ('ROR', 'ADC'),
+}
+
+
+class BlockCompiler(object):
+    """
+    把一个已解码的基本块翻译成一个 Python 函数的源码
+    寄存器在函数里是局部变量，只在出口写回 CPU
+    块里算出的 N/Z、C、V 也放在局部变量 nz、c、v 里，分支直接读局部变量，PHP 或者出口时才写回 CPU
+    地址固定的 RAM 访问直接读写 ram，块所在的 ROM 页里的常量直接折叠成数字
+    会访问 I/O 的指令不编译：地址固定的在它之前结束这个块，地址要执行时才知道的在访问前检查页表，
+    不是 RAM/ROM 时写回状态提前返回，由解释器执行这条指令
+    """
+
+    def __init__(self, cpu: nc.NesCPU, block: List[int]):
+        self.cpu = cpu
+        self.block = block
+        self.lines: List[str] = []
+        self.indent = 2
+        # 已经改过、出口时需要写回的寄存器
+        self.dirty = set()
+        # 还在局部变量里、没有写回 CPU 的 flag：'nz'、'c'、'v'
+        self.lazy = set()
+        # 已经编译的指令条数和它们的基本周期数
+        self.count = 0
+        self.cycles = 0
+        # 是否用到了跨页多出的周期数 extra，以及最多可能多出几个周期
+        self.extra = False
+        self.extra_cycles = 0
+        # 所有出口中最多的周期数
+        self.max_cycles = 0
+        # 分支、跳转和返回已经生成了出口
+        self.ended = False
+        # 块占用的页，失效时整个块一起作废，这些页里的 ROM 常量可以直接折叠
+        self.pages = set()
+        for pc in block:
+            entry = cpu.decoded[pc]
+            self.pages.update(range(pc >> 8, ((entry[5] - 1) >> 8) + 1))
+
+    def emit(self, line: str):
+        self.lines.append('    ' * self.indent + line)
+
+    def flag(self, name: str):
+        # 读取单个 flag 的表达式，结果只用来判断真假
+        if name == 'C':
+            return 'c' if 'c' in self.lazy else 'cpu.c'
+        if name == 'V':
+            return 'v' if 'v' in self.lazy else 'cpu.v'
+        if name == 'Z':
+            return 'not nz' if 'nz' in self.lazy else 'not cpu.z'
+        return 'nz & 0x80' if 'nz' in self.lazy else 'cpu.n & 0x80'
+
+    def carry(self):
+        # 作为数值参与运算的 C
+        return 'c' if 'c' in self.lazy else 'cpu.c'
+
+    def flush(self):
+        # 把局部变量里的 flag 写回 CPU
+        if 'nz' in self.lazy:
+            self.emit('cpu.n = cpu.z = nz')
+        if 'c' in self.lazy:
+            self.emit('cpu.c = c')
+        if 'v' in self.lazy:
+            self.emit('cpu.v = v')
+
+    def exit(self, pc: str, cycles: int):
+        # 写回状态并返回执行的指令条数，pc 是表达式，cycles 是已执行指令的周期数
+        self.flush()
+        for r in 'axys':
+            if r in self.dirty:
+                self.emit('cpu.{0} = {0}'.format(r))
+        self.emit('cpu.pc = {}'.format(pc))
+        self.emit('cpu.cycles += {}{}'.format(cycles, ' + extra' if self.extra else ''))
+        self.emit('return {}'.format(self.count))
+        self.max_cycles = max(self.max_cycles, cycles + self.extra_cycles)
+
+    def guard(self, condition: str, pc: int):
+        # condition 成立时这条指令交给解释器
+        self.emit('if {}:'.format(condition))
+        self.indent += 1
+        self.exit('0x{:04x}'.format(pc), self.cycles)
+        self.indent -= 1
+
+    def set_nz(self, value: str):
+        self.emit('nz = {}'.format(value))
+        self.lazy.add('nz')
+
+    def access(self, pc: int, mode: str, operand: Optional[int], write: bool, page_cross: bool):
+        """
+        生成计算地址和检查页表的代码，返回 (读取的表达式, 写入的格式)
+        地址固定但不是 RAM/ROM 时返回 None，这条指令不能编译
+        """
+        if mode == 'IMM':
+            return '0x{:02x}'.format(operand), None
+        if mode == 'ZPG' or mode == 'ZPX' or mode == 'ZPY':
+            if mode == 'ZPG':
+                t = '0x{:02x}'.format(operand)
+            else:
+                self.emit('t = (0x{:02x} + {}) & 0xff'.format(operand, mode[2].lower()))
+                t = 't'
+            if write:
+                self.guard('write_pages[0] is None', pc)
+            return 'ram[{}]'.format(t), 'ram[{}] = {{}}'.format(t)
+        if mode == 'ABS':
+            page = operand >> 8
+            if page < 0x20:
+                t = '0x{:03x}'.format(operand & 0x7ff)
+                if write:
+                    self.guard('write_pages[0x{:02x}] is None'.format(page), pc)
+                return 'ram[{}]'.format(t), 'ram[{}] = {{}}'.format(t)
+            view = self.cpu.write_pages[page] if write else self.cpu.read_pages[page]
+            if view is None:
+                return None
+            offset = operand & 0xff
+            if not write and view.readonly and page in self.pages:
+                return '0x{:02x}'.format(view[offset]), None
+            pages = 'write_pages' if write else 'read_pages'
+            self.emit('w = {}[0x{:02x}]'.format(pages, page))
+            self.guard('w is None', pc)
+            return 'w[0x{:02x}]'.format(offset), 'w[0x{:02x}] = {{}}'.format(offset)
+        if mode == 'ABX' or mode == 'ABY':
+            base = '0x{:04x}'.format(operand)
+            self.emit('t = ({} + {}) & 0xffff'.format(base, mode[2].lower()))
+            cross = 't >> 8 != 0x{:02x}'.format(operand >> 8)
+        elif mode == 'INX':
+            self.emit('t = (0x{:02x} + x) & 0xff'.format(operand))
+            self.emit('t = ram[t] | ram[(t + 1) & 0xff] << 8')
+            cross = None
+        elif mode == 'INY':
+            self.emit('b = ram[0x{:02x}] | ram[0x{:02x}] << 8'.format(operand, (operand + 1) & 0xff))
+            self.emit('t = (b + y) & 0xffff')
+            cross = '(b ^ t) & 0xff00'
+        else:
+            return None
+        # 地址要执行时才知道，页表里没有对应的 RAM/ROM 时交给解释器
+        self.emit('w = {}[t >> 8]'.format('write_pages' if write else 'read_pages'))
+        self.guard('w is None', pc)
+        if page_cross and cross is not None:
+            self.emit('if {}:'.format(cross))
+            self.emit('    extra += 1')
+            self.extra = True
+            self.extra_cycles += 1
+        return 'w[t & 0xff]', 'w[t & 0xff] = {}'
+
+    def alu(self, op: str, m: str):
+        # 结果写到寄存器的运算，m 是操作数的表达式
+        if op in logic_ops:
+            self.emit('a = a {} {}'.format(logic_ops[op], m))
+            self.dirty.add('a')
+            self.set_nz('a')
+        elif op == 'ADC' or op == 'SBC':
+            self.emit('m = {}{}'.format(m, ' ^ 0xff' if op == 'SBC' else ''))
+            self.emit('t = a + m + {}'.format(self.carry()))
+            self.emit('v = (~(a ^ m) & (a ^ t) & 0x80) >> 1')
+            self.emit('c = t >> 8')
+            self.emit('a = t & 0xff')
+            self.dirty.add('a')
+            self.lazy.update(('c', 'v'))
+            self.set_nz('a')
+        else:
+            self.emit('t = {} - {}'.format(compare_ops[op], m))
+            self.emit('c = 1 if t >= 0 else 0')
+            self.lazy.add('c')
+            self.set_nz('t & 0xff')
+
+    def rmw(self, op: str, m: str):
+        # 读-改-写的运算，结果放在 m 里
+        if op == 'INC' or op == 'DEC':
+            self.emit('m = ({} {} 1) & 0xff'.format(m, '+' if op == 'INC' else '-'))
+        elif op == 'ASL':
+            self.emit('m = {}'.format(m))
+            self.emit('c = m >> 7')
+            self.emit('m = (m << 1) & 0xff')
+        elif op == 'LSR':
+            self.emit('m = {}'.format(m))
+            self.emit('c = m & 0x01')
+            self.emit('m = m >> 1')
+        elif op == 'ROL':
+            # t 里可能是之后写回用的地址，移位的中间结果放在 r 里
+            self.emit('r = ({} << 1) | {}'.format(m, self.carry()))
+            self.emit('c = r >> 8')
+            self.emit('m = r & 0xff')
+        else:
+            self.emit('m = {}'.format(m))
+            self.emit('r = (m >> 1) | ({} << 7)'.format(self.carry()))
+            self.emit('c = m & 0x01')
+            self.emit('m = r')
+        if op in shift_ops:
+            self.lazy.add('c')
+        self.set_nz('m')
+
+    def push(self, value: str):
+        self.emit('ram[0x100 + s] = {}'.format(value))
+        self.emit('s = (s - 1) & 0xff')
+        self.dirty.add('s')
+
+    def pop(self, target: str):
+        self.emit('s = (s + 1) & 0xff')
+        self.emit('{} = ram[0x100 + s]'.format(target))
+        self.dirty.add('s')
+
+    def instruction(self, pc: int, entry: Tuple):
+        """
+        生成一条指令的代码，返回 False 表示这条指令不能编译，块在它之前结束
+        """
+        c, _, mode, _, operand, next_pc, cycles = entry
+        op = self.cpu.dispatch[c][0]
+        page_cross = op in opcodes_table.page_cross_ops and mode in opcodes_table.page_cross_modes
+
+        if op in load_ops or op == 'LAX':
+            target = self.access(pc, mode, operand, False, page_cross)
+            if target is None:
+                return False
+            r = load_ops.get(op, 'a')
+            self.emit('{} = {}'.format(r, target[0]))
+            if op == 'LAX':
+                self.emit('x = a')
+                self.dirty.add('x')
+            self.dirty.add(r)
+            self.set_nz(r)
+        elif op in store_ops:
+            target = self.access(pc, mode, operand, True, False)
+            if target is None:
+                return False
+            self.emit(target[1].format(store_ops[op]))
+        elif op in logic_ops or op in compare_ops or op == 'ADC' or op == 'SBC':
+            target = self.access(pc, mode, operand, False, page_cross)
+            if target is None:
+                return False
+            self.alu(op, target[0])
+        elif op in shift_ops and mode == 'IMP':
+            self.rmw(op, 'a')
+            self.emit('a = m')
+            self.dirty.add('a')
+        elif op in shift_ops or op == 'INC' or op == 'DEC' or op in combined_ops:
+            target = self.access(pc, mode, operand, True, False)
+            if target is None:
+                return False
+            first, then = combined_ops.get(op, (op, None))
+            self.rmw(first, target[0])
+            self.emit(target[1].format('m'))
+            if then is not None:
+                self.alu(then, 'm')
+        elif op in transfer_ops:
+            r, source = transfer_ops[op]
+            self.emit('{} = {}'.format(r, source))
+            self.dirty.add(r)
+            self.set_nz(r)
+        elif op == 'TXS':
+            self.emit('s = x')
+            self.dirty.add('s')
+        elif op in step_ops:
+            r, diff = step_ops[op]
+            self.emit('{0} = ({0} {1} 1) & 0xff'.format(r, '+' if diff > 0 else '-'))
+            self.dirty.add(r)
+            self.set_nz(r)
+        elif op == 'BIT':
+            target = self.access(pc, mode, operand, False, False)
+            if target is None:
+                return False
+            # N、V 取自操作数，Z 取自和 A 相与的结果，局部变量里的 N/Z、V 直接丢弃
+            self.emit('m = {}'.format(target[0]))
+            self.emit('cpu.n = m')
+            self.emit('cpu.v = m & 0x40')
+            self.emit('cpu.z = a & m')
+            self.lazy.difference_update(('nz', 'v'))
+        elif op == 'SEC' or op == 'CLC':
+            self.emit('c = {}'.format(1 if op == 'SEC' else 0))
+            self.lazy.add('c')
+        elif op == 'CLV':
+            self.emit('v = 0')
+            self.lazy.add('v')
+        elif op in status_ops:
+            self.emit('cpu.status {}'.format(status_ops[op]))
+        elif op == 'NOP':
+            # NOP 不读操作数，只有跨页的周期和解释器一致
+            if page_cross and mode == 'ABX':
+                self.emit('if 0x{:02x} + x > 0xff:'.format(operand & 0xff))
+                self.emit('    extra += 1')
+                self.extra = True
+                self.extra_cycles += 1
+        elif op == 'PHA':
+            self.push('a')
+        elif op == 'PHP':
+            self.flush()
+            self.lazy.clear()
+            self.push('cpu.p | 0x10')
+        elif op == 'PLA':
+            self.pop('a')
+            self.dirty.add('a')
+            self.set_nz('a')
+        elif op == 'PLP':
+            self.pop('m')
+            # 弹出的值不会作用到 B flag 上，局部变量里的 flag 直接丢弃
+            self.lazy.clear()
+            self.emit('cpu.p = (cpu.status & 0x30) | (m & 0xcf)')
+        elif op in branch_ops:
+            name, taken = branch_ops[op]
+            condition = self.flag(name)
+            if not taken:
+                condition = 'not ({})'.format(condition)
+            self.count += 1
+            self.cycles += cycles
+            # 跳转成功多用 1 个周期，跳到另一页再多用 1 个周期
+            self.emit('if {}:'.format(condition))
+            self.indent += 1
+            self.exit('0x{:04x}'.format(operand), self.cycles + (2 if (next_pc ^ operand) & 0xff00 else 1))
+            self.indent -= 1
+            self.exit('0x{:04x}'.format(next_pc), self.cycles)
+            self.ended = True
+            return True
+        elif op == 'JMP' and mode == 'ABS':
+            self.count += 1
+            self.cycles += cycles
+            self.exit('0x{:04x}'.format(operand), self.cycles)
+            self.ended = True
+            return True
+        elif op == 'JSR':
+            ret = next_pc - 1
+            self.push('0x{:02x}'.format(ret >> 8))
+            self.push('0x{:02x}'.format(ret & 0xff))
+            self.count += 1
+            self.cycles += cycles
+            self.exit('0x{:04x}'.format(operand), self.cycles)
+            self.ended = True
+            return True
+        elif op == 'RTS':
+            self.pop('t')
+            self.pop('m')
+            self.count += 1
+            self.cycles += cycles
+            self.exit('((m << 8 | t) + 1) & 0xffff', self.cycles)
+            self.ended = True
+            return True
+        else:
+            # RTI、BRK、JMP (ind) 和未知的指令交给解释器
+            return False
+
+        self.count += 1
+        self.cycles += cycles
+        return True
+
+    def source(self, start: int):
+        """
+        返回块的源码，第一条指令就不能编译时返回 None
+        """
+        decoded = self.cpu.decoded
+        pc = start
+        for pc in self.block:
+            entry = decoded[pc]
+            if not self.instruction(pc, entry):
+                break
+            if self.ended:
+                break
+            pc = entry[5]
+        if self.count == 0:
+            return None
+        if not self.ended:
+            self.exit('0x{:04x}'.format(pc), self.cycles)
+
+        head = [
+            'def make(ram, read_pages, write_pages):',
+            '    def block(cpu):',
+            '        a, x, y, s = cpu.a, cpu.x, cpu.y, cpu.s',
+        ]
+        if self.extra:
+            head.append('        extra = 0')
+        tail = ['    return block']
+        return '\n'.join(head + self.lines + tail) + '\n'
+
+
+def compile_block(cpu: nc.NesCPU, start: int, block: List[int]):
+    """
+    编译 start 开始的基本块，返回 block(cpu) 函数，执行后返回执行的指令条数
+    返回 0 表示第一条指令就需要解释器执行；第一条指令就不能编译时返回 None
+    函数的 max_cycles 属性是执行一次最多用掉的周期数
+    """
+    compiler = BlockCompiler(cpu, block)
+    source = compiler.source(start)
+    if source is None:
+        return None
+    namespace = {}
+    exec(compile(source, '<jit ${:04X}>'.format(start), 'exec'), namespace)
+    fn = namespace['make'](cpu.ram, cpu.read_pages, cpu.write_pages)
+    fn.source = source
+    fn.max_cycles = compiler.max_cycles
+    return fn
+
+
+class NesJIT(object):
+    """
+    可选的动态编译：按基本块的起始 PC 计数，执行次数达到 threshold 的块编译成 Python 函数
+    块由 CPU 的指令缓存解码，缓存作废时（改写 RAM 里的代码、切换 bank、读档）编译结果也随之作废
+    编译好的块不写指令跟踪记录
+    """
+
+    def __init__(self, cpu: nc.NesCPU, threshold=8):
+        self.cpu = cpu
+        self.threshold = threshold
+        self.hits = [0] * 0x10000
+        # 块的起始 PC => (编译时的基本块, 编译好的函数, 最多用掉的周期数)，函数为 None 表示这个块不能编译
+        # 基本块的列表在缓存作废后会重新创建，用 is 比较就能知道编译结果是否还有效
+        self.code: Dict[int, Tuple[List[int], Optional[Callable], int]] = {}
+        # 在编译好的块里执行的指令条数
+        self.compiled_instructions = 0
+
+    def step(self, budget=1 << 30):
+        """
+        执行一个编译好的块或者一条指令，返回执行的指令条数
+        块最多可能用掉的周期数达到 budget 时只解释执行一条指令，调度器用它保证中断的时机不变
+        """
+        cpu = self.cpu
+        pc = cpu.pc
+        block = cpu.blocks.get(pc)
+        if block is not None:
+            code = self.code.get(pc)
+            if code is None or code[0] is not block:
+                code = self._hit(pc, block)
+            if code is not None and code[1] is not None and code[2] < budget:
+                n = code[1](cpu)
+                if n:
+                    self.compiled_instructions += n
+                    return n
+        cpu.execute()
+        return 1
+
+    def _hit(self, pc: int, block: List[int]):
+        hits = self.hits[pc] + 1
+        if hits < self.threshold:
+            self.hits[pc] = hits
+            return None
+        self.hits[pc] = 0
+        fn = compile_block(self.cpu, pc, block)
+        code = (block, fn, 0 if fn is None else fn.max_cycles)
+        self.code[pc] = code
+        return code
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import struct
+from typing import Dict, List, Optional, Tuple, Type
+
+import nes_file as nf
+
+
+class NesMapper(object):
+    """
+    卡带上的 Mapper，负责把 PRG/CHR 的 bank 映射到 CPU/PPU 的地址空间
+    所有 bank 都预先切好了页，切换 bank 只需要替换页表里的项
+    """
+    number = None
+    # 存档时需要保存的整数属性（bank 寄存器等），读档后由 update_banks 恢复页表
+    state_attrs: Tuple[str, ...] = ()
+
+    def __init__(self, nes: nf.NesFile):
+        self.nes = nes
+        self.cpu = None
+        self.ppu = None
+        self.mirroring = nes.mirroring
+
+        # PRG-ROM 按 256 字节切页，对应 CPU 页表里的一项
+        prg = memoryview(nes.prg_rom)
+        self.prg_pages: List[memoryview] = [prg[i:i + 0x100] for i in range(0, len(prg), 0x100)]
+        # $6000-$7FFF 的 PRG-RAM
+        self.prg_ram = bytearray(0x2000)
+        if nes.trainer is not None:
+            self.prg_ram[0x1000:0x1200] = nes.trainer
+        ram = memoryview(self.prg_ram)
+        self.prg_ram_pages: List[memoryview] = [ram[i:i + 0x100] for i in range(0, len(ram), 0x100)]
+
+        # CHR 按 1KB 切页，对应 PPU 图样表里的一项；没有 CHR-ROM 的卡带使用 CHR-RAM
+        self.chr_ram: Optional[bytearray] = None
+        if len(nes.chr_rom) > 0:
+            chr_memory = memoryview(nes.chr_rom)
+        else:
+            self.chr_ram = bytearray(max(nes.chr_ram_size, 0x2000))
+            chr_memory = memoryview(self.chr_ram)
+        self.chr_pages: List[memoryview] = [chr_memory[i:i + 0x400] for i in range(0, len(chr_memory), 0x400)]
+
+    def attach(self, cpu):
+        """
+        接管 CPU 的 $6000-$FFFF 和 PPU 的图样表、名称表镜像
+        """
+        self.cpu = cpu
+        self.ppu = cpu.ppu
+        cpu.invalidate_pages(0x60, 0xa0)
+        for page in range(0x60, 0x80):
+            view = self.prg_ram_pages[page - 0x60]
+            cpu.read_pages[page] = view
+            cpu.write_pages[page] = view
+        for page in range(0x80, 0x100):
+            cpu.write_pages[page] = None
+            cpu.write_handlers[page] = self.write
+        self.reset()
+
+    def reset(self):
+        # 没有寄存器的 mapper 只需要按初始状态映射一次
+        self.update_banks()
+
+    def update_banks(self):
+        """
+        按当前的寄存器映射 PRG、CHR 和名称表镜像，由子类按各自的寄存器实现
+        """
+        pass
+
+    def write(self, addr: int, value: int):
+        # 默认忽略对 ROM 的写入
+        pass
+
+    def save_state(self):
+        """
+        寄存器、PRG-RAM、CHR-RAM 依次拼成字节串，长度由卡带决定
+        """
+        values = [getattr(self, attr) for attr in self.state_attrs]
+        parts = [struct.pack('<{}i'.format(len(values)), *values), self.prg_ram]
+        if self.chr_ram is not None:
+            parts.append(self.chr_ram)
+        return b''.join(parts)
+
+    def load_state(self, data: memoryview):
+        """
+        从 save_state 的结果恢复，返回用掉的字节数
+        """
+        size = 4 * len(self.state_attrs)
+        values = struct.unpack_from('<{}i'.format(len(self.state_attrs)), data)
+        for attr, value in zip(self.state_attrs, values):
+            setattr(self, attr, value)
+        self.prg_ram[:] = data[size:size + len(self.prg_ram)]
+        size += len(self.prg_ram)
+        if self.chr_ram is not None:
+            self.chr_ram[:] = data[size:size + len(self.chr_ram)]
+            size += len(self.chr_ram)
+            # CHR-RAM 的内容变了，所有图样都要重新解码
+            self.ppu.dirty_tiles.update(range(512))
+        self.update_banks()
+        return size
+
+    def map_prg(self, addr: int, size: int, bank: int):
+        """
+        把第 bank 个大小为 size 的 PRG bank 映射到 CPU 的 addr 处
+        bank 可以为负数，-1 表示最后一个 bank
+        """
+        count = size >> 8
+        total = len(self.prg_pages)
+        # ROM 比窗口小时在窗口里重复出现，和真机一样
+        banks = max(1, total // count)
+        begin = (bank % banks) * count
+        first = addr >> 8
+        pages = [self.prg_pages[(begin + i) % total] for i in range(count)]
+        # 按对象比较，逐个比较 memoryview 的内容太慢，切换 bank 的写入很频繁
+        if any(a is not b for a, b in zip(self.cpu.read_pages[first:first + count], pages)):
+            # 换掉的 bank 里已解码的指令作废
+            self.cpu.invalidate_pages(first, count)
+            self.cpu.read_pages[first:first + count] = pages
+
+    def map_chr(self, addr: int, size: int, bank: int):
+        """
+        把第 bank 个大小为 size 的 CHR bank 映射到 PPU 的 addr 处
+        """
+        count = size >> 10
+        total = len(self.chr_pages)
+        banks = max(1, total // count)
+        begin = (bank % banks) * count
+        self.ppu.set_pattern_pages(addr >> 10, [self.chr_pages[(begin + i) % total] for i in range(count)])
+
+    def set_mirroring(self, mirroring: str):
+        self.mirroring = mirroring
+        self.ppu.set_mirroring(mirroring)
+
+
+class MapperNROM(NesMapper):
+    """
+    Mapper 000: 16KB 的 PRG-ROM 在 $8000 和 $C000 各出现一次，32KB 的直接铺满
+    """
+    number = 0
+
+    def update_banks(self):
+        self.map_prg(0x8000, 0x4000, 0)
+        self.map_prg(0xc000, 0x4000, -1)
+        self.map_chr(0x0000, 0x2000, 0)
+        self.set_mirroring(self.mirroring)
+
+
+class MapperUxROM(NesMapper):
+    """
+    Mapper 002: $8000 为可切换的 16KB bank，$C000 固定为最后一个 bank
+    """
+    number = 2
+    state_attrs = ('prg_bank',)
+
+    def __init__(self, nes: nf.NesFile):
+        super().__init__(nes)
+        self.prg_bank = 0
+
+    def reset(self):
+        self.prg_bank = 0
+        self.update_banks()
+
+    def update_banks(self):
+        self.map_prg(0x8000, 0x4000, self.prg_bank)
+        self.map_prg(0xc000, 0x4000, -1)
+        self.map_chr(0x0000, 0x2000, 0)
+        self.set_mirroring(self.mirroring)
+
+    def write(self, addr: int, value: int):
+        self.prg_bank = value
+        self.map_prg(0x8000, 0x4000, value)
+
+
+class MapperCNROM(NesMapper):
+    """
+    Mapper 003: PRG 同 NROM，CHR 为可切换的 8KB bank
+    """
+    number = 3
+    state_attrs = ('chr_bank',)
+
+    def __init__(self, nes: nf.NesFile):
+        super().__init__(nes)
+        self.chr_bank = 0
+
+    def reset(self):
+        self.chr_bank = 0
+        self.update_banks()
+
+    def update_banks(self):
+        self.map_prg(0x8000, 0x4000, 0)
+        self.map_prg(0xc000, 0x4000, -1)
+        self.map_chr(0x0000, 0x2000, self.chr_bank)
+        self.set_mirroring(self.mirroring)
+
+    def write(self, addr: int, value: int):
+        self.chr_bank = value
+        self.map_chr(0x0000, 0x2000, value)
+
+
+class MapperMMC1(NesMapper):
+    """
+    Mapper 001: 通过串行写入 5 位的移位寄存器来设置 4 个内部寄存器
+    """
+    number = 1
+    state_attrs = ('shift', 'shift_count', 'control', 'chr_bank0', 'chr_bank1', 'prg_bank')
+
+    def __init__(self, nes: nf.NesFile):
+        super().__init__(nes)
+        self.shift = 0
+        self.shift_count = 0
+        self.control = 0
+        self.chr_bank0 = 0
+        self.chr_bank1 = 0
+        self.prg_bank = 0
+
+    def reset(self):
+        self.shift = 0
+        self.shift_count = 0
+        # 上电时固定最后一个 PRG bank 到 $C000
+        self.control = 0b01100
+        self.chr_bank0 = 0
+        self.chr_bank1 = 0
+        self.prg_bank = 0
+        self.update_banks()
+
+    def write(self, addr: int, value: int):
+        if value & 0b10000000:
+            # 最高位为 1 时重置移位寄存器
+            self.shift = 0
+            self.shift_count = 0
+            self.control |= 0b01100
+            self.update_banks()
+            return
+
+        # 从低位开始依次写入
+        self.shift |= (value & 1) << self.shift_count
+        self.shift_count += 1
+        if self.shift_count < 5:
+            return
+
+        v = self.shift
+        self.shift = 0
+        self.shift_count = 0
+        # 第 5 次写入的地址决定写哪个寄存器
+        register = (addr >> 13) & 0b11
+        if register == 0:
+            self.control = v
+        elif register == 1:
+            self.chr_bank0 = v
+        elif register == 2:
+            self.chr_bank1 = v
+        else:
+            self.prg_bank = v & 0b01111
+        self.update_banks()
+
+    def update_banks(self):
+        mirrorings = ['single_lower', 'single_upper', 'vertical', 'horizontal']
+        self.set_mirroring(mirrorings[self.control & 0b11])
+
+        prg_mode = (self.control >> 2) & 0b11
+        if prg_mode in (0, 1):
+            # 32KB 模式，忽略 bank 号的最低位
+            self.map_prg(0x8000, 0x8000, self.prg_bank >> 1)
+        elif prg_mode == 2:
+            self.map_prg(0x8000, 0x4000, 0)
+            self.map_prg(0xc000, 0x4000, self.prg_bank)
+        else:
+            self.map_prg(0x8000, 0x4000, self.prg_bank)
+            self.map_prg(0xc000, 0x4000, -1)
+
+        if self.control & 0b10000:
+            # 两个独立的 4KB bank
+            self.map_chr(0x0000, 0x1000, self.chr_bank0)
+            self.map_chr(0x1000, 0x1000, self.chr_bank1)
+        else:
+            # 8KB 模式，忽略 bank 号的最低位
+            self.map_chr(0x0000, 0x2000, self.chr_bank0 >> 1)
+
+
+# mapper 编号 => Mapper 类
+mappers: Dict[int, Type[NesMapper]] = {}
+
+
+def register_mapper(cls: Type[NesMapper]):
+    mappers[cls.number] = cls
+    return cls
+
+
+def mapper_from_nes(nes: nf.NesFile):
+    cls = mappers.get(nes.mapper)
+    if cls is None:
+        raise ValueError('不支持的 mapper：<{}>'.format(nes.mapper))
+    return cls(nes)
+
+
+for _cls in (MapperNROM, MapperMMC1, MapperUxROM, MapperCNROM):
+    register_mapper(_cls)
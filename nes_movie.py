@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import json
+import struct
+import sys
+import time
+from typing import Dict, Tuple
+
+import config
+import nes_cpu as nc
+import nes_file as nf
+import nes_scheduler as ns
+
+
+# 录像文件头：魔数、ROM 的 SHA-1、帧数、检查点个数
+# 之后是每帧 2 字节的按键，再之后是检查点
+movie_magic = b'NESMOVIE'
+header_struct = struct.Struct('<8s20sII')
+# 检查点：帧数、画面的 SHA-1、RAM 的 SHA-1
+check_struct = struct.Struct('<I20s20s')
+
+
+def rom_sha1(nes: nf.NesFile):
+    # 只计算 PRG 和 CHR，文件头里无关紧要的字节不影响匹配
+    h = hashlib.sha1()
+    h.update(nes.prg_rom)
+    h.update(nes.chr_rom)
+    return h.digest()
+
+
+def frame_hashes(cpu: nc.NesCPU):
+    screen = hashlib.sha1(cpu.ppu.screen.tobytes()).digest()
+    ram = hashlib.sha1(cpu.ram).digest()
+    return screen, ram
+
+
+class Movie(object):
+    """
+    录像：每帧两个字节，分别是两个手柄按下的按键，第 i 帧的按键在运行第 i 帧之前设置
+    另外在选定的帧记录画面和 RAM 的哈希，帧数为运行完之后 PPU 已经完成的帧数，回放时用来检查结果
+    """
+
+    def __init__(self, rom: bytes):
+        self.rom = rom
+        self.inputs = bytearray()
+        # 帧数 => (画面的 SHA-1, RAM 的 SHA-1)
+        self.checks: Dict[int, Tuple[bytes, bytes]] = {}
+
+    def __len__(self):
+        return len(self.inputs) // 2
+
+    def add_frame(self, port1: int, port2=0):
+        self.inputs += bytes((port1, port2))
+
+    def frame_input(self, index: int):
+        return self.inputs[index * 2], self.inputs[index * 2 + 1]
+
+    def add_check(self, cpu: nc.NesCPU):
+        self.checks[cpu.ppu.frame_count] = frame_hashes(cpu)
+
+    def to_bytes(self):
+        parts = [header_struct.pack(movie_magic, self.rom, len(self), len(self.checks)), self.inputs]
+        for frame in sorted(self.checks):
+            parts.append(check_struct.pack(frame, *self.checks[frame]))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        magic, rom, frames, checks = header_struct.unpack_from(data)
+        if magic != movie_magic:
+            raise ValueError('错误的录像文件')
+        movie = cls(rom)
+        offset = header_struct.size
+        movie.inputs[:] = data[offset:offset + frames * 2]
+        offset += frames * 2
+        for frame, screen, ram in check_struct.iter_unpack(data[offset:offset + checks * check_struct.size]):
+            movie.checks[frame] = (screen, ram)
+        return movie
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def replay(nes: nf.NesFile, movie: Movie):
+    """
+    不显示画面、不限制帧率，以 CPU 能跑到的最快速度回放录像，在检查点比较画面和 RAM 的哈希
+    返回可以直接转成 JSON 的回放摘要
+    """
+    if rom_sha1(nes) != movie.rom:
+        raise ValueError('录像和 ROM 不匹配')
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    cpu.interrupt('reset')
+    scheduler = ns.NesScheduler(cpu)
+    port1, port2 = cpu.controllers
+
+    instructions = 0
+    checked = 0
+    mismatches = []
+    begin = time.perf_counter()
+    for i in range(len(movie)):
+        buttons1, buttons2 = movie.frame_input(i)
+        port1.set_buttons(buttons1)
+        port2.set_buttons(buttons2)
+        instructions += scheduler.run_frame()
+        expected = movie.checks.get(cpu.ppu.frame_count)
+        if expected is not None:
+            checked += 1
+            if frame_hashes(cpu) != expected:
+                mismatches.append(cpu.ppu.frame_count)
+    used = time.perf_counter() - begin
+
+    summary = dict(
+        frames=len(movie),
+        instructions=instructions,
+        cycles=cpu.cycles,
+        wall_time=used,
+        fps=len(movie) / used if used > 0 else None,
+        checks=checked,
+        mismatches=mismatches,
+        framebuffer_sha1=frame_hashes(cpu)[0].hex(),
+    )
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='无界面回放录像，输出一行 JSON 摘要，检查点不一致时返回 1')
+    parser.add_argument('rom', help='ROM 文件路径')
+    parser.add_argument('movie', help='录像文件路径')
+    args = parser.parse_args(argv)
+
+    config.DEBUG = False
+    summary = replay(nf.NesFile.load(args.rom), Movie.load(args.movie))
+    print(json.dumps(summary))
+    return 1 if summary['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
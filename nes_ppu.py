@@ -1,21 +1,96 @@
 # -*- coding: utf-8 -*-
-from typing import Dict, List, Tuple
+import struct
+from typing import Callable, Dict, List, Optional, Tuple, Set
 
+import numpy as np
 import pygame as pygame
 
 import nes_file as nf
 
 
+def tiles_from_patterns(patterns: np.ndarray):
+    """
+    把图样表的字节解码成图样，每个图样 16 字节，解码后是 8x8 的 2 位颜色
+    (n * 16,) => (n, 8, 8)
+    """
+    planes = patterns.reshape(-1, 2, 8, 1)
+    # 把每一行展开成 8 个像素，最高位在最左边
+    bits = np.unpackbits(planes, axis=-1)
+    return bits[:, 0] | (bits[:, 1] << 1)
+
+
+# 镜像方式 => 4 个逻辑名称表（$2000、$2400、$2800、$2C00）实际使用的显存地址
+name_table_offsets = {
+    'horizontal': [0x2000, 0x2000, 0x2400, 0x2400],
+    'vertical': [0x2000, 0x2400, 0x2000, 0x2400],
+    'single_lower': [0x2000, 0x2000, 0x2000, 0x2000],
+    'single_upper': [0x2400, 0x2400, 0x2400, 0x2400],
+    'four_screen': [0x2000, 0x2400, 0x2800, 0x2c00],
+}
+
+# 存档的定长部分：9 个寄存器、v、t、x、w、PPUDATA 的读缓冲、扫描线、点、帧数
+state_struct = struct.Struct('<9sHHBBBHHQ')
+
+# 名称表里每个名称在属性字节里的位偏移，每 2x2 个名称共用两位，shape 为 (30, 32)
+_ty, _tx = np.mgrid[0:30, 0:32]
+attribute_shifts = ((_tx & 0b10) | ((_ty & 0b10) << 1)).astype(np.uint8)
+
+
 class NesPPU(object):
     def __init__(self):
         self.registers: Dict[str, int] = None
-        self.memory: List[int] = None
-        # 用于判断 PPUSCROLL、PPUADDR 的寄存是该写「高位」还是「低位」
-        self.reg_flag: Dict[str, bool] = None
+        self.memory: bytearray = None
+        # $0000-$1FFF 的图样表，每 1KB 一页，共 8 页，由 mapper 切换 bank
+        # CHR-ROM 直接引用 ROM 文件里的只读字节，CHR-RAM 默认是 memory 的前 8KB
+        self.pattern_pages: List[memoryview] = None
+        # 4 个逻辑名称表在 memory 里实际的起始地址，由卡带的镜像方式决定
+        self.name_table_offsets: List[int] = None
+        # PPU 内部的 loopy 寄存器，PPUCTRL、PPUSCROLL、PPUADDR 的写入都落在这里
+        # v、t 为 15 位的显存地址：yyy NN YYYYY XXXXX（精细 Y、名称表、粗略 Y、粗略 X）
+        # v 是当前地址，t 是下一帧（或下一行）开始时使用的地址，x 是精细 X 滚动（0 - 7）
+        # w 是 PPUSCROLL、PPUADDR 共用的写入开关，0 表示下一次是第一次写入
+        self.v = 0
+        self.t = 0
+        self.x = 0
+        self.w = 0
         # 将 cpu 读写的 port 映射到 ppu 寄存器上
         self.reg_mapper_for_cpu: Dict[int, str] = None
         self.buffer = 0
         self.colors: List[Tuple[int, int, int, int]] = None
+        # 颜色编号 => RGB，shape 为 (64, 3)
+        self.colors_rgb: np.ndarray = None
+        # 两个图样表共 512 个图样，预先解码好，shape 为 (512, 8, 8)
+        self.tiles: np.ndarray = None
+        # 被写入过、需要重新解码的图样
+        self.dirty_tiles: Set[int] = None
+        # 上一帧之后被改动过的名称，编号为 物理名称表 << 10 | 名称（0 - 959），属性表的改动会展开成它管理的名称
+        self.dirty_names: Set[int] = None
+        self.palette_dirty = True
+        # 调色盘索引 => RGB，shape 为 (32, 3)，调色盘被改写后重新计算
+        self.palette_rgb: np.ndarray = None
+        # 持久保存的背景，4 个逻辑名称表拼成一张图，只重画改动过的 8x8 名称
+        # background 为调色盘索引，shape 为 (480, 512)，滚动只是从里面切出 256 个像素
+        self.background: np.ndarray = None
+        # 上一次画背景时使用的图样表，None 表示需要重画整个背景
+        self.drawn_pattern_table: int = None
+        # 当前的扫描线（0 - 261，261 为预渲染线）和线内的点（0 - 340）
+        self.scanline = 0
+        self.dot = 0
+        # 已经完成的帧数
+        self.frame_count = 0
+        # 按扫描线输出的画面，每条可见扫描线结束时写入一行，shape 为 (240, 256, 3)
+        self.screen: np.ndarray = None
+        # 进入 VBlank 并且允许 NMI 时调用，由 CPU 设置
+        self.nmi_callback: Optional[Callable[[], None]] = None
+        # 64 个精灵，每个 4 字节：Y、图样编号、属性、X
+        self.oam: bytearray = None
+        # 每条扫描线选中的精灵，shape 为 (240, 64)，OAM 或精灵高度改变后重新计算
+        self.sprite_selected: np.ndarray = None
+        # 每条扫描线是否有精灵、是否超过 8 个精灵
+        self.sprite_lines: List[bool] = None
+        self.sprite_overflow_lines: List[bool] = None
+        # 计算 sprite_selected 时使用的精灵高度，None 表示需要重新计算
+        self.evaluated_sprite_height: Optional[int] = None
 
         self.setup()
 
@@ -42,11 +117,14 @@ class NesPPU(object):
             0x2007: 'PPUDATA',
             0x4014: 'OAMDMA',
         }
-        self.memory = [0] * 0x4000
-        self.reg_flag = {
-            'PPUSCROLL': True,
-            'PPUADDR': True,
-        }
+        self.memory = bytearray(0x4000)
+        memory = memoryview(self.memory)
+        self.pattern_pages = [memory[i:i + 0x400] for i in range(0, 0x2000, 0x400)]
+        self.name_table_offsets = name_table_offsets['horizontal']
+        self.v = 0
+        self.t = 0
+        self.x = 0
+        self.w = 0
 
         self.colors = [
             (0x7F, 0x7F, 0x7F, 0xFF), (0x20, 0x00, 0xB0, 0xFF), (0x28, 0x00, 0xB8, 0xFF), (0x60, 0x10, 0xA0, 0xFF),
@@ -69,9 +147,87 @@ class NesPPU(object):
             (0xFF, 0xF0, 0x90, 0xFF), (0xC8, 0xF0, 0x80, 0xFF), (0xA0, 0xF0, 0xA0, 0xFF), (0xA0, 0xFF, 0xC8, 0xFF),
             (0xA0, 0xFF, 0xF0, 0xFF), (0xA0, 0xA0, 0xA0, 0xFF), (0x00, 0x00, 0x00, 0xFF), (0x00, 0x00, 0x00, 0xFF),
         ]
+        self.colors_rgb = np.array(self.colors, dtype=np.uint8)[:, :3]
+        self.tiles = np.zeros((512, 8, 8), dtype=np.uint8)
+        self.dirty_tiles = set()
+        self.dirty_names = set()
+        self.palette_dirty = True
+        self.palette_rgb = np.zeros((32, 3), dtype=np.uint8)
+        self.background = np.zeros((480, 512), dtype=np.uint8)
+        self.drawn_pattern_table = None
+        self.scanline = 0
+        self.dot = 0
+        self.frame_count = 0
+        self.screen = np.zeros((240, 256, 3), dtype=np.uint8)
+        self.oam = bytearray(0x100)
+        self.evaluated_sprite_height = None
 
     def load_nes(self, nes: nf.NesFile):
-        self.memory[:0x2000] = nes.chr_rom
+        # 先按 NROM 的方式映射前 8KB，有 bank 切换的卡带之后由 mapper 重新映射
+        if len(nes.chr_rom) > 0:
+            memory = nes.chr_rom
+        else:
+            memory = memoryview(self.memory)
+        self.pattern_pages = [memory[i:i + 0x400] for i in range(0, 0x2000, 0x400)]
+        self.dirty_tiles.update(range(512))
+        self._refresh_tiles()
+        self.drawn_pattern_table = None
+        self.set_mirroring(nes.mirroring)
+
+    def save_state(self):
+        """
+        寄存器和锁存器、显存、OAM 依次拼成字节串，解码好的图样等缓存不保存
+        """
+        head = state_struct.pack(bytes(self.registers.values()), self.v, self.t, self.x, self.w, self.buffer,
+                                 self.scanline, self.dot, self.frame_count)
+        return b''.join((head, self.memory, self.oam))
+
+    def load_state(self, data: memoryview):
+        """
+        从 save_state 的结果恢复，返回用掉的字节数
+        """
+        registers, self.v, self.t, self.x, self.w, self.buffer, self.scanline, self.dot, self.frame_count = \
+            state_struct.unpack_from(data)
+        self.registers.update(zip(list(self.registers), registers))
+        size = state_struct.size
+        self.memory[:] = data[size:size + len(self.memory)]
+        size += len(self.memory)
+        self.oam[:] = data[size:size + len(self.oam)]
+        size += len(self.oam)
+        # 缓存全部作废，下次画的时候再重新计算
+        self.dirty_tiles.update(range(512))
+        self.drawn_pattern_table = None
+        self.palette_dirty = True
+        self.evaluated_sprite_height = None
+        return size
+
+    def set_pattern_pages(self, first: int, pages: List[memoryview]):
+        """
+        从第 first 页开始替换图样表的页，被换掉的页里的 64 个图样需要重新解码
+        """
+        for i, page in enumerate(pages):
+            slot = first + i
+            if self.pattern_pages[slot] is not page:
+                self.pattern_pages[slot] = page
+                self.dirty_tiles.update(range(slot * 64, slot * 64 + 64))
+
+    def set_mirroring(self, mirroring: str):
+        offsets = name_table_offsets[mirroring]
+        if offsets != self.name_table_offsets:
+            self.name_table_offsets = offsets
+            self.drawn_pattern_table = None
+
+    def _refresh_tiles(self):
+        # 只重新解码被写入过的图样，返回这些图样的编号
+        if not self.dirty_tiles:
+            return []
+        ids = sorted(self.dirty_tiles)
+        # 以页为单位解码，一页 64 个图样
+        for slot in sorted({i >> 6 for i in ids}):
+            patterns = np.frombuffer(self.pattern_pages[slot], dtype=np.uint8)
+            self.tiles[slot * 64:slot * 64 + 64] = tiles_from_patterns(patterns)
+        self.dirty_tiles.clear()
+        return ids
 
     def reg_value(self, name: str):
         n = name.upper()
@@ -82,12 +238,9 @@ class NesPPU(object):
 
         if n not in self.registers:
             raise ValueError('未知的寄存器：<{}>'.format(n))
-        if n in ('PPUADDR', 'PPUSCROLL'):
-            if value < 0 or value > 2 ** 16 - 1:
-                raise ValueError('<{}>超过了<{}>寄存器的取值范围'.format(value, n))
-        else:
-            if value < 0 or value > 2 ** 8 - 1:
-                raise ValueError('<{}>超过了<{}>寄存器的取值范围'.format(value, n))
+        # PPUSCROLL、PPUADDR 只保存最后一次写入的字节，地址在 loopy 寄存器里
+        if value < 0 or value > 2 ** 8 - 1:
+            raise ValueError('<{}>超过了<{}>寄存器的取值范围'.format(value, n))
 
         self.registers[n] = value
 
@@ -95,23 +248,64 @@ class NesPPU(object):
         # 镜像
         if 0x3000 <= addr <= 0x3eff:
             addr -= 0x1000
-        elif 0x3f20 <= addr <= 0x3fff:
-            addr -= 0x0020
-        elif addr in (0x3F10, 0x3F14, 0x3F18, 0x3F1C):
-            addr -= 0x0010
+        elif addr >= 0x3f00:
+            addr = 0x3f00 | (addr & 0x1f)
+            if addr in (0x3F10, 0x3F14, 0x3F18, 0x3F1C):
+                addr -= 0x0010
 
+        if addr < 0x2000:
+            return self.pattern_pages[addr >> 10][addr & 0x3ff]
+        elif addr < 0x3000:
+            addr = self.name_table_offsets[(addr >> 10) & 0b11] | (addr & 0x3ff)
         return self.memory[addr]
 
     def set_mem_value(self, addr: int, value: int):
         # 镜像
         if 0x3000 <= addr <= 0x3eff:
             addr -= 0x1000
-        elif 0x3f20 <= addr <= 0x3fff:
-            addr -= 0x0020
-        elif addr in (0x3F10, 0x3F14, 0x3F18, 0x3F1C):
-            addr -= 0x0010
+        elif addr >= 0x3f00:
+            addr = 0x3f00 | (addr & 0x1f)
+            if addr in (0x3F10, 0x3F14, 0x3F18, 0x3F1C):
+                addr -= 0x0010
+
+        if addr < 0x2000:
+            page = self.pattern_pages[addr >> 10]
+            if page.readonly:
+                # CHR-ROM 不能写入
+                return
+            page[addr & 0x3ff] = value
+            # CHR-RAM 被改写，对应的图样需要重新解码
+            self.dirty_tiles.add(addr >> 4)
+            return
+        elif addr < 0x3000:
+            addr = self.name_table_offsets[(addr >> 10) & 0b11] | (addr & 0x3ff)
 
         self.memory[addr] = value
+        if addr >= 0x3f00:
+            self.palette_dirty = True
+        elif addr >= 0x2000:
+            # 按物理名称表记录，画背景时再展开到映射到它的逻辑名称表
+            table = ((addr >> 10) & 0b11) << 10
+            offset = addr & 0x3ff
+            if offset < 0x3c0:
+                self.dirty_names.add(table | offset)
+            else:
+                self._mark_attribute_dirty(table, offset - 0x3c0)
+
+    def _mark_attribute_dirty(self, table: int, aid: int):
+        # 每个属性字节管理 4x4 个名称，最后一行属性只管理 2 行名称
+        top = (aid >> 3) * 4
+        left = (aid & 0b111) * 4
+        for row in range(top, min(top + 4, 30)):
+            begin = table | (row * 32 + left)
+            self.dirty_names.update(range(begin, begin + 4))
+
+    def _address_increment(self):
+        # PPUCTRL 的第 2 位为 1 时每次读写 PPUDATA 后地址加 32，即向下一行
+        if self.registers['PPUCTRL'] & 0b00000100:
+            return 32
+        else:
+            return 1
 
     def reg_value_for_cpu(self, addr: int):
         name = self.reg_mapper_for_cpu[addr]
@@ -119,7 +313,7 @@ class NesPPU(object):
         #     raise ValueError('CPU 不能读取<{}>寄存器'.format(name))
 
         if name == 'PPUDATA':
-            a = self.reg_value('ppuaddr')
+            a = self.v & 0x3fff
 
             if 0x3F00 <= a <= 0x3FFF:
                 v = self.mem_value(a)
@@ -129,7 +323,15 @@ class NesPPU(object):
                 v = self.buffer
                 self.buffer = self.mem_value(a)
 
-            self.set_reg_value('ppuaddr', a + 1)
+            self.v = (self.v + self._address_increment()) & 0x7fff
+            return v
+        elif name == 'OAMDATA':
+            return self.oam[self.registers['OAMADDR']]
+        elif name == 'PPUSTATUS':
+            # 读取后清除 VBlank 标志，并且重置 PPUSCROLL、PPUADDR 的写入开关
+            v = self.registers['PPUSTATUS']
+            self.registers['PPUSTATUS'] = v & 0b01111111
+            self.w = 0
             return v
         else:
             return self.reg_value(name)
@@ -140,29 +342,152 @@ class NesPPU(object):
         #     raise ValueError('CPU 不能写入<{}>寄存器'.format(name))
 
         if name == 'PPUDATA':
-            a = self.reg_value('ppuaddr')
-            self.set_mem_value(a, value)
-            self.set_reg_value('ppuaddr', a + 1)
-        elif name in self.reg_flag:
-            old_v = self.reg_value(name)
-            f = self.reg_flag[name]
-            self.reg_flag[name] = not f
-            if f:
-                self.set_reg_value(name, (old_v & 0x00ff) | (value << 8))
+            self.set_mem_value(self.v & 0x3fff, value)
+            self.v = (self.v + self._address_increment()) & 0x7fff
+        elif name == 'PPUSCROLL':
+            self.set_reg_value(name, value)
+            if self.w == 0:
+                # 第一次写入：粗略 X 和精细 X
+                self.t = (self.t & 0x7fe0) | (value >> 3)
+                self.x = value & 0b111
             else:
-                self.set_reg_value(name, (old_v & 0xff00) | value)
+                # 第二次写入：粗略 Y 和精细 Y
+                self.t = (self.t & 0x0c1f) | ((value & 0b111) << 12) | ((value & 0b11111000) << 2)
+            self.w ^= 1
+        elif name == 'PPUADDR':
+            self.set_reg_value(name, value)
+            if self.w == 0:
+                # 第一次写入地址的高 6 位，最高位被清除
+                self.t = (self.t & 0x00ff) | ((value & 0b00111111) << 8)
+            else:
+                self.t = (self.t & 0x7f00) | value
+                self.v = self.t
+            self.w ^= 1
+        elif name == 'OAMDATA':
+            a = self.registers['OAMADDR']
+            self.oam[a] = value
+            self.registers['OAMADDR'] = (a + 1) & 0xff
+            self.evaluated_sprite_height = None
+        elif name == 'PPUCTRL':
+            old_v = self.registers['PPUCTRL']
+            self.set_reg_value(name, value)
+            # 低 2 位是名称表的选择，也就是滚动坐标的第 8 位
+            self.t = (self.t & 0x73ff) | ((value & 0b11) << 10)
+            # VBlank 期间打开 NMI 会立即触发一次
+            if not old_v & 0b10000000 and self.can_nmi() and self.registers['PPUSTATUS'] & 0b10000000:
+                self._trigger_nmi()
         else:
             self.set_reg_value(name, value)
 
+    def write_oam_dma(self, data):
+        """
+        OAMDMA：把 CPU 的一页 256 字节一次性复制到 OAM，从 OAMADDR 开始，超出末尾后回到开头
+        """
+        begin = self.registers['OAMADDR']
+        size = 0x100 - begin
+        self.oam[begin:] = data[:size]
+        self.oam[:begin] = data[size:]
+        self.evaluated_sprite_height = None
+
+    def sprite_pattern_table(self):
+        # PPUCTRL 的第 3 位选择 8x8 精灵使用的图样表
+        if self.reg_value('ppuctrl') & 0b00001000:
+            return 0x1000
+        else:
+            return 0
+
+    def sprite_height(self):
+        # PPUCTRL 的第 5 位为 1 时精灵为 8x16
+        if self.reg_value('ppuctrl') & 0b00100000:
+            return 16
+        else:
+            return 8
+
+    def _evaluate_sprites(self):
+        """
+        一次算出每条扫描线要显示的精灵，每条扫描线最多 8 个，按 OAM 顺序优先
+        """
+        height = self.sprite_height()
+        if height == self.evaluated_sprite_height:
+            return
+        self.evaluated_sprite_height = height
+        # 精灵在 Y 坐标的下一条扫描线开始显示
+        top = np.frombuffer(self.oam, dtype=np.uint8)[0::4].astype(np.intp) + 1
+        lines = np.arange(240)[:, None]
+        in_range = (lines >= top) & (lines < top + height)
+        rank = np.cumsum(in_range, axis=1)
+        self.sprite_selected = in_range & (rank <= 8)
+        self.sprite_lines = in_range.any(axis=1).tolist()
+        self.sprite_overflow_lines = (rank[:, -1] > 8).tolist()
+
+    def _compose_sprites(self, y: int, background: np.ndarray, show_background: bool):
+        """
+        把第 y 条扫描线上的精灵合成到背景上，返回这一行的调色盘索引，shape 为 (256,)
+        background 为这一行背景的调色盘索引，0 表示透明
+        """
+        ids = np.flatnonzero(self.sprite_selected[y])
+        sprites = np.frombuffer(self.oam, dtype=np.uint8).reshape(64, 4)[ids].astype(np.intp)
+        top = sprites[:, 0] + 1
+        number = sprites[:, 1]
+        attr = sprites[:, 2]
+        x = sprites[:, 3]
+
+        height = self.evaluated_sprite_height
+        row = y - top
+        # 垂直翻转
+        row = np.where(attr & 0b10000000, height - 1 - row, row)
+        if height == 16:
+            # 8x16 的精灵由图样编号的最低位选择图样表，上下两个图样连续
+            tile = ((number & 1) << 8) | (number & 0xfe) | (row >> 3)
+        else:
+            tile = (self.sprite_pattern_table() >> 4) + number
+        pixels = self.tiles[tile, row & 0b111]
+        # 水平翻转
+        pixels = np.where((attr & 0b01000000)[:, None] != 0, pixels[:, ::-1], pixels)
+
+        # 每个精灵一行，第一个不透明的精灵优先，多出来的 8 列用于右边超出屏幕的部分
+        n = len(ids)
+        layer = np.zeros((n, 256 + 8), dtype=np.uint8)
+        palette = (0b10000 | ((attr & 0b11) << 2))[:, None]
+        layer[np.arange(n)[:, None], x[:, None] + np.arange(8)] = np.where(pixels != 0, palette | pixels, 0)
+        layer = layer[:, :256]
+        opaque = layer != 0
+        first = opaque.argmax(axis=0)
+        columns = np.arange(256)
+        sprite = layer[first, columns]
+        behind = (attr[first] & 0b00100000) != 0
+
+        if show_background and ids[0] == 0:
+            # sprite 0 hit：0 号精灵的不透明像素和背景的不透明像素重叠，不检查第 255 列
+            if (opaque[0, :255] & (background[:255] != 0)).any():
+                self.registers['PPUSTATUS'] |= 0b01000000
+
+        # 优先级：精灵在背景前面，或者背景透明时显示精灵
+        visible = (sprite != 0) & (~behind | (background == 0))
+        return np.where(visible, sprite, background)
+
+    def background_pattern_table(self):
+        # PPUCTRL 的第 4 位选择背景使用的图样表
+        if self.reg_value('ppuctrl') & 0b00010000:
+            return 0x1000
+        else:
+            return 0
+
     def color_from_xy(self, x: int, y: int):
-        # 获取所在名称
-        begin_of_name_table = 0x2000
+        # 按 t 和精细 X 的滚动坐标换算成 4 个名称表拼成的 512x480 图上的坐标
+        sx, sy = self.scroll_from_address(self.t, self.x)
+        x = (x + sx) % 512
+        y = (y + sy) % 480
+        # 获取所在名称表，以及在名称表内的坐标
+        begin_of_name_table = 0x2000 + ((x >> 8) | (y // 240) << 1) * 0x400
+        x &= 0xff
+        y %= 240
         name_per_line = 32
         size_of_name = 8
         name_id = (x // size_of_name) + (y // size_of_name) * name_per_line
         pattern_id = self.mem_value(begin_of_name_table + name_id)
         # 查找对应图样表
-        begin_of_pattern_table = 0
+        begin_of_pattern_table = self.background_pattern_table()
         width_of_pattern = 16
         height_of_pattern = 16
         bytes_per_pattern = width_of_pattern
@@ -172,9 +497,9 @@ class NesPPU(object):
         offset = y % (height_of_pattern // 2)
         p0 = self.mem_value(begin_of_p0 + offset)
         p1 = self.mem_value(begin_of_p1 + offset)
-        # X 坐标为字节内偏移
+        # X 坐标为字节内偏移，最左边的像素在最高位
         shift = x % 8
-        mask = 0x100 >> shift
+        mask = 0x80 >> shift
         # 计算低二位
         low = (0b00000001 if (p0 & mask) != 0 else 0) | (0b00000010 if (p1 & mask) != 0 else 0)
         # 计算所在属性表
@@ -184,21 +509,231 @@ class NesPPU(object):
         aoffset = ((x & 0x10) >> 3) | ((y & 0x10) >> 2)
         # 计算高两位
         high = (attr & (3 << aoffset)) >> aoffset << 2
-        # 合并作为调色盘索引
-        index_of_palette = high | low
+        # 合并作为调色盘索引，低两位为 0 的像素是透明的，显示背景色 $3F00
+        index_of_palette = high | low if low != 0 else 0
         # 从调色盘获取颜色编号
         begin_of_palette = 0x3f00
-        index_of_color = self.mem_value(begin_of_palette + index_of_palette)
+        index_of_color = self.mem_value(begin_of_palette + index_of_palette) & 0x3f
         return self.colors[index_of_color]
 
+    @staticmethod
+    def scroll_from_address(address: int, fine_x: int):
+        """
+        把 loopy 地址换算成 512x480 背景图上左上角的坐标 (x, y)
+        粗略 Y 为 30、31 时实际读到的是属性表，这里按回绕处理
+        """
+        x = ((address >> 10) & 1) * 256 + (address & 0b11111) * 8 + fine_x
+        y = ((address >> 11) & 1) * 240 + ((address >> 5) & 0b11111) * 8 + ((address >> 12) & 0b111)
+        return x, y % 480
+
+    def background_indices(self):
+        """
+        返回 shape 为 (480, 512) 的调色盘索引数组，只重画上一帧之后改动过的名称
+        """
+        self._compose_background()
+        return self.background
+
+    def _name_table_image(self):
+        """
+        把 4 个逻辑名称表拼成 (60, 64) 的名称和属性高两位
+        """
+        names = np.empty((60, 64), dtype=np.uint8)
+        high = np.empty((60, 64), dtype=np.uint8)
+        for i, offset in enumerate(self.name_table_offsets):
+            name_table = np.frombuffer(self.memory, dtype=np.uint8, count=0x400, offset=offset)
+            top = (i >> 1) * 30
+            left = (i & 1) * 32
+            names[top:top + 30, left:left + 32] = name_table[:32 * 30].reshape(30, 32)
+            # 每个属性字节管理 4x4 个名称
+            attrs = name_table[32 * 30:].reshape(8, 8).repeat(4, axis=0).repeat(4, axis=1)[:30]
+            high[top:top + 30, left:left + 32] = (attrs >> attribute_shifts) & 0b11
+        return names, high
+
+    def _dirty_cells(self):
+        # 把物理名称表里改动过的名称展开成背景图上的格子编号（行 * 64 + 列）
+        ids = np.fromiter(self.dirty_names, dtype=np.intp, count=len(self.dirty_names))
+        self.dirty_names.clear()
+        table = ids >> 10
+        ty = (ids & 0x3ff) >> 5
+        tx = ids & 0b11111
+        cells = []
+        for i, offset in enumerate(self.name_table_offsets):
+            selected = table == ((offset >> 10) & 0b11)
+            cells.append(((i >> 1) * 30 + ty[selected]) * 64 + (i & 1) * 32 + tx[selected])
+        return np.concatenate(cells)
+
+    def _compose_background(self):
+        names, high = self._name_table_image()
+        first = self.background_pattern_table() >> 4
+        changed_tiles = self._refresh_tiles()
+        if first != self.drawn_pattern_table:
+            # 切换了图样表或者镜像方式，重画整个背景
+            self.drawn_pattern_table = first
+            self.dirty_names.clear()
+            cells = np.arange(60 * 64)
+        else:
+            cells = self._dirty_cells()
+            if changed_tiles:
+                # 图样被改写后，所有引用它的名称都要重画
+                used = np.isin(names, np.array(changed_tiles) - first)
+                cells = np.union1d(cells, np.flatnonzero(used))
+
+        if len(cells) == 0:
+            return cells
+
+        ty = cells >> 6
+        tx = cells & 0b111111
+        # 直接使用解码好的图样
+        low = self.tiles[names[ty, tx].astype(np.intp) + first]
+        indices = np.where(low == 0, 0, (high[ty, tx][:, None, None] << 2) | low).astype(np.uint8)
+
+        # (480, 512) => (60, 8, 64, 8)，只写入改动过的 8x8 名称
+        self.background.reshape(60, 8, 64, 8)[ty, :, tx, :] = indices
+        return cells
+
+    def _refresh_palette(self):
+        # 调色盘只有 32 个颜色，改写后整个重新查一次颜色
+        palette = np.frombuffer(self.memory, dtype=np.uint8, count=0x20, offset=0x3f00) & 0x3f
+        self.palette_rgb = self.colors_rgb[palette]
+        self.palette_dirty = False
+
+    def _background_line(self, x: int, y: int):
+        # 从背景图里切出从 (x, y) 开始的 256 个像素，超出右边时回到左边
+        row = self.background[y]
+        if x <= 256:
+            return row[x:x + 256]
+        else:
+            return np.concatenate((row[x:], row[:x - 256]))
+
+    def frame_rgb(self):
+        """
+        返回 shape 为 (240, 256, 3) 的 RGB 画面，按 t 和精细 X 滚动
+        滚动只是从背景图里切出一块，调色盘被改写时只需要重新计算 32 个颜色
+        """
+        self._compose_background()
+        if self.palette_dirty:
+            self._refresh_palette()
+        x, y = self.scroll_from_address(self.t, self.x)
+        rows = self.background[y:y + 240]
+        if y > 240:
+            rows = np.concatenate((rows, self.background[:y - 240]))
+        if x <= 256:
+            indices = rows[:, x:x + 256]
+        else:
+            indices = np.concatenate((rows[:, x:], rows[:, :x - 256]), axis=1)
+        return self.palette_rgb[indices]
+
     def draw(self, canvas: pygame.Surface):
-        width, height = canvas.get_size()
+        # 画出按扫描线输出的画面，surfarray 的下标顺序是 (x, y)
+        pygame.surfarray.blit_array(canvas, self.screen.transpose(1, 0, 2))
+
+    def rendering_enabled(self):
+        # PPUMASK 的第 3、4 位分别打开背景和精灵
+        return (self.reg_value('ppumask') & 0b00011000) != 0
+
+    def step(self, dots: int):
+        """
+        前进 dots 个点，每条扫描线 341 个点，每帧 262 条扫描线
+        打开渲染时奇数帧的预渲染线少一个点，所以平均每帧 89341.5 个点，即 29780.5 个 CPU 周期
+        以扫描线为单位处理：可见扫描线结束时画出这一行，进入第 241 条扫描线时开始 VBlank，
+        进入第 261 条（预渲染线）时结束 VBlank
+        """
+        dot = self.dot + dots
+        while dot >= 341:
+            dot -= 341
+            scanline = self.scanline
+            if scanline < 240:
+                self._render_line(scanline)
+                if self.rendering_enabled():
+                    self._next_line_address()
+            scanline += 1
+            if scanline == 262:
+                scanline = 0
+                if self.rendering_enabled():
+                    # 预渲染线把 t 整个复制到 v，新的一帧从 t 的位置开始
+                    self.v = self.t
+                if self.frame_count & 1 and self.rendering_enabled():
+                    # 跳过奇数帧第 0 条扫描线的第 0 个点
+                    dot += 1
+                self.frame_count += 1
+            self.scanline = scanline
+            if scanline == 241:
+                self._start_vblank()
+            elif scanline == 261:
+                self._end_vblank()
+        self.dot = dot
+
+    def dots_to_event(self):
+        """
+        距离下一次进入 VBlank（可能触发 NMI）或者开始新的一帧还有多少个点
+        奇数帧可能跳过一个点，这里按少一个点算
+        """
+        if self.scanline < 241:
+            lines = 241 - self.scanline
+        else:
+            lines = 262 - self.scanline
+        return lines * 341 - self.dot - 1
+
+    def _next_line_address(self):
+        """
+        可见扫描线结束时 v 向下移动一行，并且从 t 复制水平方向的滚动
+        """
+        v = self.v
+        if (v & 0x7000) != 0x7000:
+            v += 0x1000
+        else:
+            v &= 0x0fff
+            coarse_y = (v >> 5) & 0b11111
+            if coarse_y == 29:
+                # 移到下面的名称表
+                coarse_y = 0
+                v ^= 0x0800
+            elif coarse_y == 31:
+                coarse_y = 0
+            else:
+                coarse_y += 1
+            v = (v & 0x7c1f) | (coarse_y << 5)
+        self.v = (v & 0x7be0) | (self.t & 0x041f)
+
+    def _render_line(self, y: int):
+        mask = self.registers['PPUMASK']
+        show_background = (mask & 0b00001000) != 0
+        show_sprites = (mask & 0b00010000) != 0
+        if not show_background and not show_sprites:
+            # 关闭渲染时显示背景色
+            self.screen[y] = self.colors_rgb[self.memory[0x3f00] & 0x3f]
+            return
+
+        # 只有显存改动过才需要重画背景，帧中途改动调色盘、名称表等只会影响之后的扫描线
+        if self.dirty_names or self.dirty_tiles or self.background_pattern_table() >> 4 != self.drawn_pattern_table:
+            self._compose_background()
+        if self.palette_dirty:
+            self._refresh_palette()
+
+        if show_background:
+            background = self._background_line(*self.scroll_from_address(self.v, self.x))
+        else:
+            background = np.zeros(256, dtype=np.uint8)
+        if show_sprites:
+            self._evaluate_sprites()
+            if self.sprite_overflow_lines[y]:
+                self.registers['PPUSTATUS'] |= 0b00100000
+            if self.sprite_lines[y]:
+                background = self._compose_sprites(y, background, show_background)
+        self.screen[y] = self.palette_rgb[background]
+
+    def _start_vblank(self):
+        self.registers['PPUSTATUS'] |= 0b10000000
+        if self.can_nmi():
+            self._trigger_nmi()
+
+    def _end_vblank(self):
+        # 同时清除 sprite 0 hit 和 sprite overflow
+        self.registers['PPUSTATUS'] &= 0b00011111
 
-        for y in range(height):
-            for x in range(width):
-                pos = x, y
-                color = self.color_from_xy(x, y)
-                canvas.set_at(pos, color)
+    def _trigger_nmi(self):
+        if self.nmi_callback is not None:
+            self.nmi_callback()
 
     def can_nmi(self):
         v = self.reg_value('ppuctrl')
@@ -212,3 +747,4 @@ class NesPPU(object):
             v |= mask
         else:
             v &= (~mask)
+        self.registers['PPUCTRL'] = v
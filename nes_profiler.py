@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import argparse
+import heapq
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import config
+import nes_cpu as nc
+import nes_file as nf
+import nes_scheduler as ns
+
+
+class NesProfiler(object):
+    """
+    指令级的性能分析：统计每个 PC、每种指令和每种寻址方式的执行次数，抽样统计每种指令在宿主机上的用时，
+    按 JSR/RTS 维护调用栈，统计每个调用栈用掉的 CPU 周期
+
+    分析时用 execute 代替 NesCPU.execute，NesCPU.execute 本身不做任何检查，不分析时没有开销
+    """
+
+    # 调用栈的最大深度，超过后只计数不记录，避免不返回的 JSR 让调用栈无限增长
+    max_depth = 64
+
+    def __init__(self, cpu: nc.NesCPU, sample_interval=8):
+        self.cpu = cpu
+        # 每隔多少条指令测一次用时，perf_counter 本身的开销比简单的指令还大
+        self.sample_interval = sample_interval
+        self.instructions = 0
+        self.cycles = 0
+        self.pc_counts = [0] * 0x10000
+        self.opcode_counts = [0] * 0x100
+        # 按操作码记录抽样的次数和总用时（秒）
+        self.opcode_samples = [0] * 0x100
+        self.opcode_time = [0.0] * 0x100
+        # 调用栈里是每一层的名字，stack_key 是它的元组，只在进出子程序时重新生成
+        self.stack: List[str] = []
+        self.stack_key: Tuple[str, ...] = ()
+        self.overflow = 0
+        self.stack_cycles: Dict[Tuple[str, ...], int] = {}
+        # 上一条指令执行后的 PC，下一条指令的 PC 和它不同说明中间进入了中断
+        self.next_pc = -1
+
+    def _push(self, frame: str):
+        if len(self.stack) < self.max_depth:
+            self.stack.append(frame)
+            self.stack_key = tuple(self.stack)
+        else:
+            self.overflow += 1
+
+    def _pop(self):
+        if self.overflow > 0:
+            self.overflow -= 1
+        elif self.stack:
+            self.stack.pop()
+            self.stack_key = tuple(self.stack)
+
+    def execute(self):
+        """
+        执行一条指令并记录，结果和 NesCPU.execute 完全一样
+        """
+        cpu = self.cpu
+        pc = cpu.pc
+        if pc != self.next_pc and self.next_pc >= 0:
+            self._push('int ${:04X}'.format(pc))
+        page = cpu.read_pages[pc >> 8]
+        # 在 I/O 区域执行代码时不读取操作码，读 I/O 寄存器有副作用
+        c = page[pc & 0xff] if page is not None else 0x02
+
+        cycles = cpu.cycles
+        self.instructions += 1
+        if self.instructions % self.sample_interval:
+            cpu.execute()
+        else:
+            begin = time.perf_counter()
+            cpu.execute()
+            self.opcode_time[c] += time.perf_counter() - begin
+            self.opcode_samples[c] += 1
+        used = cpu.cycles - cycles
+
+        self.cycles += used
+        self.pc_counts[pc] += 1
+        self.opcode_counts[c] += 1
+        # 调用和返回指令本身算在调用方的栈上
+        key = self.stack_key
+        self.stack_cycles[key] = self.stack_cycles.get(key, 0) + used
+        op = cpu.dispatch[c][0]
+        if op == 'JSR':
+            self._push('${:04X}'.format(cpu.pc))
+        elif op == 'BRK':
+            self._push('brk ${:04X}'.format(cpu.pc))
+        elif op == 'RTS' or op == 'RTI':
+            self._pop()
+        self.next_pc = cpu.pc
+
+    def attach(self, scheduler: ns.NesScheduler):
+        # 让调度器执行指令时经过分析器，打开 JIT 时编译好的块不经过这里
+        scheduler.execute = self.execute
+
+    def detach(self, scheduler: ns.NesScheduler):
+        scheduler.execute = scheduler.cpu.execute
+
+    def _grouped(self, index: int):
+        # 按 dispatch 表项的某一列（0 是指令名，1 是寻址方式）合并操作码的统计
+        groups: Dict[str, List] = {}
+        for c in range(0x100):
+            count = self.opcode_counts[c]
+            if count == 0:
+                continue
+            g = groups.setdefault(self.cpu.dispatch[c][index], [0, 0, 0.0])
+            g[0] += count
+            g[1] += self.opcode_samples[c]
+            g[2] += self.opcode_time[c]
+        return sorted(groups.items(), key=lambda item: item[1][0], reverse=True)
+
+    def report(self, top=20):
+        """
+        返回文本格式的平铺报告，用时是抽样的平均值，单位 ns
+        """
+        total = max(self.instructions, 1)
+        lines = ['{} instructions, {} cycles'.format(self.instructions, self.cycles), '', 'PC']
+        hot = heapq.nlargest(top, range(0x10000), key=self.pc_counts.__getitem__)
+        for pc in hot:
+            count = self.pc_counts[pc]
+            if count == 0:
+                break
+            page = self.cpu.read_pages[pc >> 8]
+            op = self.cpu.dispatch[page[pc & 0xff]][0] if page is not None else '???'
+            lines.append('  ${:04X} {:<4} {:>10} {:>7.2%}'.format(pc, op, count, count / total))
+
+        for title, index in (('OPCODE', 0), ('MODE', 1)):
+            lines.append('')
+            lines.append(title)
+            for name, (count, samples, used) in self._grouped(index):
+                mean = used / samples * 1e9 if samples else 0.0
+                lines.append('  {:<4} {:>10} {:>7.2%} {:>9.0f} ns'.format(name, count, count / total, mean))
+        return '\n'.join(lines)
+
+    def collapsed_stacks(self):
+        """
+        返回 flamegraph.pl、speedscope 等工具接受的折叠栈格式：每行是分号分隔的调用栈和它用掉的 CPU 周期
+        """
+        lines = []
+        for key, cycles in sorted(self.stack_cycles.items()):
+            lines.append('{} {}'.format(';'.join(('main',) + key), cycles))
+        return lines
+
+    def save_collapsed(self, path: str):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.collapsed_stacks()))
+            f.write('\n')
+
+
+def profile(nes: nf.NesFile, frames: int, sample_interval=8):
+    # 无界面运行指定的帧数，返回分析器
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    cpu.interrupt('reset')
+    scheduler = ns.NesScheduler(cpu)
+    profiler = NesProfiler(cpu, sample_interval)
+    profiler.attach(scheduler)
+    for _ in range(frames):
+        scheduler.run_frame()
+    profiler.detach(scheduler)
+    return profiler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='无界面运行 ROM，输出指令级的性能分析报告')
+    parser.add_argument('rom', help='ROM 文件路径')
+    parser.add_argument('--frames', type=int, default=600, help='运行多少帧')
+    parser.add_argument('--top', type=int, default=20, help='报告里列出最热的多少个 PC')
+    parser.add_argument('--sample-interval', type=int, default=8, help='每隔多少条指令测一次用时')
+    parser.add_argument('--collapsed', default=None, help='把折叠格式的调用栈保存到这个文件')
+    args = parser.parse_args(argv)
+
+    config.DEBUG = False
+    profiler = profile(nf.NesFile.load(args.rom), args.frames, args.sample_interval)
+    print(profiler.report(args.top))
+    if args.collapsed is not None:
+        profiler.save_collapsed(args.collapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
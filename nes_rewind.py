@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import collections
+import zlib
+from typing import Deque, NamedTuple, Optional
+
+import numpy as np
+
+import nes_scheduler as ns
+
+
+class Snapshot(NamedTuple):
+    # 保存时已经完成的帧数
+    frame: int
+    # 关键帧保存完整的状态，其余保存和前一个关键帧的 XOR 差异
+    keyframe: bool
+    # zlib 压缩后的数据
+    data: bytes
+
+
+class RewindBuffer(object):
+    """
+    倒带：每 interval 帧保存一次状态，每 keyframe_interval 个快照中有一个完整的关键帧
+    其余快照只保存和前一个关键帧的 XOR 差异，相邻几帧之间改动的字节很少，差异几乎全是 0，压缩后很小
+    所有快照放在环形缓冲区里，总大小超过 max_bytes 时从最旧的关键帧开始整组丢弃
+    """
+
+    def __init__(self, scheduler: ns.NesScheduler, interval=1, keyframe_interval=60, max_bytes=8 << 20, level=1):
+        self.scheduler = scheduler
+        self.ppu = scheduler.ppu
+        self.interval = interval
+        self.keyframe_interval = keyframe_interval
+        self.max_bytes = max_bytes
+        # zlib 的压缩等级，1 最快
+        self.level = level
+        self.snapshots: Deque[Snapshot] = collections.deque()
+        # 所有快照压缩后的总字节数
+        self.size = 0
+        self.keyframes = 0
+        # 最新的关键帧（未压缩）和它之后的快照数，用来计算新的差异
+        self.keyframe: Optional[np.ndarray] = None
+        self.since_keyframe = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def capture(self):
+        """
+        每帧结束后调用，到了保存的帧时保存一次，返回是否保存了
+        """
+        frame = self.ppu.frame_count
+        if frame % self.interval != 0:
+            return False
+        state = np.frombuffer(self.scheduler.save_state(), dtype=np.uint8)
+        if self.keyframe is None or self.since_keyframe >= self.keyframe_interval:
+            self.keyframe = state
+            self.since_keyframe = 0
+            self.keyframes += 1
+            snapshot = Snapshot(frame, True, zlib.compress(state, self.level))
+        else:
+            delta = np.bitwise_xor(state, self.keyframe)
+            snapshot = Snapshot(frame, False, zlib.compress(delta, self.level))
+        self.since_keyframe += 1
+        self.snapshots.append(snapshot)
+        self.size += len(snapshot.data)
+        self._evict()
+        return True
+
+    def _evict(self):
+        # 至少保留最新的一组，差异依赖的关键帧不能单独丢掉
+        snapshots = self.snapshots
+        while self.size > self.max_bytes and self.keyframes > 1:
+            snapshot = snapshots.popleft()
+            self.size -= len(snapshot.data)
+            self.keyframes -= 1
+            while not snapshots[0].keyframe:
+                self.size -= len(snapshots.popleft().data)
+
+    def _state(self, index: int):
+        # 解出第 index 个快照的完整状态
+        snapshots = self.snapshots
+        first = index
+        while not snapshots[first].keyframe:
+            first -= 1
+        keyframe = np.frombuffer(zlib.decompress(snapshots[first].data), dtype=np.uint8)
+        if first == index:
+            return keyframe
+        delta = np.frombuffer(zlib.decompress(snapshots[index].data), dtype=np.uint8)
+        return np.bitwise_xor(delta, keyframe)
+
+    def rewind(self):
+        """
+        回到当前帧之前最近的一个快照，并丢弃它和它之后的快照，返回回到的帧数，没有快照时返回 None
+        连续调用会一直向前回退，之后继续运行时重新开始保存
+        """
+        frame = self.ppu.frame_count
+        snapshots = self.snapshots
+        while snapshots and snapshots[-1].frame >= frame:
+            self._pop()
+        if not snapshots:
+            # 关键帧也被丢掉了，之后保存的第一个快照重新作为关键帧
+            self.keyframe = None
+            self.since_keyframe = 0
+            return None
+
+        state = self._state(len(snapshots) - 1)
+        snapshot = self._pop()
+        self.scheduler.load_state(state.tobytes())
+
+        # 丢掉的快照里可能有最新的关键帧，重新找到剩下的最后一组
+        self.keyframe = None
+        self.since_keyframe = 0
+        if snapshots:
+            last = len(snapshots) - 1
+            while not snapshots[last].keyframe:
+                last -= 1
+            self.keyframe = self._state(last)
+            self.since_keyframe = len(snapshots) - last
+        return snapshot.frame
+
+    def _pop(self):
+        snapshot = self.snapshots.pop()
+        self.size -= len(snapshot.data)
+        if snapshot.keyframe:
+            self.keyframes -= 1
+        return snapshot
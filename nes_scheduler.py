@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import nes_cpu as nc
+import nes_jit as nj
+
+
+# NTSC 的 CPU 频率，PPU 的频率是它的 3 倍
+cpu_frequency = 1789773
+dots_per_cycle = 3
+
+
+class NesScheduler(object):
+    """
+    按 CPU 周期同步 CPU 和 PPU：每执行一条指令，PPU 前进 3 倍于指令周期数的点
+    """
+
+    def __init__(self, cpu: nc.NesCPU, jit=False):
+        self.cpu = cpu
+        self.ppu = cpu.ppu
+        # PPU 已经追上的 CPU 周期数，中断用掉的周期在下一条指令时一起同步
+        self.synced_cycles = cpu.cycles
+        # 打开 JIT 时每一步可能执行整个编译好的基本块，PPU 在块结束后一起追上
+        # 访问 I/O 的指令总是由解释器单独执行，执行之前 PPU 已经同步，所以结果和逐条执行一样
+        self.jit = nj.NesJIT(cpu) if jit else None
+        # 上一步执行的指令条数
+        self.executed = 0
+        # 逐条执行指令的函数，性能分析时换成 NesProfiler.execute
+        self.execute = cpu.execute
+
+    def step(self):
+        """
+        执行一条指令（打开 JIT 时可能是一个基本块），返回同步给 PPU 的 CPU 周期数
+        """
+        cpu = self.cpu
+        if self.jit is None:
+            self.execute()
+            self.executed = 1
+        else:
+            # 基本块不能跨过进入 VBlank 和开始新一帧的时刻，否则 NMI 和 run_frame 的结束会比逐条执行时晚几条指令
+            budget = self.ppu.dots_to_event() // dots_per_cycle - (cpu.cycles - self.synced_cycles)
+            self.executed = self.jit.step(budget)
+        cycles = cpu.cycles - self.synced_cycles
+        self.synced_cycles = cpu.cycles
+        # 进入 VBlank 时 PPU 通过回调触发 CPU 的 NMI
+        self.ppu.step(cycles * dots_per_cycle)
+        return cycles
+
+    def save_state(self):
+        return self.cpu.save_state()
+
+    def load_state(self, data: bytes):
+        """
+        读档后周期数可能倒退，PPU 的进度已经在存档里，直接从读到的周期数开始同步
+        """
+        self.cpu.load_state(data)
+        self.synced_cycles = self.cpu.cycles
+
+    def run_frame(self):
+        """
+        一直执行到 PPU 画完当前帧，返回执行的指令条数
+        """
+        frame = self.ppu.frame_count
+        instructions = 0
+        while self.ppu.frame_count == frame:
+            self.step()
+            instructions += self.executed
+        return instructions
+
+    def run_cycles(self, cycles: int):
+        """
+        至少执行 cycles 个 CPU 周期，返回执行的指令条数
+        """
+        end = self.cpu.cycles + cycles
+        instructions = 0
+        while self.cpu.cycles < end:
+            self.step()
+            instructions += self.executed
+        return instructions
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import atexit
+import queue
+import struct
+import sys
+import threading
+from typing import Iterator, Optional, Tuple
+
+import config
+import opcodes_table
+from log_differ import LogDiffer
+
+
+# 一条指令的跟踪记录：PC, opcode, 地址（没有地址时为 -1）, A, X, Y, S, P
+record_struct = struct.Struct('<HBiBBBBB')
+size_of_record = record_struct.size
+
+
+class TraceWriter(object):
+    """
+    把指令的执行记录成定长的二进制格式，由后台线程批量写入文件
+    记录先写进预先分配好的块里，写满的块交给后台线程，写完后再还回来循环使用
+    执行指令的线程只做 pack_into，不会等待文件读写
+    """
+
+    def __init__(self, path: str, records_per_block=4096, blocks=16):
+        self.path = path
+        self.records_per_block = records_per_block
+        self.size_of_block = records_per_block * size_of_record
+        # 空闲的块
+        self.free_blocks: queue.SimpleQueue = queue.SimpleQueue()
+        for _ in range(blocks):
+            self.free_blocks.put(bytearray(self.size_of_block))
+        # 等待写入的块，(块, 字节数)，None 表示结束
+        self.filled_blocks: queue.SimpleQueue = queue.SimpleQueue()
+        self.block = self.free_blocks.get()
+        self.offset = 0
+        # 后台线程来不及写、临时新分配的块数
+        self.overflows = 0
+        self.closed = False
+
+        self.file = open(path, 'wb')
+        self.thread = threading.Thread(target=self._write_blocks, name='trace-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, pc: int, opcode: int, addr: int, a: int, x: int, y: int, s: int, p: int):
+        record_struct.pack_into(self.block, self.offset, pc, opcode, addr, a, x, y, s, p)
+        self.offset += size_of_record
+        if self.offset == self.size_of_block:
+            self._swap_block()
+
+    def _swap_block(self):
+        self.filled_blocks.put((self.block, self.offset))
+        try:
+            self.block = self.free_blocks.get_nowait()
+        except queue.Empty:
+            # 宁可多占内存也不阻塞模拟器
+            self.overflows += 1
+            self.block = bytearray(self.size_of_block)
+        self.offset = 0
+
+    def _write_blocks(self):
+        while True:
+            item = self.filled_blocks.get()
+            if item is None:
+                break
+            block, size = item
+            if block is None:
+                # flush 请求
+                self.file.flush()
+                size.set()
+                continue
+            self.file.write(memoryview(block)[:size])
+            self.free_blocks.put(block)
+        self.file.close()
+
+    def flush(self):
+        """
+        把当前未写满的块交给后台线程，并等到所有记录都落盘
+        只在需要读取跟踪文件时调用
+        """
+        if self.closed:
+            return
+        if self.offset > 0:
+            self._swap_block()
+        done = threading.Event()
+        self.filled_blocks.put((None, done))
+        done.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.offset > 0:
+            self._swap_block()
+        self.closed = True
+        self.filled_blocks.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+
+_tracer: Optional[TraceWriter] = None
+
+
+def tracer():
+    """
+    整个进程共用一个 TraceWriter，第一次使用时才创建，config.TRACE_PATH 改变后换成新文件
+    """
+    global _tracer
+    if _tracer is None or _tracer.closed or _tracer.path != config.TRACE_PATH:
+        if _tracer is not None:
+            _tracer.close()
+        _tracer = TraceWriter(config.TRACE_PATH)
+    return _tracer
+
+
+def records_from_file(path: str) -> Iterator[Tuple[int, ...]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    yield from record_struct.iter_unpack(data)
+
+
+def info_from_record(record: Tuple[int, ...]):
+    pc, opcode, addr, a, x, y, s, p = record
+    info = {
+        'PC': pc,
+        'op': opcodes_table.opcodes[opcode][0],
+        'address': addr,
+        'A': a,
+        'X': x,
+        'Y': y,
+        'S': s,
+        'P': p,
+    }
+    return info
+
+
+def line_from_record(record: Tuple[int, ...]):
+    return LogDiffer.log_line_from_info(info_from_record(record))
+
+
+def main(argv=None):
+    # 用法：python nes_trace.py [nes.trace]，把二进制记录转成文本输出
+    args = sys.argv[1:] if argv is None else argv
+    path = args[0] if args else config.TRACE_PATH
+    for record in records_from_file(path):
+        print(line_from_record(record))
+
+
+if __name__ == '__main__':
+    main()
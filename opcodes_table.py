@@ -257,3 +257,44 @@ opcodes = {
     0xFE: ('INC', 'ABX'),
     0xFF: ('ISB', 'ABX'),
 }
+
+# 每个 opcode 的基本周期数，下标为 opcode
+cycles = [
+    7, 6, 2, 8, 3, 3, 5, 5, 3, 2, 2, 2, 4, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+    6, 6, 2, 8, 3, 3, 5, 5, 4, 2, 2, 2, 4, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+    6, 6, 2, 8, 3, 3, 5, 5, 3, 2, 2, 2, 3, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+    6, 6, 2, 8, 3, 3, 5, 5, 4, 2, 2, 2, 5, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+    2, 6, 2, 6, 3, 3, 3, 3, 2, 2, 2, 2, 4, 4, 4, 4,
+    2, 6, 2, 6, 4, 4, 4, 4, 2, 5, 2, 5, 5, 5, 5, 5,
+    2, 6, 2, 6, 3, 3, 3, 3, 2, 2, 2, 2, 4, 4, 4, 4,
+    2, 5, 2, 5, 4, 4, 4, 4, 2, 4, 2, 4, 4, 4, 4, 4,
+    2, 6, 2, 8, 3, 3, 5, 5, 2, 2, 2, 2, 4, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+    2, 6, 2, 8, 3, 3, 5, 5, 2, 2, 2, 2, 4, 4, 6, 6,
+    2, 5, 2, 8, 4, 4, 6, 6, 2, 4, 2, 7, 4, 4, 7, 7,
+]
+
+# 只读内存的指令在 ABX、ABY、INY 寻址跨页时多用 1 个周期
+# 写内存和读改写的指令的周期数已经按跨页计算，不再额外增加
+page_cross_ops = {
+    'ADC', 'AND', 'CMP', 'EOR', 'LDA', 'LDX', 'LDY', 'ORA', 'SBC',
+    'LAX', 'LAS', 'NOP',
+}
+page_cross_modes = {'ABX', 'ABY', 'INY'}
+
+# 寻址模式 => 指令里操作数的字节数
+operand_sizes = {
+    'IMP': 0,
+    'IMM': 1, 'ZPG': 1, 'ZPX': 1, 'ZPY': 1, 'INX': 1, 'INY': 1, 'REL': 1,
+    'ABS': 2, 'ABX': 2, 'ABY': 2, 'IND': 2,
+}
+
+# 会改变执行流程的指令，基本块在这些指令之后结束
+block_end_ops = {
+    'JMP', 'JSR', 'RTS', 'RTI', 'BRK', 'KIL',
+    'BPL', 'BMI', 'BVC', 'BVS', 'BCC', 'BCS', 'BNE', 'BEQ',
+}
@@ -1,20 +1,55 @@
 # -*- coding: utf-8 -*-
+import argparse
+
 import pygame as pg
 
 import nes_cpu as nc
+import nes_controller as nco
 import nes_file as nf
+import nes_movie as nm
+import nes_rewind as nr
+import nes_scheduler as ns
 import utils
 
 
-def main():
+# 键盘 => 1 号手柄的按键
+keys = {
+    pg.K_j: 'A',
+    pg.K_k: 'B',
+    pg.K_RSHIFT: 'SELECT',
+    pg.K_RETURN: 'START',
+    pg.K_w: 'UP',
+    pg.K_s: 'DOWN',
+    pg.K_a: 'LEFT',
+    pg.K_d: 'RIGHT',
+}
+
+
+def pressed_buttons():
+    pressed = pg.key.get_pressed()
+    value = 0
+    for key, name in keys.items():
+        if pressed[key]:
+            value |= nco.buttons[name]
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='运行 ROM')
+    parser.add_argument('rom', nargs='?', default='misc/nestest.nes', help='ROM 文件路径')
+    parser.add_argument('--record', default=None, help='把按键录成录像，退出时保存到这个文件')
+    parser.add_argument('--check-every', type=int, default=60, help='录像时每隔多少帧记录一次画面和 RAM 的哈希')
+    parser.add_argument('--jit', action='store_true', help='把经常执行的基本块编译成 Python 函数')
+    args = parser.parse_args(argv)
+
     width, height = 256, 240
     screen = pg.display.set_mode((width, height))
     clock = pg.time.Clock()
     running = True
-    fps = 30
+    fps = 60
     # scale = 10
 
-    nes = nf.NesFile.load('misc/nestest.nes')
+    nes = nf.NesFile.load(args.rom)
     cpu = nc.NesCPU()
     cpu.load_nes(nes)
 
@@ -22,17 +57,24 @@ def main():
     # for _ in range(20000):
     #     cpu.execute()
 
-    draw_counter = 0
+    scheduler = ns.NesScheduler(cpu, jit=args.jit)
+    rewind = nr.RewindBuffer(scheduler)
+    movie = nm.Movie(nm.rom_sha1(nes)) if args.record else None
 
     while running:
-        cpu.execute()
-
-        if draw_counter < 10000:
-            draw_counter += 1
-            continue
-        draw_counter = 0
-
-        cpu.interrupt('nmi')
+        # 按住退格键倒带：回到上一个快照，再运行一帧画出那时的画面
+        # 录像时不能倒带，否则录下的按键和画面对不上
+        rewinding = movie is None and pg.key.get_pressed()[pg.K_BACKSPACE] and rewind.rewind() is not None
+        buttons = pressed_buttons()
+        cpu.controllers[0].set_buttons(buttons)
+        # 按 PPU 的时序运行一帧，进入 VBlank 时由调度器触发 NMI
+        scheduler.run_frame()
+        if movie is not None:
+            movie.add_frame(buttons)
+            if cpu.ppu.frame_count % args.check_every == 0:
+                movie.add_check(cpu)
+        if not rewinding:
+            rewind.capture()
         cpu.draw(screen)
         # for idx, code in enumerate(memory):
         #     x = idx % 10
@@ -52,6 +94,9 @@ def main():
         pg.display.flip()
         clock.tick(fps)
 
+    if movie is not None:
+        movie.save(args.record)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import batch
+
+
+def test_run_rom():
+    job = ('misc/nestest.nes', 1, 2000)
+    summary = batch.run_rom(job)
+
+    expected = (2000, None)
+    result = (summary['instructions'], summary['error'])
+    assert expected == result, summary
+
+    expected = summary
+    result = batch.run_rom(job)
+    result['wall_time'] = expected['wall_time']
+    assert expected == result, result
+
+
+def test_run_rom_error():
+    job = ('misc/not_exists.nes', 1, None)
+    summary = batch.run_rom(job)
+
+    expected = 0
+    result = summary['instructions']
+    assert expected == result, summary
+    assert summary['error'].startswith('FileNotFoundError'), summary
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+
+import benchmark as bm
+
+
+def test_regressions():
+    baseline = {
+        'nestest by table': [1000000.0, 'instructions/s'],
+        'rom load': [20.0, 'us'],
+        'ppu frame': [5000.0, 'frames/s'],
+    }
+    results = {
+        'nestest by table': (700000.0, 'instructions/s'),
+        'rom load': (22.0, 'us'),
+        'ppu frame': (6000.0, 'frames/s'),
+        # 基线里没有的指标不比较
+        'trace diff': (1.0, 'records/s'),
+    }
+    # 每秒的指令数变少、用时变长都算变差，只有超过阈值的才算退化
+    expected = ['nestest by table']
+    result = [name for name, _, _, _ in bm.regressions(baseline, results, 0.25)]
+    assert expected == result, result
+    expected = ['nestest by table', 'rom load']
+    result = [name for name, _, _, _ in bm.regressions(baseline, results, 0.05)]
+    assert expected == result, result
+
+
+def test_append_history():
+    path = os.path.join(tempfile.mkdtemp(), 'history.json')
+    for i in range(2):
+        bm.append_history(path, {'rom load': (20.0 + i, 'us')}, {'A9 LDA IMM': 200.0})
+
+    with open(path) as f:
+        history = json.load(f)
+    expected = [[20.0, 'us'], [21.0, 'us']]
+    result = [h['results']['rom load'] for h in history]
+    assert expected == result, result
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import log_differ as ld
+
+
+def test_golden_from_json():
+    path = os.path.join(tempfile.mkdtemp(), 'nestest_log.bin')
+    ld.golden_from_json('misc/nestest_log.json', path)
+
+    # 提交的二进制日志和 JSON 日志一致
+    with open(path, 'rb') as f, open('misc/nestest_log.bin', 'rb') as g:
+        assert f.read() == g.read()
+
+    logs = ld.logs_from_json('misc/nestest_log.json')
+    differ = ld.GoldenLogDiffer.from_golden(path)
+    expected = logs
+    result = [ld.info_from_golden_record(r) for r in differ.records()]
+    assert expected == result
+
+
+def test_golden_diff():
+    differ = ld.GoldenLogDiffer.from_golden('misc/nestest_log.bin')
+    info = dict(PC=0xc000, op='JMP', address=0xc5f5, A=0, X=0, Y=0, P=0x24, S=0xfd)
+    differ.diff(info)
+
+    info = dict(PC=0xc5f5, op='LDX', address=0, A=0, X=1, Y=0, P=0x24, S=0xfd)
+    try:
+        differ.diff(info)
+    except AssertionError as e:
+        message = str(e)
+    else:
+        assert False, 'X should not match'
+
+    expected = [
+        'expect: C5F5 LDX 0000 A:00 X:00 Y:00 S:FD P:0010 0100 ',
+        'result: C5F5 LDX 0000 A:00 X:01 Y:00 S:FD P:0010 0100 ',
+    ]
+    result = message.split('\n')[2:4]
+    assert expected == result, message
+
+
+def test_golden_all_passed():
+    differ = ld.GoldenLogDiffer.from_golden('misc/nestest_log.bin')
+    differ.cursor = differ.count
+    try:
+        differ.pop_log()
+    except ld.AllTestsPassed:
+        pass
+    else:
+        assert False, differ.cursor
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import nes_controller as nco
+import nes_cpu as nc
+
+
+def read_buttons(cpu, addr: int, count: int):
+    return [cpu.mem_value(addr) & 1 for _ in range(count)]
+
+
+def test_strobe():
+    cpu = nc.NesCPU()
+    cpu.controllers[0].set_buttons(nco.buttons['A'] | nco.buttons['START'] | nco.buttons['RIGHT'])
+    cpu.controllers[1].set_buttons(nco.buttons['B'])
+
+    # strobe 为 1 时一直读到 A
+    cpu.set_mem_value(0x4016, 1)
+    expected = [1, 1, 1]
+    result = read_buttons(cpu, 0x4016, 3)
+    assert expected == result, result
+
+    # strobe 变为 0 后按 A、B、Select、Start、上、下、左、右的顺序读出，之后一直是 1
+    cpu.set_mem_value(0x4016, 0)
+    expected = ([1, 0, 0, 1, 0, 0, 0, 1, 1, 1], [0, 1, 0, 0, 0, 0, 0, 0, 1])
+    result = (read_buttons(cpu, 0x4016, 10), read_buttons(cpu, 0x4017, 9))
+    assert expected == result, result
+
+
+def test_latch():
+    cpu = nc.NesCPU()
+    controller = cpu.controllers[0]
+    cpu.set_mem_value(0x4016, 1)
+    cpu.set_mem_value(0x4016, 0)
+    # 装载之后再改按键，要到下一次 strobe 才能读到
+    controller.set_buttons(nco.buttons['A'])
+    expected = (0x40, [0] * 7)
+    result = (cpu.mem_value(0x4016), read_buttons(cpu, 0x4016, 7))
+    assert expected == result, result
+
+    cpu.set_mem_value(0x4016, 1)
+    cpu.set_mem_value(0x4016, 0)
+    expected = 0x41
+    result = cpu.mem_value(0x4016)
+    assert expected == result, result
@@ -3,6 +3,7 @@
 import nes_cpu as nc
 import test_nes_file as nft
 import log_differ as ld
+import nes_scheduler as ns
 from utils import number_from_bytes
 
 
@@ -30,6 +31,25 @@ def test_register():
         assert expected == result, (case, result)
 
 
+def test_register_out_of_range():
+    cpu = nc.NesCPU()
+    test_cases = [
+        ('pc', 2 ** 16),
+        ('a', 256),
+        ('s', -1),
+        ('q', 0),
+    ]
+    for case in test_cases:
+        name = case[0]
+        value = case[1]
+        try:
+            cpu.set_reg_value(name, value)
+        except ValueError:
+            pass
+        else:
+            assert False, case
+
+
 def test_load_nes():
     nes = nft.prepared_nes()
     cpu = nc.NesCPU()
@@ -48,7 +68,7 @@ def address_for_log_info(addr):
 
 
 def test_by_log_differ():
-    differ = ld.LogDiffer.from_json('misc/nestest_log.json')
+    differ = ld.GoldenLogDiffer.from_golden('misc/nestest_log.bin')
     nes = nft.prepared_nes()
     cpu = nc.NesCPU()
     cpu.load_nes(nes)
@@ -130,6 +150,31 @@ def test_set_flag():
     assert expected == result, result
 
 
+def test_lazy_flags(debug):
+    cpu = nc.NesCPU()
+    for p in range(0x100):
+        cpu.set_reg_value('p', p)
+        expected = p
+        result = cpu.reg_value('p')
+        assert expected == result, result
+
+    # BIT 之后 N 和 Z 可以同时为 1，和普通运算结果记下的 N/Z 不同
+    cpu.set_reg_value('p', 0x24)
+    cpu.a = 0x01
+    cpu.ram[0x10] = 0xc0
+    cpu._op_bit(0x10, 'ZPG')
+    expected = (True, True, True, 0b11100110)
+    result = (cpu.flag('N'), cpu.flag('V'), cpu.flag('Z'), cpu.reg_value('p'))
+    assert expected == result, result
+
+    # CMP 只改 N/Z/C，压栈时才合并出完整的 P
+    cpu._compare(0x01, 0x02)
+    cpu._op_php(None, 'IMP')
+    expected = 0b11110100
+    result = cpu.pop()
+    assert expected == result, result
+
+
 def test_push_pop1():
     cpu = nc.NesCPU()
     cpu.push(1)
@@ -161,6 +206,213 @@ def test_push():
     assert expected == result, result
 
 
+def test_ram_mirror():
+    cpu = nc.NesCPU()
+    test_cases = [
+        (0x0000, 0x0800),
+        (0x0001, 0x1001),
+        (0x07ff, 0x1fff),
+        (0x1234, 0x0234),
+    ]
+    for i, case in enumerate(test_cases):
+        waddr = case[0]
+        raddr = case[1]
+        cpu.set_mem_value(waddr, i + 1)
+        expected = i + 1
+        result = cpu.mem_value(raddr)
+        assert expected == result, (case, result)
+
+
+def test_ppu_register_mirror():
+    cpu = nc.NesCPU()
+    # $3456 对应 $2006 (PPUADDR)
+    cpu.set_mem_value(0x3456, 0x21)
+    cpu.set_mem_value(0x2006, 0x08)
+    # $2FFF 对应 $2007 (PPUDATA)
+    cpu.set_mem_value(0x2fff, 7)
+
+    expected = 7
+    result = cpu.ppu.mem_value(0x2108)
+    assert expected == result, result
+
+
+def test_prg_rom_mirror():
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    for addr in (0x0000, 0x1234, 0x3ffc):
+        expected = nes.prg_rom[addr]
+        result = [cpu.mem_value(0x8000 + addr), cpu.mem_value(0xc000 + addr)]
+        assert [expected, expected] == result, (addr, result)
+
+
+def test_cycles_nestest(debug):
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    cpu.set_reg_value('pc', 0xc000)
+    cpu.set_reg_value('p', 0x24)
+    # nestest.log 从第 7 个周期开始，最后一条指令 C66E 在第 26554 个周期
+    cpu.cycles = 7
+    for _ in range(8990):
+        cpu.execute()
+
+    expected = (0xc66e, 26554)
+    result = (cpu.pc, cpu.cycles)
+    assert expected == result, result
+
+
+def run_program(program, **registers):
+    # 把程序放到 RAM 的 $0200 开始执行，零页的 $10、$11 存放间接寻址用的地址 $01F0
+    cpu = nc.NesCPU()
+    cpu.ram[0x10:0x12] = bytes([0xf0, 0x01])
+    cpu.ram[0x200:0x200 + len(program)] = bytes(program)
+    cpu.pc = 0x200
+    for name, value in registers.items():
+        setattr(cpu, name, value)
+    cpu.execute()
+    return cpu
+
+
+def test_cycles_page_cross(debug):
+    test_cases = [
+        # LDA $01F0,X 不跨页 / 跨页
+        ([0xbd, 0xf0, 0x01], dict(x=0x0f), 4),
+        ([0xbd, 0xf0, 0x01], dict(x=0x10), 5),
+        # LDA ($10),Y 跨页
+        ([0xb1, 0x10], dict(y=0x10), 6),
+        # STA $01F0,X 不论是否跨页都是 5 个周期
+        ([0x9d, 0xf0, 0x01], dict(x=0x10), 5),
+    ]
+    for program, registers, cycles in test_cases:
+        cpu = run_program(program, **registers)
+        expected = cycles
+        result = cpu.cycles
+        assert expected == result, (program, registers, result)
+
+
+def test_cycles_branch(debug):
+    test_cases = [
+        # BNE 不跳转 / 跳转 / 跳转到另一页
+        ([0xd0, 0x10], 0b00000010, 2),
+        ([0xd0, 0x10], 0, 3),
+        ([0xd0, 0xf0], 0, 4),
+    ]
+    for program, p, cycles in test_cases:
+        cpu = run_program(program, p=p)
+        expected = cycles
+        result = cpu.cycles
+        assert expected == result, (program, p, result)
+
+
+def test_operand_page_boundary(debug):
+    # LDA $0123 的两个操作数字节分别在 $02FF 和 $0300
+    cpu = nc.NesCPU()
+    cpu.ram[0x2fe:0x301] = bytes([0xad, 0x23, 0x01])
+    cpu.ram[0x123] = 7
+    cpu.pc = 0x2fe
+    cpu.execute()
+    expected = (7, 0x301)
+    result = (cpu.a, cpu.pc)
+    assert expected == result, result
+
+
+def test_adc_sbc_overflow(debug):
+    # 结果正好是 +128 时溢出，正好是 -128 时不溢出
+    test_cases = [
+        # ADC #$01: $7F + $01 = +128
+        ([0x69, 0x01], dict(a=0x7f, c=0), (0x80, True, False)),
+        # ADC #$81: -1 + -127 = -128
+        ([0x69, 0x81], dict(a=0xff, c=0), (0x80, False, True)),
+        # SBC #$80: 0 - (-128) = +128
+        ([0xe9, 0x80], dict(a=0x00, c=1), (0x80, True, False)),
+        # SBC #$01: -127 - 1 = -128
+        ([0xe9, 0x01], dict(a=0x81, c=1), (0x80, False, True)),
+    ]
+    for program, registers, expected in test_cases:
+        cpu = run_program(program, **registers)
+        result = (cpu.a, cpu.flag('V'), cpu.flag('C'))
+        assert expected == result, (program, registers, result)
+
+
+def test_decoded_block(debug):
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    # 第一次经过只做标记，第二次才解码
+    for _ in range(2):
+        cpu.set_reg_value('pc', 0xc000)
+        cpu.execute()
+
+    # C000 JMP $C5F5 自己就是一个基本块
+    expected = ([0xc000], (0x4c, 'ABS', None, 0xc5f5, 0xc003, 3))
+    entry = cpu.decoded[0xc000]
+    result = (cpu.blocks[0xc000], (entry[0], entry[2], entry[3], entry[4], entry[5], entry[6]))
+    assert expected == result, result
+
+
+def test_self_modifying_code(debug):
+    # LDA #$05; INC $0A01（通过镜像改写 LDA 的操作数）; JMP $0200
+    cpu = nc.NesCPU()
+    cpu.ram[0x200:0x208] = bytes([0xa9, 0x05, 0xee, 0x01, 0x0a, 0x4c, 0x00, 0x02])
+    cpu.pc = 0x200
+    # 第二圈解码出操作数 6，INC 写入受保护的代码页使缓存作废，第四圈重新解码
+    for _ in range(10):
+        cpu.execute()
+
+    # 重新解码后操作数变成 8，代码页再次受保护
+    expected = (8, 0x202, 8, None)
+    result = (cpu.a, cpu.pc, cpu.decoded[0x200][4], cpu.write_pages[0x0a])
+    assert expected == result, result
+
+
+def test_invalidate_pages(debug):
+    # LDA #$05; JMP $0200
+    cpu = nc.NesCPU()
+    cpu.ram[0x200:0x205] = bytes([0xa9, 0x05, 0x4c, 0x00, 0x02])
+    cpu.pc = 0x200
+    for _ in range(6):
+        cpu.execute()
+
+    # 直接改写 RAM 不经过页表，缓存还在，调用 invalidate_pages 之后重新解码
+    cpu.ram[0x201] = 0x09
+    cpu.invalidate_pages(0x02)
+    for _ in range(6):
+        cpu.execute()
+    expected = (9, 9, 0x200)
+    result = (cpu.a, cpu.decoded[0x200][4], cpu.pc)
+    assert expected == result, result
+
+
+def test_oam_dma():
+    cpu = nc.NesCPU()
+    data = bytes(range(256))
+    cpu.ram[0x200:0x300] = data
+    # 从 OAMADDR 开始写入，超出末尾后回到开头
+    cpu.set_mem_value(0x2003, 0x10)
+    cpu.cycles = 1
+    cpu.set_mem_value(0x4014, 0x02)
+
+    expected = (data[0xf0:] + data[:0xf0], 1 + 514)
+    result = (bytes(cpu.ppu.oam), cpu.cycles)
+    assert expected == result, result
+
+
+def test_load_state_version():
+    cpu = nc.NesCPU()
+    cpu.load_nes(nft.prepared_nes())
+    state = bytearray(cpu.save_state())
+    cpu.load_state(state)
+    # 版本号在魔数之后
+    state[8] += 1
+    try:
+        cpu.load_state(state)
+    except ValueError:
+        pass
+    else:
+        assert False, 'state of another version should be rejected'
+
+
 def test_ppu():
     nes = nft.prepared_nes()
     cpu = nc.NesCPU()
@@ -171,8 +423,10 @@ def test_ppu():
     reset = number_from_bytes([rl, rh])
     cpu.set_reg_value('pc', reset)
 
-    for _ in range(20000):
-        cpu.execute()
+    # nestest 会等待 VBlank，需要按周期同步 PPU，运行几帧直到画出菜单
+    scheduler = ns.NesScheduler(cpu)
+    for _ in range(10):
+        scheduler.run_frame()
 
     expected = [
         32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32, 32,
@@ -216,5 +470,7 @@ def test_ppu():
         0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
         0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
     ]
-    result = cpu.ppu.memory[0x2000:0x2400]
+    # VBlank 时的 NMI 会在第 4 行第 2 列画出选择测试的光标
+    expected[4 * 32 + 2] = ord('*')
+    result = list(cpu.ppu.memory[0x2000:0x2400])
     assert expected == result, result
@@ -27,6 +27,63 @@ def test_load3():
     assert expected == result, result
 
 
+def test_load_zero_copy():
+    nes = prepared_nes()
+    for rom in (nes.prg_rom, nes.chr_rom):
+        expected = (memoryview, True)
+        result = (type(rom), rom.readonly)
+        assert expected == result, result
+
+
+def test_load_without_mmap():
+    nes = prepared_nes()
+    loaded = nf.NesFile.load('misc/nestest.nes', use_mmap=False)
+    expected = (nes.prg_rom, nes.chr_rom)
+    result = (loaded.prg_rom, loaded.chr_rom)
+    assert expected == result
+
+
+def nes_data(header: bytes, prg_banks: int, chr_banks: int, trainer=b''):
+    # 每个 bank 用自己的编号填满，方便检查映射
+    prg = b''.join(bytes([i]) * 16384 for i in range(prg_banks))
+    chr_ = b''.join(bytes([0x80 | i]) * 8192 for i in range(chr_banks))
+    return header + trainer + prg + chr_
+
+
+def test_header_ines():
+    # mapper 1，垂直镜像，有电池和 trainer
+    header = b'NES\x1a' + bytes([4, 2, 0b00010111, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+    nes = nf.NesFile(nes_data(header, 4, 2, trainer=b'\x5a' * 512))
+
+    expected = (False, 1, 'vertical', True, 0x2000, 0)
+    result = (nes.nes2, nes.mapper, nes.mirroring, nes.battery, nes.prg_ram_size, nes.chr_ram_size)
+    assert expected == result, result
+
+    expected = (512, 0x5a, 4 * 16384, 0, 2 * 8192, 0x80)
+    result = (len(nes.trainer), nes.trainer[0], len(nes.prg_rom), nes.prg_rom[0], len(nes.chr_rom), nes.chr_rom[0])
+    assert expected == result, result
+
+
+def test_header_ines_dirty_flags7():
+    # 字节 12-15 不为 0 时忽略 Flags 7 里的 mapper 高位
+    header = b'NES\x1a' + bytes([1, 0, 0x20, 0x40]) + b'\x00\x00\x00\x00Dude'
+    nes = nf.NesFile(nes_data(header, 1, 0))
+
+    expected = (2, 0x2000)
+    result = (nes.mapper, nes.chr_ram_size)
+    assert expected == result, result
+
+
+def test_header_nes2():
+    # mapper 0x123，子 mapper 5，四屏镜像，PRG-RAM 8KB + 电池 PRG-RAM 8KB，CHR-RAM 32KB
+    header = b'NES\x1a' + bytes([2, 0, 0b00111000, 0b00101000, 0x51, 0, 0x77, 0x09, 0, 0, 0, 0])
+    nes = nf.NesFile(nes_data(header, 2, 0))
+
+    expected = (True, 0x123, 5, 'four_screen', 0x4000, 0x8000, 2 * 16384)
+    result = (nes.nes2, nes.mapper, nes.submapper, nes.mirroring, nes.prg_ram_size, nes.chr_ram_size, len(nes.prg_rom))
+    assert expected == result, result
+
+
 def test_bytes_to_int_list():
     test_cases = [
         (b'', []),
@@ -44,6 +101,11 @@ def test():
     test_load1()
     test_load2()
     test_load3()
+    test_load_zero_copy()
+    test_load_without_mmap()
+    test_header_ines()
+    test_header_ines_dirty_flags7()
+    test_header_nes2()
     test_bytes_to_int_list()
 
 
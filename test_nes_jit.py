@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import log_differ as ld
+import nes_cpu as nc
+import nes_jit as nj
+import nes_scheduler as ns
+import test_nes_file as nft
+import test_nes_scheduler as tns
+
+
+def test_by_log_differ():
+    differ = ld.GoldenLogDiffer.from_golden('misc/nestest_log.bin')
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    # nestest.nes 所需的特殊初始化
+    cpu.set_reg_value('pc', 0xc000)
+    cpu.set_reg_value('p', 0x24)
+    jit = nj.NesJIT(cpu, threshold=1)
+
+    # 编译好的块一次执行多条指令，只能在块的边界上和标准日志比较寄存器
+    keys = ('PC', 'A', 'X', 'Y', 'P', 'S')
+    while differ.cursor < differ.count:
+        log = differ.pop_log()
+        expected = [log[k] for k in keys]
+        result = [cpu.reg_value(k) for k in keys]
+        assert expected == result, (differ.cursor, result)
+        differ.cursor += jit.step() - 1
+
+    assert jit.compiled_instructions > 1000, jit.compiled_instructions
+
+
+def test_io_fallback():
+    # LDA #$1E; LDX #$01; STA $2000,X（写 PPUMASK）; JMP $0200
+    cpu = nc.NesCPU()
+    cpu.ram[0x200:0x20a] = bytes([0xa9, 0x1e, 0xa2, 0x01, 0x9d, 0x00, 0x20, 0x4c, 0x00, 0x02])
+    cpu.pc = 0x200
+    jit = nj.NesJIT(cpu, threshold=1)
+    # 第二圈解码，第三圈编译
+    for _ in range(8):
+        jit.step()
+
+    # 编译好的块执行到 STA 之前就返回，STA 由解释器执行
+    cpu.pc = 0x200
+    expected = (2, 0x204)
+    result = (jit.step(), cpu.pc)
+    assert expected == result, result
+    expected = (1, 0x207, 0x1e)
+    result = (jit.step(), cpu.pc, cpu.ppu.registers['PPUMASK'])
+    assert expected == result, result
+
+
+def test_scheduler():
+    expected = tns.prepared_scheduler()
+    result = ns.NesScheduler(tns.prepared_scheduler().cpu, jit=True)
+    for _ in range(8):
+        expected.run_frame()
+        result.run_frame()
+
+    # NMI 的时机、画面和 RAM 都和逐条执行一样
+    assert tns.snapshot(expected) == tns.snapshot(result)
+    assert result.jit.compiled_instructions > 0, result.jit.compiled_instructions
+
+
+def test_rmw_memory():
+    # LDX #$02; ROL $10,X; ROR $0300,X; RLA $20,X; RRA $0310,X; INC $30,X; ASL $0320,X; JMP $0202
+    program = bytes([
+        0xa2, 0x02, 0x36, 0x10, 0x7e, 0x00, 0x03, 0x37, 0x20, 0x7f, 0x10, 0x03,
+        0xf6, 0x30, 0x1e, 0x20, 0x03, 0x4c, 0x02, 0x02,
+    ])
+    expected = nc.NesCPU()
+    result = nc.NesCPU()
+    for cpu in (expected, result):
+        cpu.ram[0x200:0x200 + len(program)] = program
+        cpu.ram[0x10:0x40] = bytes(range(0x81, 0xb1))
+        cpu.ram[0x300:0x330] = bytes(range(0x31, 0x61))
+        cpu.pc = 0x200
+    jit = nj.NesJIT(result, threshold=1)
+
+    # 读-改-写的结果要写回按 X 变址得到的地址，只比较寄存器发现不了写错地址
+    for _ in range(40):
+        for _ in range(jit.step()):
+            expected.execute()
+        assert expected.ram[:0x800] == result.ram[:0x800]
+        assert (expected.pc, expected.a, expected.p) == (result.pc, result.a, result.p)
+    assert jit.compiled_instructions > 0, jit.compiled_instructions
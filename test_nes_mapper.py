@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import nes_cpu as nc
+import nes_file as nf
+import test_nes_file as nft
+
+
+def prepared_cpu(mapper: int, prg_banks: int, chr_banks: int, flags6=0):
+    header = b'NES\x1a' + bytes([prg_banks, chr_banks, (mapper & 0x0f) << 4 | flags6, mapper & 0xf0]) + bytes(8)
+    nes = nf.NesFile(nft.nes_data(header, prg_banks, chr_banks))
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    return cpu
+
+
+def test_nrom():
+    cpu = prepared_cpu(0, 1, 1, flags6=0b00000001)
+    expected = (0, 0, 0x80, 'vertical')
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000), cpu.ppu.mem_value(0x1fff), cpu.mapper.mirroring)
+    assert expected == result, result
+
+    # PRG-RAM
+    cpu.set_mem_value(0x6123, 0x42)
+    expected = 0x42
+    result = cpu.mem_value(0x6123)
+    assert expected == result, result
+
+
+def test_uxrom():
+    cpu = prepared_cpu(2, 8, 0)
+    expected = (0, 7)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xffff))
+    assert expected == result, result
+
+    cpu.set_mem_value(0x8000, 5)
+    expected = (5, 5, 7)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xbfff), cpu.mem_value(0xc000))
+    assert expected == result, result
+
+    # 没有 CHR-ROM 时使用 CHR-RAM
+    cpu.ppu.set_mem_value(0x0123, 0x99)
+    expected = 0x99
+    result = cpu.ppu.mem_value(0x0123)
+    assert expected == result, result
+
+
+def test_uxrom_decoded():
+    cpu = prepared_cpu(2, 8, 0)
+    cpu.set_mem_value(0x8000, 5)
+    for _ in range(2):
+        cpu.pc = 0x8000
+        cpu.execute()
+    expected = 0x05
+    result = cpu.decoded[0x8000][0]
+    assert expected == result, result
+
+    # 切换 bank 之后 $8000 上已解码的指令作废
+    cpu.set_mem_value(0x8000, 6)
+    expected = None
+    result = cpu.decoded[0x8000]
+    assert expected == result, result
+
+    for _ in range(2):
+        cpu.pc = 0x8000
+        cpu.execute()
+    expected = 0x06
+    result = cpu.decoded[0x8000][0]
+    assert expected == result, result
+
+
+def test_cnrom():
+    cpu = prepared_cpu(3, 2, 4)
+    cpu.ppu.frame_rgb()
+    cpu.set_mem_value(0xffff, 2)
+
+    expected = (0x82, 0x82, 1)
+    result = (cpu.ppu.mem_value(0x0000), cpu.ppu.mem_value(0x1fff), cpu.mem_value(0xc000))
+    assert expected == result, result
+
+    # 切换 CHR bank 后所有图样都要重新解码
+    expected = set(range(512))
+    result = cpu.ppu.dirty_tiles
+    assert expected == result, len(result)
+
+
+def write_mmc1(cpu, addr: int, value: int):
+    # 从低位开始，连续写 5 次
+    for i in range(5):
+        cpu.set_mem_value(addr, (value >> i) & 1)
+
+
+def test_mmc1():
+    cpu = prepared_cpu(1, 8, 4)
+    expected = (0, 7)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000))
+    assert expected == result, result
+
+    # PRG 模式 3：切换 $8000，固定 $C000
+    write_mmc1(cpu, 0xe000, 3)
+    expected = (3, 7)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000))
+    assert expected == result, result
+
+    # PRG 模式 2：固定 $8000，切换 $C000；CHR 4KB 模式；垂直镜像
+    write_mmc1(cpu, 0x8000, 0b11010)
+    expected = (0, 3, 'vertical')
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000), cpu.mapper.mirroring)
+    assert expected == result, result
+
+    write_mmc1(cpu, 0xa000, 5)
+    write_mmc1(cpu, 0xc000, 2)
+    expected = (0x82, 0x81)
+    result = (cpu.ppu.mem_value(0x0000), cpu.ppu.mem_value(0x1000))
+    assert expected == result, result
+
+    # 最高位为 1 时重置移位寄存器，并回到 PRG 模式 3
+    cpu.set_mem_value(0x8000, 1)
+    cpu.set_mem_value(0x8000, 0x80)
+    expected = (0, 3, 7)
+    result = (cpu.mapper.shift_count, cpu.mem_value(0x8000), cpu.mem_value(0xc000))
+    assert expected == result, result
+
+
+def test_mmc1_small_prg():
+    # 只有 16KB PRG 时切到 32KB 模式，ROM 在 $8000 和 $C000 各出现一次
+    cpu = prepared_cpu(1, 1, 1)
+    write_mmc1(cpu, 0x8000, 0)
+    expected = (0, 0, 0x80)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000), cpu.ppu.mem_value(0x1fff))
+    assert expected == result, result
+
+
+def test_mirroring():
+    cpu = prepared_cpu(1, 2, 1)
+    ppu = cpu.ppu
+    # 水平镜像：$2000 和 $2400 是同一个名称表
+    write_mmc1(cpu, 0x8000, 0b01111)
+    ppu.set_mem_value(0x2405, 0x11)
+    ppu.set_mem_value(0x2c06, 0x22)
+    expected = (0x11, 0x22)
+    result = (ppu.mem_value(0x2005), ppu.mem_value(0x2806))
+    assert expected == result, result
+
+    # 垂直镜像：$2000 和 $2800 是同一个名称表
+    write_mmc1(cpu, 0x8000, 0b01110)
+    expected = (0x11, 0x11, 0x22)
+    result = (ppu.mem_value(0x2005), ppu.mem_value(0x2805), ppu.mem_value(0x2406))
+    assert expected == result, result
+
+
+def test_mmc1_state():
+    cpu = prepared_cpu(1, 8, 4)
+    write_mmc1(cpu, 0x8000, 0b11010)
+    write_mmc1(cpu, 0xa000, 5)
+    write_mmc1(cpu, 0xe000, 4)
+    cpu.set_mem_value(0x6000, 0x42)
+    state = cpu.save_state()
+
+    # 存档之后切换 bank，读档恢复页表和 PRG-RAM
+    cpu.set_mem_value(0x8000, 0x80)
+    write_mmc1(cpu, 0xa000, 0)
+    cpu.set_mem_value(0x6000, 0)
+    cpu.load_state(state)
+    expected = (0, 4, 0x82, 'vertical', 0x42)
+    result = (cpu.mem_value(0x8000), cpu.mem_value(0xc000), cpu.ppu.mem_value(0x0000), cpu.mapper.mirroring,
+              cpu.mem_value(0x6000))
+    assert expected == result, result
+
+
+def test_unsupported_mapper():
+    header = b'NES\x1a' + bytes([1, 1, 0xf0, 0xf0]) + bytes(8)
+    nes = nf.NesFile(nft.nes_data(header, 1, 1))
+    cpu = nc.NesCPU()
+    try:
+        cpu.load_nes(nes)
+    except ValueError:
+        pass
+    else:
+        assert False, 'mapper 255 should not be supported'
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import nes_controller as nco
+import nes_cpu as nc
+import nes_movie as nm
+import nes_scheduler as ns
+import test_nes_file as nft
+
+
+def recorded_movie(frames: int, presses):
+    # 按 presses（帧 => 按键）录一段 nestest 的录像，每 10 帧一个检查点
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    cpu.interrupt('reset')
+    scheduler = ns.NesScheduler(cpu)
+    movie = nm.Movie(nm.rom_sha1(nes))
+    for i in range(frames):
+        buttons = presses.get(i, 0)
+        cpu.controllers[0].set_buttons(buttons)
+        scheduler.run_frame()
+        movie.add_frame(buttons)
+        if cpu.ppu.frame_count % 10 == 0:
+            movie.add_check(cpu)
+    return movie, cpu
+
+
+def test_movie_bytes():
+    movie, _ = recorded_movie(20, {12: nco.buttons['DOWN']})
+    loaded = nm.Movie.from_bytes(movie.to_bytes())
+
+    expected = (movie.rom, bytes(movie.inputs), movie.checks)
+    result = (loaded.rom, bytes(loaded.inputs), loaded.checks)
+    assert expected == result, result
+    expected = (20, 2, (nco.buttons['DOWN'], 0))
+    result = (len(loaded), len(loaded.checks), loaded.frame_input(12))
+    assert expected == result, result
+
+
+def test_replay():
+    # 按下 Start 后 nestest 开始运行测试，RAM 和画面都会改变
+    presses = {12: nco.buttons['START']}
+    movie, cpu = recorded_movie(30, presses)
+    summary = nm.replay(nft.prepared_nes(), movie)
+
+    expected = (30, 3, [], nm.frame_hashes(cpu)[0].hex())
+    result = (summary['frames'], summary['checks'], summary['mismatches'], summary['framebuffer_sha1'])
+    assert expected == result, summary
+
+    # 不按 Start 时之后的检查点都对不上
+    movie.inputs[12 * 2] = 0
+    summary = nm.replay(nft.prepared_nes(), movie)
+    expected = [20, 30]
+    result = summary['mismatches']
+    assert expected == result, summary
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+import random
+
+import numpy as np
+import pygame
+
+import nes_ppu as npu
+import test_nes_file as nft
+
+
+def fill_random(ppu):
+    # 用固定的随机数填满名称表、属性表和调色盘
+    r = random.Random(0)
+    for addr in range(0x2000, 0x2400):
+        ppu.set_mem_value(addr, r.randrange(256))
+    for addr in range(0x3f00, 0x3f20):
+        ppu.set_mem_value(addr, r.randrange(64))
+
+
+def prepared_ppu():
+    nes = nft.prepared_nes()
+    ppu = npu.NesPPU()
+    ppu.load_nes(nes)
+    fill_random(ppu)
+    return ppu
+
+
+def prepared_chr_ram_ppu():
+    # 不加载 ROM 时图样表是 CHR-RAM，把 nestest 的 CHR 写进去
+    nes = nft.prepared_nes()
+    ppu = npu.NesPPU()
+    for addr, value in enumerate(nes.chr_rom):
+        ppu.set_mem_value(addr, value)
+    fill_random(ppu)
+    return ppu
+
+
+def test_frame_rgb():
+    ppu = prepared_ppu()
+    frame = ppu.frame_rgb()
+
+    expected = (240, 256, 3)
+    result = frame.shape
+    assert expected == result, result
+
+    for y in range(0, 240, 3):
+        for x in range(0, 256, 5):
+            expected = ppu.color_from_xy(x, y)[:3]
+            result = tuple(frame[y, x])
+            assert expected == result, ((x, y), result)
+
+
+def test_frame_rgb_pattern_table():
+    ppu = prepared_ppu()
+    ppu.set_reg_value('ppuctrl', 0b00010000)
+    frame = ppu.frame_rgb()
+
+    for y in range(0, 240, 7):
+        for x in range(0, 256, 3):
+            expected = ppu.color_from_xy(x, y)[:3]
+            result = tuple(frame[y, x])
+            assert expected == result, ((x, y), result)
+
+
+def test_draw():
+    ppu = prepared_ppu()
+    # 显示背景，运行一帧，画面按扫描线输出
+    ppu.set_reg_value('ppumask', 0b00001000)
+    ppu.step(262 * 341)
+    canvas = pygame.Surface((256, 240))
+    ppu.draw(canvas)
+
+    expected = ppu.frame_rgb().transpose(1, 0, 2).tolist()
+    result = pygame.surfarray.array3d(canvas).tolist()
+    assert expected == result
+
+
+def test_tiles():
+    ppu = prepared_chr_ram_ppu()
+    # 第 1 个图样的第 0 行：平面 0 为 0b10000001，平面 1 为 0b11000000
+    ppu.set_mem_value(0x0010, 0b10000001)
+    ppu.set_mem_value(0x0018, 0b11000000)
+    ppu._refresh_tiles()
+
+    expected = [3, 2, 0, 0, 0, 0, 0, 1]
+    result = ppu.tiles[1][0].tolist()
+    assert expected == result, result
+
+
+def test_tiles_invalidate():
+    ppu = prepared_chr_ram_ppu()
+    ppu.frame_rgb()
+    # 通过 PPUDATA 改写 CHR
+    ppu.set_reg_value_for_cpu(0x2006, 0x10)
+    ppu.set_reg_value_for_cpu(0x2006, 0x20)
+    for _ in range(16):
+        ppu.set_reg_value_for_cpu(0x2007, 0xff)
+
+    expected = {0x102}
+    result = ppu.dirty_tiles
+    assert expected == result, result
+
+    ppu.set_reg_value('ppuctrl', 0b00010000)
+    frame = ppu.frame_rgb()
+    expected = [[3] * 8] * 8
+    result = ppu.tiles[0x102].tolist()
+    assert expected == result, result
+    for y in range(0, 240, 3):
+        for x in range(0, 256, 5):
+            expected = ppu.color_from_xy(x, y)[:3]
+            result = tuple(frame[y, x])
+            assert expected == result, ((x, y), result)
+
+
+def fresh_frame_rgb(ppu):
+    # 用同样的显存重新画一帧，作为增量画面的参照
+    fresh = npu.NesPPU()
+    fresh.registers.update(ppu.registers)
+    fresh.memory[:] = ppu.memory
+    fresh.pattern_pages = list(ppu.pattern_pages)
+    fresh.name_table_offsets = ppu.name_table_offsets
+    fresh.t = ppu.t
+    fresh.x = ppu.x
+    patterns = np.concatenate([np.frombuffer(page, dtype=np.uint8) for page in ppu.pattern_pages])
+    fresh.tiles = npu.tiles_from_patterns(patterns)
+    return fresh.frame_rgb()
+
+
+def test_dirty_names():
+    ppu = prepared_ppu()
+    ppu.frame_rgb()
+
+    expected = set()
+    result = ppu.dirty_names
+    assert expected == result, result
+
+    # 名称表和属性表
+    ppu.set_mem_value(0x2000 + 32 * 5 + 7, 0x41)
+    ppu.set_mem_value(0x23c0 + 8 * 7 + 2, 0b11100100)
+    expected = {32 * 5 + 7} | {row * 32 + col for row in (28, 29) for col in range(8, 12)}
+    result = ppu.dirty_names
+    assert expected == result, result
+
+    result = ppu.frame_rgb()
+    expected = fresh_frame_rgb(ppu)
+    assert (expected == result).all()
+
+    # 调色盘
+    ppu.set_mem_value(0x3f01, 0x21)
+    ppu.set_mem_value(0x3f10, 0x0f)
+    result = ppu.frame_rgb()
+    expected = fresh_frame_rgb(ppu)
+    assert (expected == result).all()
+
+
+def test_dirty_tiles_redraw_names():
+    ppu = prepared_chr_ram_ppu()
+    ppu.frame_rgb()
+
+    # 改写 0x41 号图样，所有使用它的名称都要重画
+    for offset in range(16):
+        ppu.set_mem_value(0x0410 + offset, 0b10100101)
+    result = ppu.frame_rgb()
+    expected = fresh_frame_rgb(ppu)
+    assert (expected == result).all()
+
+
+def test_chr_rom_read_only():
+    nes = nft.prepared_nes()
+    ppu = prepared_ppu()
+    ppu.set_mem_value(0x0010, nes.chr_rom[0x0010] ^ 0xff)
+
+    expected = (nes.chr_rom[0x0010], set())
+    result = (ppu.mem_value(0x0010), ppu.dirty_tiles)
+    assert expected == result, result
+
+
+def test_frame_timing():
+    ppu = npu.NesPPU()
+    # 关闭渲染时每帧 262 * 341 个点
+    ppu.step(262 * 341 - 1)
+    expected = (0, 261, 340)
+    result = (ppu.frame_count, ppu.scanline, ppu.dot)
+    assert expected == result, result
+    ppu.step(1)
+    expected = (1, 0, 0)
+    result = (ppu.frame_count, ppu.scanline, ppu.dot)
+    assert expected == result, result
+
+    # 打开渲染时奇数帧少一个点，两帧共 2 * 29780.5 个 CPU 周期
+    ppu = npu.NesPPU()
+    ppu.set_reg_value('ppumask', 0b00011000)
+    dots = 0
+    while ppu.frame_count < 2:
+        ppu.step(3)
+        dots += 3
+    expected = 29780.5 * 2 * 3
+    result = dots - ppu.scanline * 341 - ppu.dot
+    assert expected == result, result
+
+
+def test_vblank():
+    ppu = npu.NesPPU()
+    nmis = []
+    ppu.nmi_callback = lambda: nmis.append(ppu.scanline)
+    ppu.set_reg_value('ppustatus', 0)
+    ppu.set_reg_value('ppuctrl', 0b10000000)
+
+    ppu.step(241 * 341 - 1)
+    expected = (0, [])
+    result = (ppu.reg_value('ppustatus'), nmis)
+    assert expected == result, result
+
+    ppu.step(1)
+    expected = (0b10000000, [241])
+    result = (ppu.reg_value('ppustatus'), nmis)
+    assert expected == result, result
+
+    # 读取 PPUSTATUS 会清除 VBlank 标志
+    expected = (0b10000000, 0)
+    result = (ppu.reg_value_for_cpu(0x2002), ppu.reg_value('ppustatus'))
+    assert expected == result, result
+
+    # 预渲染线清除 VBlank
+    ppu.registers['PPUSTATUS'] = 0b11100000
+    ppu.step(20 * 341)
+    expected = 0
+    result = ppu.reg_value('ppustatus')
+    assert expected == result, result
+
+
+def test_vblank_enable_nmi():
+    ppu = npu.NesPPU()
+    nmis = []
+    ppu.nmi_callback = lambda: nmis.append(ppu.scanline)
+    ppu.set_reg_value('ppustatus', 0)
+    ppu.step(250 * 341)
+    # VBlank 期间打开 NMI 会立即触发
+    ppu.set_reg_value_for_cpu(0x2000, 0b10000000)
+    ppu.set_reg_value_for_cpu(0x2000, 0b10000000)
+    expected = [250]
+    result = nmis
+    assert expected == result, result
+
+
+def test_render_line():
+    ppu = prepared_ppu()
+    ppu.set_reg_value('ppumask', 0b00001000)
+    before = ppu.frame_rgb().copy()
+
+    # 帧中途改动调色盘，只影响之后的扫描线
+    ppu.step(100 * 341)
+    ppu.set_mem_value(0x3f00, 0x21)
+    ppu.step(162 * 341)
+    after = ppu.frame_rgb()
+
+    assert (ppu.screen[:100] == before[:100]).all()
+    assert (ppu.screen[100:] == after[100:]).all()
+    assert (ppu.screen[100:] != before[100:]).any()
+
+
+def test_loopy_registers():
+    ppu = npu.NesPPU()
+    ppu.set_reg_value_for_cpu(0x2000, 0b10)
+    ppu.reg_value_for_cpu(0x2002)
+    expected = (0x0800, 0)
+    result = (ppu.t, ppu.w)
+    assert expected == result, result
+
+    # PPUSCROLL：X 为 $7D，Y 为 $5E
+    ppu.set_reg_value_for_cpu(0x2005, 0x7d)
+    expected = (0x080f, 0b101, 1)
+    result = (ppu.t, ppu.x, ppu.w)
+    assert expected == result, result
+    ppu.set_reg_value_for_cpu(0x2005, 0x5e)
+    expected = (0x696f, 0)
+    result = (ppu.t, ppu.w)
+    assert expected == result, result
+
+    # PPUADDR 和 PPUSCROLL 共用 t 和 w，第二次写入时 v = t
+    ppu.set_reg_value_for_cpu(0x2006, 0x3d)
+    ppu.set_reg_value_for_cpu(0x2006, 0xf0)
+    expected = (0x3df0, 0x3df0, 0b101, 0)
+    result = (ppu.t, ppu.v, ppu.x, ppu.w)
+    assert expected == result, result
+
+
+def scrolled_ppu(mirroring: str):
+    ppu = npu.NesPPU()
+    ppu.load_nes(nft.prepared_nes())
+    ppu.set_mirroring(mirroring)
+    r = random.Random(1)
+    for addr in range(0x2000, 0x3000):
+        ppu.set_mem_value(addr, r.randrange(256))
+    for addr in range(0x3f00, 0x3f20):
+        ppu.set_mem_value(addr, r.randrange(64))
+    return ppu
+
+
+def set_scroll(ppu, name_table: int, x: int, y: int):
+    ppu.set_reg_value_for_cpu(0x2000, name_table)
+    ppu.reg_value_for_cpu(0x2002)
+    ppu.set_reg_value_for_cpu(0x2005, x)
+    ppu.set_reg_value_for_cpu(0x2005, y)
+
+
+def test_frame_rgb_scroll():
+    for mirroring in ('horizontal', 'vertical', 'four_screen'):
+        ppu = scrolled_ppu(mirroring)
+        # 向右下滚动，画面跨过 4 个名称表
+        set_scroll(ppu, 0b11, 0x7d, 0x5e)
+        frame = ppu.frame_rgb()
+        for y in range(0, 240, 3):
+            for x in range(0, 256, 5):
+                expected = ppu.color_from_xy(x, y)[:3]
+                result = tuple(frame[y, x])
+                assert expected == result, (mirroring, (x, y), result)
+
+
+def test_mirroring_dirty_names():
+    ppu = scrolled_ppu('vertical')
+    set_scroll(ppu, 0b01, 0x30, 0xa0)
+    ppu.frame_rgb()
+    # 垂直镜像时 $2C00 就是 $2400，两个逻辑名称表都要重画
+    ppu.set_mem_value(0x2c00 + 32 * 3 + 4, 0x41)
+    ppu.set_mem_value(0x2fc0 + 8 * 2 + 1, 0b00011011)
+
+    expected = ppu.mem_value(0x2400 + 32 * 3 + 4)
+    result = 0x41
+    assert expected == result, result
+    result = ppu.frame_rgb()
+    expected = fresh_frame_rgb(ppu)
+    assert (expected == result).all()
+
+
+def test_split_scroll():
+    ppu = scrolled_ppu('vertical')
+    ppu.set_reg_value('ppumask', 0b00001000)
+    before = ppu.frame_rgb()
+
+    # 帧中途改动水平滚动，粗略 X 从下一条扫描线开始生效（精细 X 立即生效），垂直滚动要到下一帧才生效
+    ppu.step(100 * 341)
+    set_scroll(ppu, 0, 0x84, 0x40)
+    ppu.step(162 * 341)
+    set_scroll(ppu, 0, 0x84, 0)
+    after = ppu.frame_rgb()
+
+    assert (ppu.screen[:100] == before[:100]).all()
+    assert (ppu.screen[101:] == after[101:]).all()
+    assert (ppu.screen[101:] != before[101:]).any()
+
+
+def sprite_ppu():
+    # 0 号图样全透明，1 号图样全为颜色 1，2 号图样只有左上角一个像素为颜色 3
+    ppu = npu.NesPPU()
+    for offset in range(8):
+        ppu.set_mem_value(0x0010 + offset, 0xff)
+    ppu.set_mem_value(0x0020, 0x80)
+    ppu.set_mem_value(0x0028, 0x80)
+    # 调色盘的第 i 项为颜色 i，$3F10 等是 $3F00 等的镜像，跳过
+    for addr in range(0x3f00, 0x3f20):
+        if addr & 0b11 or addr < 0x3f10:
+            ppu.set_mem_value(addr, addr & 0x1f)
+    ppu.set_reg_value('ppumask', 0b00011000)
+    # Y 坐标为 $FF 的精灵不会显示
+    ppu.oam[:] = b'\xff' * 0x100
+    return ppu
+
+
+def set_sprite(ppu, i: int, y: int, number: int, attr: int, x: int):
+    ppu.oam[i * 4:i * 4 + 4] = bytes([y, number, attr, x])
+    ppu.evaluated_sprite_height = None
+
+
+def color_of_index(index: int):
+    return npu.NesPPU().colors_rgb[index].tolist()
+
+
+def test_oam_data():
+    ppu = npu.NesPPU()
+    ppu.set_reg_value_for_cpu(0x2003, 0xfe)
+    for v in (1, 2, 3):
+        ppu.set_reg_value_for_cpu(0x2004, v)
+
+    expected = ([1, 2, 3], 0x01)
+    result = ([ppu.oam[0xfe], ppu.oam[0xff], ppu.oam[0x00]], ppu.reg_value('oamaddr'))
+    assert expected == result, result
+
+
+def test_sprites():
+    ppu = sprite_ppu()
+    # 0 号精灵用调色盘 1，1 号精灵用调色盘 2，两者在 (20, 10) 开始重叠
+    set_sprite(ppu, 0, 9, 1, 0b01, 20)
+    set_sprite(ppu, 1, 9, 1, 0b10, 16)
+    ppu.step(262 * 341)
+
+    row = ppu.screen[10].tolist()
+    expected = [color_of_index(0)] * 16 + [color_of_index(0x19)] * 4 + [color_of_index(0x15)] * 8
+    result = row[:28]
+    assert expected == result, result
+    # 精灵从 Y 坐标的下一行开始显示，共 8 行
+    expected = (color_of_index(0), color_of_index(0x15), color_of_index(0x15), color_of_index(0))
+    result = (ppu.screen[9, 20].tolist(), ppu.screen[10, 20].tolist(), ppu.screen[17, 20].tolist(),
+              ppu.screen[18, 20].tolist())
+    assert expected == result, result
+
+
+def test_sprite_flip():
+    ppu = sprite_ppu()
+    set_sprite(ppu, 0, 49, 2, 0b00, 100)
+    set_sprite(ppu, 1, 99, 2, 0b11000000, 100)
+    ppu.step(262 * 341)
+
+    expected = (color_of_index(0x13), color_of_index(0), color_of_index(0x13), color_of_index(0))
+    result = (ppu.screen[50, 100].tolist(), ppu.screen[57, 107].tolist(),
+              ppu.screen[107, 107].tolist(), ppu.screen[100, 100].tolist())
+    assert expected == result, result
+
+
+def test_sprite_priority_and_hit():
+    ppu = sprite_ppu()
+    # 背景的左上角 2x2 个名称使用 1 号图样，颜色 1
+    for addr in (0x2000, 0x2001, 0x2020, 0x2021):
+        ppu.set_mem_value(addr, 1)
+    # 0 号精灵在背景后面，1 号精灵在前面
+    set_sprite(ppu, 0, 0, 1, 0b00100001, 12)
+    set_sprite(ppu, 1, 0, 1, 0b00000010, 0)
+    ppu.step(241 * 341)
+
+    # 背景不透明时在背景后面的精灵被挡住，背景透明时显示
+    expected = ([color_of_index(0x19)] * 8, [color_of_index(0x01)] * 4, [color_of_index(0x15)] * 4)
+    result = (ppu.screen[1, 0:8].tolist(), ppu.screen[1, 12:16].tolist(), ppu.screen[1, 16:20].tolist())
+    assert expected == result, result
+
+    # 背后的精灵也会触发 sprite 0 hit
+    expected = 0b01000000
+    result = ppu.reg_value('ppustatus') & 0b01000000
+    assert expected == result, result
+
+
+def test_sprite_evaluation():
+    ppu = sprite_ppu()
+    # 同一行有 9 个精灵，只显示前 8 个
+    for i in range(9):
+        set_sprite(ppu, i, 29, 1, 0b01, i * 10)
+    ppu.step(241 * 341)
+
+    expected = ([color_of_index(0x15)] * 8, color_of_index(0), 0b00100000)
+    result = (ppu.screen[30, 70:78].tolist(), ppu.screen[30, 80].tolist(), ppu.reg_value('ppustatus') & 0b00100000)
+    assert expected == result, result
+
+
+def test_sprite_8x16():
+    ppu = sprite_ppu()
+    ppu.set_reg_value('ppuctrl', 0b00100000)
+    # 图样编号 2 表示上半部分用 2 号图样，下半部分用 3 号图样（全透明）
+    set_sprite(ppu, 0, 9, 2, 0b10000000, 0)
+    ppu.step(241 * 341)
+
+    # 垂直翻转后 2 号图样的左上角像素在第 16 行
+    expected = (color_of_index(0), color_of_index(0x13))
+    result = (ppu.screen[10, 0].tolist(), ppu.screen[25, 0].tolist())
+    assert expected == result, result
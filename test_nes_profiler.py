@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import log_differ as ld
+import nes_cpu as nc
+import nes_profiler as npr
+import test_nes_file as nft
+import test_nes_scheduler as tns
+
+
+def test_counts():
+    differ = ld.GoldenLogDiffer.from_golden('misc/nestest_log.bin')
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    # nestest.nes 所需的特殊初始化
+    cpu.set_reg_value('pc', 0xc000)
+    cpu.set_reg_value('p', 0x24)
+    profiler = npr.NesProfiler(cpu, sample_interval=1)
+    cycles = cpu.cycles
+    for _ in range(differ.count):
+        profiler.execute()
+
+    expected = (differ.count, cpu.cycles - cycles)
+    result = (sum(profiler.pc_counts), profiler.cycles)
+    assert expected == result, result
+    expected = 1
+    result = profiler.pc_counts[0xc000]
+    assert expected == result, result
+    jsr = sum(profiler.opcode_counts[c] for c in range(0x100) if cpu.dispatch[c][0] == 'JSR')
+    assert jsr > 0, jsr
+
+    # 折叠栈的周期数加起来等于总周期数，nestest 的每个测试都是从 $C000 附近调用的子程序
+    stacks = [line.rsplit(' ', 1) for line in profiler.collapsed_stacks()]
+    expected = profiler.cycles
+    result = sum(int(cycles) for _, cycles in stacks)
+    assert expected == result, result
+    assert all(frames.startswith('main') for frames, _ in stacks), stacks
+    assert len(stacks) > 1, stacks
+
+    report = profiler.report(top=5)
+    assert report.startswith('{} instructions'.format(differ.count)), report
+    assert 'OPCODE' in report and 'MODE' in report, report
+
+
+def test_scheduler():
+    expected = tns.prepared_scheduler()
+    result = tns.prepared_scheduler()
+    profiler = npr.NesProfiler(result.cpu)
+    profiler.attach(result)
+    instructions = 0
+    for _ in range(4):
+        expected.run_frame()
+        instructions += result.run_frame()
+    profiler.detach(result)
+
+    # 分析时执行的结果和不分析时一样，NMI 处理程序出现在调用栈里
+    assert tns.snapshot(expected) == tns.snapshot(result)
+    expected = instructions
+    result = profiler.instructions
+    assert expected == result, result
+    assert any(f.startswith('int') for key in profiler.stack_cycles for f in key), profiler.stack_cycles
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import nes_rewind as nr
+import test_nes_scheduler as tns
+
+
+def state_of(scheduler):
+    cpu = scheduler.cpu
+    return cpu.registers, cpu.cycles, bytes(cpu.ram), scheduler.ppu.frame_count
+
+
+def test_rewind():
+    scheduler = tns.prepared_scheduler()
+    rewind = nr.RewindBuffer(scheduler, interval=2, keyframe_interval=3)
+    states = {}
+    for _ in range(12):
+        scheduler.run_frame()
+        if rewind.capture():
+            states[scheduler.ppu.frame_count] = state_of(scheduler)
+
+    expected = ([2, 4, 6, 8, 10, 12], [True, False, False, True, False, False])
+    result = ([s.frame for s in rewind.snapshots], [s.keyframe for s in rewind.snapshots])
+    assert expected == result, result
+
+    # 当前就是第 12 帧，回到之前的第 10 帧，再回到第 8 帧（关键帧）
+    for frame in (10, 8):
+        expected = (frame, states[frame])
+        result = (rewind.rewind(), state_of(scheduler))
+        assert expected == result, result
+
+    # 倒带后继续运行，新的快照和剩下的关键帧衔接
+    scheduler.run_frame()
+    scheduler.run_frame()
+    rewind.capture()
+    expected = state_of(scheduler)
+    scheduler.run_frame()
+    result = (rewind.rewind(), state_of(scheduler))
+    assert (10, expected) == result, result
+
+
+def test_rewind_past_oldest():
+    scheduler = tns.prepared_scheduler()
+    rewind = nr.RewindBuffer(scheduler, interval=2, keyframe_interval=3)
+    scheduler.run_frame()
+    scheduler.run_frame()
+    rewind.capture()
+    # 唯一的快照就是当前帧，没有更早的快照可以回去
+    expected = (None, 0)
+    result = (rewind.rewind(), len(rewind))
+    assert expected == result, result
+
+    # 之后保存的快照重新从关键帧开始
+    scheduler.run_frame()
+    scheduler.run_frame()
+    rewind.capture()
+    expected = (4, state_of(scheduler))
+    scheduler.run_frame()
+    result = (rewind.rewind(), state_of(scheduler))
+    assert expected == result, result
+
+
+def test_rewind_max_bytes():
+    scheduler = tns.prepared_scheduler()
+    rewind = nr.RewindBuffer(scheduler, keyframe_interval=4, max_bytes=1)
+    for _ in range(10):
+        scheduler.run_frame()
+        rewind.capture()
+
+    # 超出上限时整组丢弃，只留下最新的一组
+    expected = ([9, 10], 1)
+    result = ([s.frame for s in rewind.snapshots], rewind.keyframes)
+    assert expected == result, result
+    expected = sum(len(s.data) for s in rewind.snapshots)
+    result = rewind.size
+    assert expected == result, result
+
+    scheduler.run_frame()
+    expected = 10
+    result = rewind.rewind()
+    assert expected == result, result
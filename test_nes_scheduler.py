@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import nes_cpu as nc
+import nes_scheduler as ns
+import test_nes_file as nft
+
+
+def prepared_scheduler():
+    nes = nft.prepared_nes()
+    cpu = nc.NesCPU()
+    cpu.load_nes(nes)
+    cpu.interrupt('reset')
+    return ns.NesScheduler(cpu)
+
+
+def test_step():
+    scheduler = prepared_scheduler()
+    cycles = scheduler.step()
+
+    # PPU 比 CPU 快 3 倍，reset 用掉的 7 个周期在创建调度器之前
+    expected = (scheduler.cpu.cycles, cycles * 3)
+    result = (scheduler.synced_cycles, scheduler.ppu.scanline * 341 + scheduler.ppu.dot)
+    assert expected == result, result
+
+
+def test_run_frame():
+    scheduler = prepared_scheduler()
+    scheduler.run_frame()
+    scheduler.run_frame()
+
+    # 前两帧 nestest 还没有打开渲染，每帧 89342 个点
+    expected = 2
+    result = scheduler.ppu.frame_count
+    assert expected == result, result
+    ppu = scheduler.ppu
+    expected = 89342 * 2 + ppu.scanline * 341 + ppu.dot
+    result = (scheduler.synced_cycles - 7) * 3
+    assert expected == result, result
+
+
+def test_run_cycles():
+    scheduler = prepared_scheduler()
+    scheduler.run_cycles(1000)
+    assert 1000 <= scheduler.cpu.cycles - 7 < 1000 + 7, scheduler.cpu.cycles
+
+
+def snapshot(scheduler):
+    cpu = scheduler.cpu
+    return cpu.registers, cpu.cycles, bytes(cpu.ram), scheduler.ppu.screen.tobytes()
+
+
+def test_save_state():
+    scheduler = prepared_scheduler()
+    for _ in range(8):
+        scheduler.run_frame()
+    state = scheduler.save_state()
+    for _ in range(4):
+        scheduler.run_frame()
+    expected = snapshot(scheduler)
+
+    # 从存档继续运行，结果和一直运行下去一样
+    scheduler.load_state(state)
+    for _ in range(4):
+        scheduler.run_frame()
+    result = snapshot(scheduler)
+    assert expected == result
+
+    # 读到另一台新的机器上
+    other = prepared_scheduler()
+    other.load_state(state)
+    for _ in range(4):
+        other.run_frame()
+    result = snapshot(other)
+    assert expected == result
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import config
+import nes_cpu as nc
+import nes_trace as nt
+import test_nes_file as nft
+
+
+def test_trace_writer():
+    path = os.path.join(tempfile.mkdtemp(), 'test.trace')
+    # 块很小，确保用完空闲块后也能继续记录
+    writer = nt.TraceWriter(path, records_per_block=3, blocks=2)
+    records = [(0xc000 + i, 0x4c, i - 1, i & 0xff, 1, 2, 0xfd, 0x24) for i in range(100)]
+    for r in records:
+        writer.record(*r)
+    writer.flush()
+
+    expected = records
+    result = list(nt.records_from_file(path))
+    assert expected == result, result[:3]
+
+    writer.close()
+    writer.close()
+
+
+def test_line_from_record():
+    record = (0xc000, 0x4c, 0xc5f5, 0, 0, 0, 0xfd, 0x24)
+    expected = 'C000 JMP C5F5 A:00 X:00 Y:00 S:FD P:0010 0100 '
+    result = nt.line_from_record(record)
+    assert expected == result, result
+
+
+def test_cpu_trace():
+    old_path = config.TRACE_PATH
+    config.TRACE_PATH = os.path.join(tempfile.mkdtemp(), 'cpu.trace')
+    try:
+        nes = nft.prepared_nes()
+        cpu = nc.NesCPU()
+        cpu.load_nes(nes)
+        cpu.set_reg_value('pc', 0xc000)
+        cpu.set_reg_value('p', 0x24)
+        for _ in range(3):
+            cpu.execute()
+        nt.tracer().close()
+
+        expected = [
+            'C000 JMP C5F5 A:00 X:00 Y:00 S:FD P:0010 0100 ',
+            'C5F5 LDX 0000 A:00 X:00 Y:00 S:FD P:0010 0100 ',
+            'C5F7 STX 0000 A:00 X:00 Y:00 S:FD P:0010 0110 ',
+        ]
+        result = [nt.line_from_record(r) for r in nt.records_from_file(config.TRACE_PATH)]
+        assert expected == result, result
+    finally:
+        config.TRACE_PATH = old_path